@@ -2,7 +2,8 @@ import asyncio
 import logging
 import os
 import json
-import aiohttp
+import hashlib
+from collections import OrderedDict
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.types import (
     Message,
@@ -10,24 +11,34 @@ from aiogram.types import (
     InlineKeyboardButton,
     ReplyKeyboardMarkup,
     KeyboardButton,
-    BufferedInputFile,
+    InputFile,
 )
 from aiogram.filters import CommandStart
-from aiohttp import FormData, ClientSession
+from aiogram.exceptions import TelegramBadRequest
+from aiohttp import FormData
 from aiogram.client.default import DefaultBotProperties
 
 from dotenv import load_dotenv
 load_dotenv(dotenv_path=".env")
 
+from utils.api_client import ApiClient
+
 API_TOKEN = os.getenv("BOT_TOKEN", "your bot token")
 API_BASE = os.getenv("API_BASE", "http://localhost:8000")
 UPLOAD_DIR = "uploads"
+SCENARIO_POLL_SEC = float(os.getenv("SCENARIO_POLL_SEC", "1.0"))
+SCENARIO_TIMEOUT_SEC = float(os.getenv("SCENARIO_TIMEOUT_SEC", "300"))
+TEMPLATES_PAGE_SIZE = 8
+BOT_METRICS_LOG_SEC = float(os.getenv("BOT_METRICS_LOG_SEC", "300"))
+BOT_FILE_ID_CACHE = int(os.getenv("BOT_FILE_ID_CACHE", "2000"))
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
 bot = Bot(token=API_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
 dp = Dispatcher()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("invoicebot")
+# Один клиент на процесс бота: создается при старте диспетчера, закрывается при остановке
+api = ApiClient(API_BASE)
 
 main_menu = ReplyKeyboardMarkup(
     keyboard=[
@@ -50,29 +61,126 @@ def pretty_scenario_status(scenario: dict) -> str:
     }
     current = scenario.get("step", "")
     status = scenario.get("status", "")
+    log = {entry.get("step"): entry for entry in scenario.get("log", []) if entry.get("step")}
     lines = []
-    found_current = False
-    for step in steps:
-        emoji = step_emojis.get(step, "•")
-        if status == "error" and step == current:
-            lines.append(f"{emoji} <b>{step}</b> — ❌ <b>Ошибка</b>")
-            found_current = True
-            break
-        elif step == current:
-            lines.append(f"{emoji} <b>{step}</b> — <b>В процессе...</b>")
-            found_current = True
-        elif not found_current:
-            lines.append(f"{emoji} {step} — ✅")
-        else:
-            lines.append(f"{emoji} {step} — ⏳")
+    if log:
+        # Реальные шаги сценария из лога сервера: статус и длительность каждого
+        for step in steps:
+            emoji = step_emojis.get(step, "•")
+            entry = log.get(step)
+            if entry is None:
+                lines.append(f"{emoji} {step} — ⏳")
+            elif entry.get("status") == "error":
+                lines.append(f"{emoji} <b>{step}</b> — ❌ <b>Ошибка</b>")
+            elif entry.get("status") == "running":
+                lines.append(f"{emoji} <b>{step}</b> — <b>В процессе...</b>")
+            else:
+                lines.append(f"{emoji} {step} — ✅ {entry.get('duration_sec', 0):.2f} с")
+    else:
+        found_current = False
+        for step in steps:
+            emoji = step_emojis.get(step, "•")
+            if status == "error" and step == current:
+                lines.append(f"{emoji} <b>{step}</b> — ❌ <b>Ошибка</b>")
+                found_current = True
+                break
+            elif step == current:
+                lines.append(f"{emoji} <b>{step}</b> — <b>В процессе...</b>")
+                found_current = True
+            elif not found_current:
+                lines.append(f"{emoji} {step} — ✅")
+            else:
+                lines.append(f"{emoji} {step} — ⏳")
     if scenario.get("log"):
         lines.append("\n<b>Лог:</b>")
         for entry in scenario["log"]:
             msg = entry.get("error") or entry.get("message") or ""
             lines.append(f"{entry.get('time', '')} [{entry.get('step', '')}]: {msg}")
+    if status == "error" and scenario.get("error_message"):
+        lines.append(f"❌ {scenario['error_message']}")
     return "\n".join(lines)
 
 
+async def wait_for_scenario(user_id: str, scenario: dict, progress: Message):
+    """
+    Опрашивает сценарий обработки шаблона, обновляя сообщение с прогрессом.
+    Возвращает (scenario, result); result — None при ошибке или таймауте.
+    """
+    scenario_id = scenario["scenario_id"]
+    result = None
+    last_text = None
+    deadline = asyncio.get_running_loop().time() + SCENARIO_TIMEOUT_SEC
+    while True:
+        text = pretty_scenario_status(scenario)
+        if text != last_text:
+            try:
+                await progress.edit_text(f"📈 Прогресс:\n{text}")
+            except Exception as e:
+                logger.warning(f"Не удалось обновить прогресс: {e}")
+            last_text = text
+        if scenario.get("status") in ("finished", "error"):
+            return scenario, result if scenario.get("status") == "finished" else None
+        if asyncio.get_running_loop().time() > deadline:
+            return scenario, None
+        await asyncio.sleep(SCENARIO_POLL_SEC)
+        r = await api.get(f"/api/v1/template/scenario/{scenario_id}", params={"tg_id": user_id})
+        if r.status != 200:
+            return scenario, None
+        data = r.json()
+        scenario, result = data["scenario"], data.get("result")
+
+
+class ApiStreamInputFile(InputFile):
+    """Файл для Telegram, читаемый из API потоком: байты идут в загрузку без буфера на весь PDF."""
+
+    def __init__(self, path: str, params: dict, filename: str):
+        super().__init__(filename=filename)
+        self.path = path
+        self.params = params
+
+    async def read(self, bot: Bot):
+        async for chunk in api.stream(self.path, chunk_size=self.chunk_size, params=self.params):
+            yield chunk
+
+
+# SHA-256 содержимого -> file_id в Telegram: одинаковый документ повторно не загружается
+_file_ids: "OrderedDict[str, str]" = OrderedDict()
+
+
+def cached_file_id(sha256: str):
+    file_id = _file_ids.get(sha256) if sha256 else None
+    if file_id:
+        _file_ids.move_to_end(sha256)
+    return file_id
+
+
+def remember_file_id(sha256: str, file_id: str):
+    if not sha256 or not file_id:
+        return
+    _file_ids[sha256] = file_id
+    _file_ids.move_to_end(sha256)
+    while len(_file_ids) > BOT_FILE_ID_CACHE:
+        _file_ids.popitem(last=False)
+
+
+async def send_rendered_pdf(message: Message, user_id: str, filename: str, sha256: str, caption: str):
+    """Готовый PDF: по file_id из кэша, если такой документ уже отправлялся, иначе потоком из API."""
+    file_id = cached_file_id(sha256)
+    if file_id:
+        try:
+            return await message.answer_document(file_id, caption=caption)
+        except TelegramBadRequest as e:
+            logger.warning(f"file_id для {filename} больше не действует: {e}")
+            _file_ids.pop(sha256, None)
+    sent = await message.answer_document(
+        ApiStreamInputFile("/api/v1/file/rendered", {"tg_id": user_id, "filename": filename}, filename),
+        caption=caption
+    )
+    if sent.document:
+        remember_file_id(sha256, sent.document.file_id)
+    return sent
+
+
 def make_user_edit_json(parsed_data: dict) -> dict:
     user_json, service_values = {}, []
     descs = parsed_data.get("Descriptions") or parsed_data.get("Description")
@@ -111,12 +219,48 @@ def get_user_dir(tg_id: str) -> str:
     return path
 
 
+# путь -> (mtime, размер, SHA-256): неизмененный шрифт не перечитывается, новая версия заменяет старую
+_font_hashes = {}
+
+
+def local_font_hashes(user_dir: str) -> dict:
+    """{SHA-256: путь} для .ttf/.otf в папке пользователя. Читает диск — вызывать через asyncio.to_thread."""
+    hashes = {}
+    for fname in os.listdir(user_dir):
+        if not fname.lower().endswith((".ttf", ".otf")):
+            continue
+        path = os.path.join(user_dir, fname)
+        st = os.stat(path)
+        cached = _font_hashes.get(path)
+        if cached is None or cached[:2] != (st.st_mtime_ns, st.st_size):
+            with open(path, "rb") as f:
+                cached = (st.st_mtime_ns, st.st_size, hashlib.sha256(f.read()).hexdigest())
+            _font_hashes[path] = cached
+        hashes[cached[2]] = path
+    return hashes
+
+
+async def fonts_to_send(user_id: str, user_dir: str) -> list:
+    """Пути шрифтов, которых нет на сервере: сначала хэши, содержимое — только недостающих."""
+    local = await asyncio.to_thread(local_font_hashes, user_dir)
+    if not local:
+        return []
+    resp = await api.post("/api/v1/template/fonts/missing", params={"tg_id": user_id}, json={
+        "fonts": [{"name": os.path.basename(path), "sha256": sha} for sha, path in local.items()]
+    })
+    if resp.status != 200:
+        logger.warning(f"Согласование шрифтов не удалось ({resp.status}), отправляем все")
+        return list(local.values())
+    missing = resp.json().get("missing", [])
+    logger.info(f"Шрифты {user_id}: {len(local) - len(missing)} уже на сервере, отправляем {len(missing)}")
+    return [local[sha] for sha in missing if sha in local]
+
+
 @dp.message(CommandStart())
 async def start(msg: Message):
     user_id = f"tg_{msg.from_user.id}"
     full_name = msg.from_user.full_name
-    async with ClientSession() as session:
-        await session.post(f"{API_BASE}/api/v1/user/register", params={"tg_id": user_id, "full_name": full_name})
+    await api.post("/api/v1/user/register", params={"tg_id": user_id, "full_name": full_name})
     await msg.answer(
         f"👋 Привет, <b>{full_name}</b>!\n"
         "Добро пожаловать в <b>InvoiceBot</b>.\n"
@@ -135,12 +279,7 @@ async def handle_ttf_or_template(msg: Message):
         file = await bot.download(msg.document.file_id)
         form = FormData()
         form.add_field("ttf_file", file, filename=msg.document.file_name, content_type="font/ttf")
-        async with ClientSession() as session:
-            await session.post(
-                f"{API_BASE}/api/v1/template/upload-font",
-                data=form,
-                params={"tg_id": user_id}
-            )
+        await api.post("/api/v1/template/upload-font", data=form, params={"tg_id": user_id})
         await msg.answer(f"🆗 Файл {msg.document.file_name} загружен!")
         return
 
@@ -154,21 +293,20 @@ async def handle_ttf_or_template(msg: Message):
     with open(path, "wb") as f:
         f.write(file.read())
     form.add_field("file", open(path, "rb"), filename=msg.document.file_name, content_type=msg.document.mime_type)
-    for fname in os.listdir(user_dir):
-        if fname.lower().endswith(".ttf"):
-            form.add_field("ttf_files", open(os.path.join(user_dir, fname), "rb"), filename=fname,
-                           content_type="font/ttf")
+    for font_path in await fonts_to_send(user_id, user_dir):
+        with open(font_path, "rb") as f:
+            form.add_field("ttf_files", f.read(), filename=os.path.basename(font_path), content_type="font/ttf")
     await msg.answer("⏳ Обработка шаблона...", reply_markup=main_menu)
-    async with ClientSession() as session:
-        async with session.post(f"{API_BASE}/upload-template", data=form, params={"tg_id": user_id}) as resp:
-            data = await resp.json()
-    if resp.status != 200:
+    resp = await api.post("/api/v1/template/upload-template", data=form,
+                          params={"tg_id": user_id, "background": "true"})
+    data = resp.json()
+    if resp.status != 202:
         return await msg.answer(f"❌ {data.get('detail')}", reply_markup=main_menu)
-
-    scenario = data.get('scenario')
-    if scenario:
-        text = pretty_scenario_status(scenario)
-        await msg.answer(f"📈 Прогресс:\n{text}", reply_markup=main_menu)
+    progress = await msg.answer("📈 Прогресс: в очереди...")
+    scenario, data = await wait_for_scenario(user_id, data["scenario"], progress)
+    if data is None:
+        return await msg.answer(f"❌ {scenario.get('error_message') or 'Обработка не завершилась'}",
+                                reply_markup=main_menu)
 
     fonts = data.get("fonts", [])
     parsed = data.get("parsed_data", {})
@@ -190,51 +328,42 @@ async def handle_ttf_or_template(msg: Message):
 @dp.callback_query(lambda c: c.data == "confirm_parsed")
 async def confirm_cb(cb: types.CallbackQuery):
     user_id = f"tg_{cb.from_user.id}"
-    async with ClientSession() as session:
-        async with session.post(f"{API_BASE}/api/v1/template/confirm-latest-template", params={"tg_id": user_id}) as resp:
-            res = await resp.json()
-        updated_pdf_name = res.get("updated_pdf_name") or "invoice_updated.pdf"
-        async with session.get(f"{API_BASE}/api/v1/file/get-presigned-url", params={
-            "tg_id": user_id,
-            "filename": updated_pdf_name
-        }) as presigned_resp:
-            presigned = await presigned_resp.json()
-            pdf_presigned_url = presigned["presigned_url"]
-        async with aiohttp.ClientSession() as fsession:
-            async with fsession.get(pdf_presigned_url) as f:
-                pdf_bytes = await f.read()
-        await cb.message.answer_document(
-            BufferedInputFile(pdf_bytes, filename=updated_pdf_name),
-            caption="✅ Ваш обновленный счет"
-        )
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="⬇️ Скачать PDF (5 мин)", url=pdf_presigned_url)]
-        ])
-        await cb.message.answer("⬇️ Ссылка для скачивания PDF (действует 5 минут):", reply_markup=kb)
-
-        links = []
-        if res.get("extracted_fonts_url"):
-            fname = res["extracted_fonts_url"].split("/")[-1]
-            async with session.get(f"{API_BASE}/api/v1/file/get-presigned-url",
-                                   params={"tg_id": user_id, "filename": fname}) as font_url_resp:
-                font_presigned = await font_url_resp.json()
-            links.append(f'🧩 <a href="{font_presigned["presigned_url"]}">Шрифты</a>')
-        if res.get("parsed_json_url"):
-            fname = res["parsed_json_url"].split("/")[-1]
-            async with session.get(f"{API_BASE}/api/v1/file/get-presigned-url",
-                                   params={"tg_id": user_id, "filename": fname}) as json_url_resp:
-                json_presigned = await json_url_resp.json()
-            links.append(f'🧾 <a href="{json_presigned["presigned_url"]}">JSON</a>')
-        if links:
-            await cb.message.answer("\n".join(links), parse_mode="HTML")
+    resp = await api.post("/api/v1/template/confirm-latest-template", params={"tg_id": user_id})
+    res = resp.json()
+    updated_pdf_name = res.get("updated_pdf_name") or "invoice_updated.pdf"
+    presigned = (await api.get("/api/v1/file/get-presigned-url", params={
+        "tg_id": user_id,
+        "filename": updated_pdf_name
+    })).json()
+    pdf_presigned_url = presigned["presigned_url"]
+    await send_rendered_pdf(
+        cb.message, user_id, updated_pdf_name, res.get("updated_pdf_sha256"), "✅ Ваш обновленный счет"
+    )
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="⬇️ Скачать PDF (5 мин)", url=pdf_presigned_url)]
+    ])
+    await cb.message.answer("⬇️ Ссылка для скачивания PDF (действует 5 минут):", reply_markup=kb)
+
+    links = []
+    if res.get("extracted_fonts_url"):
+        fname = res["extracted_fonts_url"].split("/")[-1]
+        font_presigned = (await api.get("/api/v1/file/get-presigned-url",
+                                        params={"tg_id": user_id, "filename": fname})).json()
+        links.append(f'🧩 <a href="{font_presigned["presigned_url"]}">Шрифты</a>')
+    if res.get("parsed_json_url"):
+        fname = res["parsed_json_url"].split("/")[-1]
+        json_presigned = (await api.get("/api/v1/file/get-presigned-url",
+                                        params={"tg_id": user_id, "filename": fname})).json()
+        links.append(f'🧾 <a href="{json_presigned["presigned_url"]}">JSON</a>')
+    if links:
+        await cb.message.answer("\n".join(links), parse_mode="HTML")
 
 
 @dp.callback_query(lambda c: c.data == "edit_parsed")
 async def edit_prompt(cb: types.CallbackQuery):
     user_id = f"tg_{cb.from_user.id}"
-    async with ClientSession() as session:
-        async with session.get(f"{API_BASE}/api/v1/template/latest-template", params={"tg_id": user_id}) as r:
-            parsed = (await r.json()).get('parsed_data', {})
+    r = await api.get("/api/v1/template/latest-template", params={"tg_id": user_id})
+    parsed = r.json().get('parsed_data', {})
     user_friendly = make_user_edit_json(parsed)
     fields = ", ".join(user_friendly.keys()) or "(нет полей)"
     prompt = (
@@ -251,25 +380,26 @@ async def handle_json_edit(msg: Message):
     except json.JSONDecodeError:
         return
     user_id = f"tg_{msg.from_user.id}"
-    async with ClientSession() as session:
-        async with session.get(f"{API_BASE}/api/v1/template/latest-template", params={"tg_id": user_id}) as r:
-            old = (await r.json()).get('parsed_data', {})
-        user_friendly_old = make_user_edit_json(old)
-        merged = {**user_friendly_old, **new_data}
-        async with session.post(
-                f"{API_BASE}api/v1/template/update-latest-template", params={"tg_id": user_id}, json={"parsed_data": merged}
-        ) as r2:
-            if r2.status == 200:
-                kb = InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="✅ Подтвердить", callback_data="confirm_parsed")],
-                    [InlineKeyboardButton(text="✏️ Изменить ещё", callback_data="edit_parsed")]
-                ])
-                await msg.answer(
-                    f"✅ Обновлено:\n<pre>{json.dumps(merged, ensure_ascii=False, indent=2)}</pre>",
-                    reply_markup=kb
-                )
-            else:
-                await msg.answer("❌ Ошибка при обновлении.", reply_markup=main_menu)
+    r = await api.get("/api/v1/template/latest-template", params={"tg_id": user_id})
+    old = r.json().get('parsed_data', {})
+    user_friendly_old = make_user_edit_json(old)
+    merged = {**user_friendly_old, **new_data}
+    r2 = await api.post("/api/v1/template/update-latest-template", params={"tg_id": user_id},
+                        json={"parsed_data": merged})
+    if r2.status == 200 and r2.json().get("superseded"):
+        # Правка склеена с более поздней: итог придет в ответ на последнее сообщение
+        return
+    if r2.status == 200:
+        kb = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="✅ Подтвердить", callback_data="confirm_parsed")],
+            [InlineKeyboardButton(text="✏️ Изменить ещё", callback_data="edit_parsed")]
+        ])
+        await msg.answer(
+            f"✅ Обновлено:\n<pre>{json.dumps(merged, ensure_ascii=False, indent=2)}</pre>",
+            reply_markup=kb
+        )
+    else:
+        await msg.answer("❌ Ошибка при обновлении.", reply_markup=main_menu)
 
 
 @dp.message(lambda m: m.text == "📤 Загрузить свой шаблон")
@@ -283,41 +413,72 @@ async def upload_prompt(event: types.Message | types.CallbackQuery):
     await target.answer(prompt, reply_markup=main_menu)
 
 
+# Страницы каталога по номеру: (ETag, ответ) для условных запросов If-None-Match
+_templates_pages = {}
+
+
+async def fetch_templates_page(page: int) -> dict:
+    cached = _templates_pages.get(page)
+    headers = {"If-None-Match": cached[0]} if cached else {}
+    resp = await api.get("/api/v1/template/templates",
+                         params={"page": page, "page_size": TEMPLATES_PAGE_SIZE}, headers=headers)
+    if resp.status == 304 and cached:
+        return cached[1]
+    data = resp.json()
+    if resp.status == 200 and resp.headers.get("ETag"):
+        _templates_pages[page] = (resp.headers["ETag"], data)
+    return data
+
+
+def templates_keyboard(data: dict) -> InlineKeyboardMarkup:
+    rows = [
+        [InlineKeyboardButton(text=tpl["template_name"], callback_data=f"select:{tpl['template_id']}")]
+        for tpl in data.get("templates", [])
+    ]
+    page, pages = data.get("page", 1), data.get("pages", 1)
+    nav = []
+    if page > 1:
+        nav.append(InlineKeyboardButton(text="◀️", callback_data=f"tpl_page:{page - 1}"))
+    if page < pages:
+        nav.append(InlineKeyboardButton(text="▶️", callback_data=f"tpl_page:{page + 1}"))
+    if nav:
+        rows.append(nav)
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+
 @dp.message(lambda m: m.text == "📄 Выбрать готовый шаблон")
 @dp.callback_query(lambda c: c.data == "choose_template")
 async def choose_prompt(event: types.Message | types.CallbackQuery):
     target = event.message if isinstance(event, types.CallbackQuery) else event
-    user_id = f"tg_{target.from_user.id}"
-    async with ClientSession() as session:
-        async with session.get(f"{API_BASE}/api/v1/template/templates", params={"tg_id": user_id}) as resp:
-            data = await resp.json()
-    templates = data.get("templates", [])
-    if not templates:
+    data = await fetch_templates_page(1)
+    if not data.get("templates"):
         return await target.answer("⚠️ Нет готовых шаблонов.", reply_markup=main_menu)
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text=tpl['template_name'], callback_data=f"select:{i}")]
-        for i, tpl in enumerate(templates)
-    ])
-    await target.answer("📑 Выберите шаблон:", reply_markup=kb)
+    await target.answer("📑 Выберите шаблон:", reply_markup=templates_keyboard(data))
+
+
+@dp.callback_query(lambda c: c.data.startswith("tpl_page:"))
+async def templates_page(cb: types.CallbackQuery):
+    page = int(cb.data.split(":")[1])
+    data = await fetch_templates_page(page)
+    await cb.message.edit_reply_markup(reply_markup=templates_keyboard(data))
+    await cb.answer()
 
 
 @dp.callback_query(lambda c: c.data.startswith("select:"))
 async def handle_select(cb: types.CallbackQuery):
     user_id = f"tg_{cb.from_user.id}"
-    idx = int(cb.data.split(':')[1])
-    async with ClientSession() as session:
-        async with session.get(f"{API_BASE}/api/v1/template/templates", params={"tg_id": user_id}) as resp:
-            data = await resp.json()
-    lst = data.get("templates", [])
-    if idx < 0 or idx >= len(lst):
-        return await cb.message.answer("❌ Неверный выбор.", reply_markup=main_menu)
-    name = lst[idx]['template_name']
-    async with ClientSession() as session:
-        async with session.post(f"{API_BASE}/api/v1/template/select-template",
-                                params={"tg_id": user_id, "template_name": name}) as resp:
-            data = await resp.json()
-    if resp.status != 200:
+    template_id = cb.data.split(":", 1)[1]
+    resp = await api.post("/api/v1/template/select-template",
+                          params={"tg_id": user_id, "template_id": template_id, "background": "true"})
+    data = resp.json()
+    if resp.status != 202:
         return await cb.message.answer(f"❌ {data.get('detail')}", reply_markup=main_menu)
+    progress = await cb.message.answer("📈 Прогресс: в очереди...")
+    scenario, data = await wait_for_scenario(user_id, data["scenario"], progress)
+    if data is None:
+        return await cb.message.answer(f"❌ {scenario.get('error_message') or 'Обработка не завершилась'}",
+                                       reply_markup=main_menu)
+    name = os.path.basename(data.get("local_pdf", ""))
     fonts = data.get("fonts", [])
     parsed = data.get("parsed_data", {})
     user_friendly = make_user_edit_json(parsed)
@@ -335,5 +496,26 @@ async def handle_select(cb: types.CallbackQuery):
     await cb.message.answer(text, reply_markup=kb)
 
 
+async def log_api_metrics():
+    while True:
+        await asyncio.sleep(BOT_METRICS_LOG_SEC)
+        logger.info(f"API client metrics: {json.dumps(api.stats(), ensure_ascii=False)}")
+
+
+@dp.startup()
+async def on_startup():
+    await api.start()
+    if BOT_METRICS_LOG_SEC > 0:
+        dp["metrics_task"] = asyncio.create_task(log_api_metrics())
+
+
+@dp.shutdown()
+async def on_shutdown():
+    task = dp.workflow_data.get("metrics_task")
+    if task:
+        task.cancel()
+    await api.close()
+
+
 if __name__ == "__main__":
     asyncio.run(dp.start_polling(bot))
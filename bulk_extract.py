@@ -0,0 +1,175 @@
+"""
+Офлайн-извлечение полей из архива PDF в JSONL.
+
+    python bulk_extract.py archive/ -o results.jsonl --concurrency 8
+
+Разбор PDF идет в пуле процессов (PDF_POOL_WORKERS), извлечение полей — правила + Gemini
+(EXTRACTION_MODE). Готовые файлы отмечаются в checkpoint-файле: повторный запуск с теми же
+параметрами продолжает с места остановки. Результат строки пишется до отметки в checkpoint,
+поэтому при обрыве между ними файл может попасть в JSONL дважды (последняя запись актуальна).
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from typing import Awaitable, Callable, Iterable, List, Optional, Set
+import logging_conf
+from utils.pdf import analyze_template_file
+from utils.prompt_encoding import prompt_size_counter
+from services.pdf_pool import pdf_pool
+
+logger = logging_conf.logger.getChild("bulk_extract")
+
+PROGRESS_EVERY_SEC = 10.0
+
+
+def find_documents(root: str, extensions=(".pdf",)) -> List[str]:
+    """Пути документов относительно root в стабильном порядке (для воспроизводимого возобновления)."""
+    found = []
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if name.lower().endswith(extensions):
+                found.append(os.path.relpath(os.path.join(dirpath, name), root))
+    return sorted(found)
+
+
+def load_checkpoint(path: str, retry_failed: bool = False) -> Set[str]:
+    """Обработанные файлы из checkpoint (строки «ok\\tпуть» / «error\\tпуть»)."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            status, _, rel_path = line.rstrip("\n").partition("\t")
+            if rel_path and (status == "ok" or not retry_failed):
+                done.add(rel_path)
+    return done
+
+
+class ExtractionStats:
+    def __init__(self, total: int, skipped: int):
+        self.total = total
+        self.skipped = skipped
+        self.ok = 0
+        self.failed = 0
+        self.started = time.perf_counter()
+        self.tokens_at_start = prompt_size_counter.stats()["encoded_tokens"]
+
+    def summary(self) -> dict:
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        processed = self.ok + self.failed
+        tokens = prompt_size_counter.stats()["encoded_tokens"] - self.tokens_at_start
+        return {
+            "total": self.total,
+            "skipped": self.skipped,
+            "processed": processed,
+            "ok": self.ok,
+            "failed": self.failed,
+            "failure_rate": round(self.failed / processed, 4) if processed else 0.0,
+            "elapsed_sec": round(elapsed, 2),
+            "docs_per_sec": round(processed / elapsed, 3),
+            "prompt_tokens": tokens,
+            "tokens_per_sec": round(tokens / elapsed, 1),
+        }
+
+
+async def extract_document(root: str, rel_path: str, extractor: Callable[..., Awaitable[dict]]) -> dict:
+    started = time.perf_counter()
+    analysis = await pdf_pool.run_async(analyze_template_file, os.path.join(root, rel_path))
+    fields = await extractor(analysis["blocks"], analysis["table_regions"])
+    return {
+        "file": rel_path,
+        "sha256": analysis["sha256"],
+        "fonts": analysis["fonts"],
+        "fields": fields,
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+async def run_bulk_extraction(
+    root: str,
+    output: str,
+    checkpoint: str,
+    concurrency: int = 4,
+    files: Optional[Iterable[str]] = None,
+    retry_failed: bool = False,
+    extractor: Optional[Callable[..., Awaitable[dict]]] = None
+) -> dict:
+    """
+    Обрабатывает документы root не более чем по concurrency одновременно, дописывая
+    результаты в output (JSONL) и отметки в checkpoint. Возвращает сводку по пропускной способности.
+    """
+    if extractor is None:
+        from services.gemini_service import extract_fields_with_bbox_gemini_async
+        extractor = extract_fields_with_bbox_gemini_async
+    files = list(files) if files is not None else find_documents(root)
+    done = load_checkpoint(checkpoint, retry_failed)
+    pending = [f for f in files if f not in done]
+    stats = ExtractionStats(len(files), len(files) - len(pending))
+    logger.info(f"Документов: {len(files)}, уже обработано: {stats.skipped}, к обработке: {len(pending)}")
+
+    queue: asyncio.Queue = asyncio.Queue()
+    for rel_path in pending:
+        queue.put_nowait(rel_path)
+    last_report = time.perf_counter()
+
+    with open(output, "a", encoding="utf-8") as out, open(checkpoint, "a", encoding="utf-8") as ckpt:
+        def record(result: dict, status: str):
+            nonlocal last_report
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            out.flush()
+            ckpt.write(f"{status}\t{result['file']}\n")
+            ckpt.flush()
+            if time.perf_counter() - last_report >= PROGRESS_EVERY_SEC:
+                last_report = time.perf_counter()
+                logger.info(f"Прогресс: {json.dumps(stats.summary(), ensure_ascii=False)}")
+
+        async def worker():
+            while True:
+                try:
+                    rel_path = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    result = await extract_document(root, rel_path, extractor)
+                except Exception as e:
+                    stats.failed += 1
+                    logger.warning(f"{rel_path}: {e}")
+                    record({"file": rel_path, "error": str(getattr(e, "detail", e)) or e.__class__.__name__}, "error")
+                else:
+                    stats.ok += 1
+                    record(result, "ok")
+
+        await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+
+    summary = stats.summary()
+    logger.info(f"Готово: {json.dumps(summary, ensure_ascii=False)}")
+    return summary
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Bulk field extraction from a directory of invoice PDFs")
+    parser.add_argument("input_dir", help="Папка с PDF (обходится рекурсивно)")
+    parser.add_argument("-o", "--output", default="extracted.jsonl", help="JSONL с результатами (дописывается)")
+    parser.add_argument("--checkpoint", help="Файл отметок обработанных документов (по умолчанию <output>.checkpoint)")
+    parser.add_argument("-c", "--concurrency", type=int, default=4, help="Документов в обработке одновременно")
+    parser.add_argument("--retry-failed", action="store_true", help="Повторить документы, завершившиеся ошибкой")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.input_dir):
+        parser.error(f"{args.input_dir} is not a directory")
+    checkpoint = args.checkpoint or f"{args.output}.checkpoint"
+    try:
+        summary = asyncio.run(run_bulk_extraction(
+            args.input_dir, args.output, checkpoint, args.concurrency, retry_failed=args.retry_failed
+        ))
+    finally:
+        pdf_pool.shutdown()
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
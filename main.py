@@ -4,6 +4,11 @@ from routers.user_router import router as user_router
 from routers.template_router import router as template_router
 from routers.file_router import router as file_router
 from routers.health_router import router as health_router
+import threading
+from services.pdf_pool import pdf_pool
+from services.shared_templates import shared_templates, SHARED_ARTIFACTS_PREBUILD
+from services.blob_store import blob_store, BLOB_GC_INTERVAL_SEC
+from models.db import init_db
 from fastapi import FastAPI
 
 
@@ -16,3 +21,25 @@ app.include_router(user_router)
 app.include_router(template_router)
 app.include_router(file_router)
 app.include_router(health_router)
+
+
+@app.on_event("startup")
+def migrate_db():
+    init_db()
+
+
+@app.on_event("startup")
+def prebuild_shared_templates():
+    if SHARED_ARTIFACTS_PREBUILD:
+        threading.Thread(target=shared_templates.prebuild_all, name="shared-templates", daemon=True).start()
+
+
+@app.on_event("startup")
+def start_blob_gc():
+    if BLOB_GC_INTERVAL_SEC > 0:
+        threading.Thread(target=blob_store.run_gc_forever, name="blob-gc", daemon=True).start()
+
+
+@app.on_event("shutdown")
+def shutdown_pools():
+    pdf_pool.shutdown()
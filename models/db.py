@@ -1,6 +1,9 @@
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, DateTime, JSON
+from sqlalchemy import create_engine, inspect, text, Column, Integer, String, ForeignKey, DateTime, JSON, UniqueConstraint
 from sqlalchemy.orm import declarative_base, sessionmaker, relationship, Session
 from datetime import datetime
+import logging_conf
+
+logger = logging_conf.logger.getChild("db")
 
 DATABASE_URL = "sqlite:///./tests.db"
 engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
@@ -28,9 +31,58 @@ class Template(Base):
     updated_at = Column(DateTime, default=datetime.utcnow)
     invoice_name = Column(String)
     font_map = Column(JSON, nullable=True)
+    layout = Column(JSON, nullable=True)
+    file_hash = Column(String, nullable=True)
     user = relationship("User", back_populates="templates")
 
 
+class Blob(Base):
+    """Содержимое файла в хранилище блобов (один раз на SHA-256)."""
+    __tablename__ = "blobs"
+    sha256 = Column(String(64), primary_key=True)
+    ext = Column(String)
+    size = Column(Integer, nullable=True)
+    content_type = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    # Последнее повторное использование содержимого: GC не трогает блоб grace-период после него
+    used_at = Column(DateTime, nullable=True)
+
+
+class BlobRef(Base):
+    """Файл пользователя: имя и вид (template | font | output) -> блоб."""
+    __tablename__ = "blob_refs"
+    __table_args__ = (UniqueConstraint("user_id", "kind", "name"),)
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"))
+    sha256 = Column(String(64), ForeignKey("blobs.sha256"))
+    kind = Column(String)
+    name = Column(String)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+
+# Колонки, добавленные после первых развертываний: create_all не меняет существующие таблицы
+ADDED_COLUMNS = {
+    "templates": {"layout": "JSON", "file_hash": "VARCHAR"},
+    "blobs": {"used_at": "DATETIME"},
+}
+
+
+def init_db(bind=engine):
+    """
+    Создает недостающие таблицы (blobs, blob_refs, ...) и добавляет в существующие новые колонки
+    через ALTER TABLE, чтобы старая БД работала без ручной миграции. Повторный вызов ничего не меняет.
+    """
+    Base.metadata.create_all(bind)
+    inspector = inspect(bind)
+    with bind.begin() as conn:
+        for table, columns in ADDED_COLUMNS.items():
+            existing = {c["name"] for c in inspector.get_columns(table)}
+            for name, ddl in columns.items():
+                if name not in existing:
+                    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+                    logger.info(f"Миграция БД: добавлена колонка {table}.{name}")
+
+
 def get_db():
     db = SessionLocal()
     try:
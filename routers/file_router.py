@@ -1,8 +1,13 @@
 import logging
 
-from fastapi import APIRouter, Query
+from fastapi import APIRouter, Depends, Query
+from fastapi.responses import FileResponse, StreamingResponse
+from sqlalchemy.orm import Session
+from models.db import get_db
 from schemas.template import PresignedUrlResponse
-from services.minio_service import get_presigned_url as minio_get_presigned_url
+from services.minio_service import get_presigned_url as minio_get_presigned_url, open_object_stream
+from services.template_service import rendered_pdf_path
+from services.blob_store import blob_store
 
 
 logger = logging.getLogger("file_router")
@@ -18,7 +23,25 @@ router = APIRouter(prefix="/api/v1/file", tags=["File"])
 def get_presigned_url_endpoint(
     tg_id: str = Query(..., description="Telegram ID юзера"),
     filename: str = Query(..., description="Имя файла"),
-    expires: int = Query(300, description="Время жизни ссылки (сек)")
+    expires: int = Query(300, description="Время жизни ссылки (сек)"),
+    db: Session = Depends(get_db)
 ):
-    url = minio_get_presigned_url(tg_id, filename, expires)
+    url = minio_get_presigned_url(tg_id, filename, expires, object_name=blob_store.object_for(db, tg_id, filename))
     return {"presigned_url": url, "expires": expires}
+
+
+@router.get("/rendered", response_class=StreamingResponse)
+def get_rendered_pdf(
+    tg_id: str = Query(..., description="Telegram ID юзера"),
+    filename: str = Query(..., description="Имя готового PDF, например invoice_updated_3f2a9c1d0b7e.pdf"),
+    db: Session = Depends(get_db)
+):
+    """Готовый PDF потоком: с локального диска, иначе напрямую из MinIO (без presigned-ссылки)"""
+    path = rendered_pdf_path(tg_id, filename)
+    if path is not None:
+        return FileResponse(path, media_type="application/pdf", filename=filename)
+    chunks, size = open_object_stream(blob_store.object_for(db, tg_id, filename))
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+    if size is not None:
+        headers["Content-Length"] = str(size)
+    return StreamingResponse(chunks, media_type="application/pdf", headers=headers)
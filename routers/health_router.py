@@ -1,6 +1,18 @@
 import logging
 
 from fastapi import APIRouter
+from services.gemini_service import extraction_cache
+from services.gemini_client import gemini_client
+from services.document_pool import document_pool
+from services.minio_service import upload_stats
+from services.job_queue import job_queue
+from services.pdf_pool import pdf_pool
+from services.shared_templates import shared_templates
+from services.template_catalog import template_catalog
+from services.blob_store import blob_store
+from services.render_flight import render_flight
+from services.edit_coalescer import edit_coalescer
+from utils.prompt_encoding import prompt_size_counter
 
 logger = logging.getLogger("health_router")
 logging.basicConfig(
@@ -14,3 +26,21 @@ router = APIRouter(prefix="/api/v1", tags=["Health"])
 @router.get("/health", summary="Health check", description="Check service health")
 def health_check():
     return {"status": "ok"}
+
+
+@router.get("/metrics", summary="Service metrics", description="Cache and pool counters")
+def metrics():
+    return {
+        "gemini_cache": extraction_cache.stats(),
+        "gemini_client": gemini_client.stats(),
+        "prompt_size": prompt_size_counter.stats(),
+        "document_pool": document_pool.stats(),
+        "minio_uploads": upload_stats(),
+        "template_jobs": job_queue.stats(),
+        "pdf_pool": pdf_pool.stats(),
+        "shared_templates": shared_templates.stats(),
+        "template_catalog": template_catalog.stats(),
+        "blob_store": blob_store.stats(),
+        "render_flight": render_flight.stats(),
+        "edit_coalescer": edit_coalescer.stats(),
+    }
@@ -1,14 +1,18 @@
 import logging
 
 from fastapi import APIRouter, Depends, UploadFile, File, HTTPException, Request, Query
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 from schemas.template import (
     TemplateUploadResponse, TemplateUpdateRequest, ConfirmTemplateResponse,
-    LatestTemplateResponse, UpdateTemplateResponse, FontUploadResponse
+    LatestTemplateResponse, UpdateTemplateResponse, FontUploadResponse, ScenarioStatusResponse,
+    MissingFontsRequest, MissingFontsResponse
 )
 from services.template_service import (
     upload_template_service, confirm_latest_template_service,
-    latest_template_service, update_latest_template_service, upload_font_service
+    latest_template_service, update_latest_template_service, upload_font_service, missing_fonts_service
 )
 from models.db import get_db
 
@@ -22,16 +26,25 @@ logging.basicConfig(
 router = APIRouter(prefix="/api/v1/template", tags=["Template"])
 
 
+def scenario_accepted(job) -> JSONResponse:
+    body = ScenarioStatusResponse(scenario=job.scenario())
+    return JSONResponse(status_code=202, content=jsonable_encoder(body))
+
+
 @router.post("/upload-template", response_model=TemplateUploadResponse)
-def upload_template(
+async def upload_template(
     tg_id: str = Query(...),
     file: UploadFile = File(...),
     ttf_files: list[UploadFile] = File(None),
+    background: bool = Query(False, description="Обработать в фоне и сразу вернуть сценарий (202)"),
     db: Session = Depends(get_db)
 ):
     logger.info(f"User {tg_id} started upload_template. File: {file.filename}, TTFs: {[ttf.filename for ttf in ttf_files or []]}")
     try:
-        resp = upload_template_service(tg_id, file, ttf_files, db)
+        resp = await upload_template_service(tg_id, file, ttf_files, db, background=background)
+        if background:
+            logger.info(f"User {tg_id} template queued: {resp.scenario_id}")
+            return scenario_accepted(resp)
         logger.info(f"User {tg_id} uploaded template successfully.")
         return resp
     except Exception as e:
@@ -72,7 +85,8 @@ async def update_latest_template(
     logger.info(f"User {tg_id} started update_latest_template.")
     payload = await request.json()
     try:
-        resp = update_latest_template_service(tg_id, payload, db)
+        # В пуле потоков: запрос может ждать окно склейки правок, не блокируя event loop
+        resp = await run_in_threadpool(update_latest_template_service, tg_id, payload, db)
         logger.info(f"User {tg_id} updated template successfully.")
         return resp
     except Exception as e:
@@ -83,32 +97,116 @@ async def update_latest_template(
 @router.post("/upload-font", response_model=FontUploadResponse)
 def upload_font(
     tg_id: str = Query(...),
-    ttf_file: UploadFile = File(...)
+    ttf_file: UploadFile = File(...),
+    db: Session = Depends(get_db)
 ):
     logger.info(f"User {tg_id} uploading font: {ttf_file.filename}")
     try:
-        resp = upload_font_service(tg_id, ttf_file)
+        resp = upload_font_service(tg_id, ttf_file, db)
         logger.info(f"User {tg_id} uploaded font {ttf_file.filename} successfully.")
         return resp
     except Exception as e:
         logger.exception(f"User {tg_id} failed to upload font: {e}")
         raise
 
-from services.template_service import get_templates_service, select_template_service
+
+@router.post("/fonts/missing", response_model=MissingFontsResponse)
+def missing_fonts(body: MissingFontsRequest, tg_id: str = Query(...), db: Session = Depends(get_db)):
+    """Какие шрифты (по SHA-256) нужно прислать; уже известные сразу доступны пользователю"""
+    return missing_fonts_service(tg_id, [font.model_dump() for font in body.fonts], db)
+
+
+from services.template_service import get_templates_service, select_template_service, get_scenario_service
+from services.bulk_service import prepare_bulk_job, parse_rows_csv, BULK_FORMATS
+from services.template_catalog import template_catalog, TEMPLATE_PAGE_SIZE, TEMPLATE_PAGE_SIZE_MAX
 
 
 @router.get("/templates", tags=["Template"])
-def get_templates(db: Session = Depends(get_db)):
-    """Список готовых шаблонов"""
-    return get_templates_service(db)
+def get_templates(
+    request: Request,
+    page: int = Query(1, ge=1),
+    page_size: int = Query(TEMPLATE_PAGE_SIZE, ge=1, le=TEMPLATE_PAGE_SIZE_MAX)
+):
+    """Список готовых шаблонов постранично; при совпадении If-None-Match — 304 без тела"""
+    catalog = get_templates_service(page, page_size)
+    etag = f'W/"{catalog["version"]}-{page}-{page_size}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(content=catalog, headers=headers)
+
+
+@router.post("/templates/refresh", tags=["Template"])
+def refresh_templates():
+    """Сбросить кэш каталога (после добавления или удаления шаблонов в MinIO)"""
+    template_catalog.invalidate()
+    return {"version": template_catalog.version(), "total": template_catalog.stats()["templates"]}
 
 
 @router.post("/select-template", tags=["Template"])
-def select_template(
+async def select_template(
     tg_id: str = Query(...),
-    template_name: str = Query(...),
+    template_id: str = Query(None, description="ID шаблона из /templates"),
+    template_name: str = Query(None, description="Имя файла в templates/ (устаревший вариант)"),
+    background: bool = Query(False, description="Обработать в фоне и сразу вернуть сценарий (202)"),
     db: Session = Depends(get_db)
 ):
     """Выбрать готовый шаблон и загрузить себе"""
-    return select_template_service(tg_id, template_name, db)
+    resp = await select_template_service(tg_id, template_name, db, background=background, template_id=template_id)
+    if background:
+        return scenario_accepted(resp)
+    return resp
 
+
+@router.get("/scenario/{scenario_id}", response_model=ScenarioStatusResponse, tags=["Template"])
+def get_scenario(scenario_id: str, tg_id: str = Query(...)):
+    """Прогресс сценария обработки шаблона: шаги, время, длительность и итог"""
+    return get_scenario_service(tg_id, scenario_id)
+
+
+
+@router.post("/bulk-generate", tags=["Template"])
+async def bulk_generate(
+    request: Request,
+    tg_id: str = Query(...),
+    template_id: int = Query(None, description="ID шаблона; по умолчанию последний"),
+    output: str = Query("zip", description="zip — архив с PDF и report.json, pdf — один склеенный PDF"),
+    db: Session = Depends(get_db)
+):
+    """
+    Пакетная генерация счетов по одному шаблону. Тело — JSON {"rows": [{поле: значение}, ...]}
+    (или список строк) либо CSV (text/csv) с названиями полей в заголовке.
+    """
+    if output not in BULK_FORMATS:
+        raise HTTPException(400, f"output must be one of {BULK_FORMATS}")
+    content_type = request.headers.get("content-type", "")
+    try:
+        if "csv" in content_type:
+            rows = parse_rows_csv((await request.body()).decode("utf-8-sig"))
+        else:
+            payload = await request.json()
+            rows = payload.get("rows") if isinstance(payload, dict) else payload
+    except (ValueError, UnicodeDecodeError) as e:
+        raise HTTPException(400, f"Invalid rows payload: {e}")
+    if not isinstance(rows, list):
+        raise HTTPException(400, "Invalid payload: expected a list of rows")
+    logger.info(f"User {tg_id} started bulk generation: {len(rows)} rows, output={output}")
+    job = await prepare_bulk_job(tg_id, template_id, rows, db)
+    if output == "pdf":
+        merged = await job.merged_pdf()
+        summary = job.summary()
+        failed = [str(e["row"]) for e in summary["results"] if "error" in e]
+        return Response(
+            content=merged,
+            media_type="application/pdf",
+            headers={
+                "Content-Disposition": f'attachment; filename="{job.invoice_name}_bulk.pdf"',
+                "X-Bulk-Rendered": str(summary["rendered"]),
+                "X-Bulk-Failed-Rows": ",".join(failed),
+            }
+        )
+    return StreamingResponse(
+        job.stream_zip(),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{job.invoice_name}_bulk.zip"'}
+    )
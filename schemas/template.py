@@ -20,6 +20,11 @@ class TemplateScenario(BaseModel):
     log: List[Dict[str, Any]] = Field(default_factory=list, description="Лог событий обработки (step, message, time и пр.)")
 
 
+class ScenarioStatusResponse(BaseModel):
+    scenario: TemplateScenario
+    result: Optional[Dict[str, Any]] = Field(None, description="Итог обработки (как в синхронном ответе), когда сценарий завершен")
+
+
 class RegisterUserRequest(BaseModel):
     tg_id: constr(pattern=r"^\d{3,32}$") = Field(..., example="123456789", description="Telegram ID (только цифры, 3-32 символа)")
     full_name: constr(min_length=2, max_length=64) = Field(..., example="John Doe", description="Full name")
@@ -46,6 +51,7 @@ class ConfirmTemplateResponse(BaseModel):
     pdf_url: HttpUrl
     updated_pdf_url: HttpUrl
     updated_pdf_name: constr(min_length=1, max_length=128)
+    updated_pdf_sha256: Optional[str] = Field(None, description="SHA-256 обновленного PDF (ключ кэша file_id в боте)")
     extracted_fonts_url: HttpUrl
     parsed_json_url: HttpUrl
     scenario: Optional[TemplateScenario] = Field(None, description="Сценарий и статус обработки")
@@ -60,10 +66,14 @@ class LatestTemplateResponse(BaseModel):
 class UpdateTemplateResponse(BaseModel):
     message: constr(min_length=3, max_length=256)
     updated_pdf_url: HttpUrl
+    updated_pdf_name: Optional[str] = None
+    updated_pdf_sha256: Optional[str] = None
     parsed_json_url: HttpUrl
     extracted_fonts_url: HttpUrl
     fields_changed: Dict[str, str]
     fields_found: Dict[str, str]
+    coalesced_edits: int = Field(1, description="Сколько запросов на правку склеено в этот рендер")
+    superseded: bool = Field(False, description="Правки запроса вошли в более поздний запрос, итог придет в его ответе")
     scenario: Optional[TemplateScenario] = Field(None, description="Сценарий и статус обработки")
 
 
@@ -72,6 +82,20 @@ class FontUploadResponse(BaseModel):
     font_name: constr(min_length=1, max_length=64)
 
 
+class FontHash(BaseModel):
+    name: constr(min_length=1, max_length=128)
+    sha256: constr(min_length=64, max_length=64)
+
+
+class MissingFontsRequest(BaseModel):
+    fonts: List[FontHash]
+
+
+class MissingFontsResponse(BaseModel):
+    missing: List[str] = Field(..., description="SHA-256 шрифтов, содержимое которых нужно прислать")
+    linked: List[str] = Field(..., description="SHA-256 шрифтов, уже связанных с пользователем")
+
+
 class PresignedUrlResponse(BaseModel):
     presigned_url: HttpUrl
     expires: conint(ge=10, le=86400) = Field(..., example=300)
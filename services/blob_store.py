@@ -0,0 +1,586 @@
+import os
+import re
+import time
+import hashlib
+import tempfile
+import mimetypes
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+from fastapi import HTTPException
+from minio.error import S3Error
+from sqlalchemy import exists, func
+from sqlalchemy.orm import Session
+from models.db import User, Blob, BlobRef, SessionLocal
+from utils.ingest import write_bytes_atomic
+from services.minio_service import minio_client, minio_upload_batch, MINIO_BUCKET
+import logging_conf
+
+logger = logging_conf.logger.getChild("blob_store")
+
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "uploads")
+BLOB_STORE_DIR = os.getenv("BLOB_STORE_DIR", os.path.join(UPLOAD_DIR, ".blobs"))
+BLOB_GC_GRACE_SEC = int(os.getenv("BLOB_GC_GRACE_SEC", "3600"))
+BLOB_GC_INTERVAL_SEC = int(os.getenv("BLOB_GC_INTERVAL_SEC", "3600"))
+BLOB_CACHE_MAX_MB = int(os.getenv("BLOB_CACHE_MAX_MB", "2048"))
+BLOB_CACHE_MIN_AGE_SEC = int(os.getenv("BLOB_CACHE_MIN_AGE_SEC", "300"))
+# Вытеснение освобождает кэш с запасом (до этой доли лимита), чтобы не запускаться на каждой записи
+BLOB_CACHE_EVICT_RATIO = float(os.getenv("BLOB_CACHE_EVICT_RATIO", "0.9"))
+BLOB_PREFIX = "blobs/"
+
+FONT_EXTENSIONS = (".ttf", ".otf")
+_MISSING_CODES = ("NoSuchKey", "NoSuchObject", "ResourceNotFound")
+# Блокировки по sha256 (полосами): put одного содержимого и его удаление в gc() не пересекаются
+_STRIPES = 64
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+def is_sha256(value: str) -> bool:
+    return bool(value) and bool(_SHA256_RE.match(value))
+
+
+def _ext(filename: str) -> str:
+    return os.path.splitext(filename)[1].lower()
+
+
+class BlobStore:
+    """
+    Контентно-адресуемое хранилище файлов (шаблоны, шрифты, готовые PDF): содержимое лежит
+    один раз под своим SHA-256 — локально (<dir>/<sha[:2]>/<sha><ext>) и в MinIO (blobs/<sha><ext>).
+    Пользователь видит файл под своим именем: жесткая ссылка в его папке и строка BlobRef в БД.
+    Блобы без ссылок, не использованные последние BLOB_GC_GRACE_SEC, удаляет gc().
+
+    Источник истины — MinIO (новые блобы записываются туда сразу), локальная папка — LRU-кэш
+    размером до max_bytes: при переполнении фоновый поток удаляет давно не использованные блобы
+    вместе с их ссылками в папках пользователей (links_root), при промахе файл скачивается
+    обратно (ensure/rehydrate).
+    Поэтому запрос можно обслужить на любом экземпляре API.
+    """
+
+    def __init__(self, root: str = BLOB_STORE_DIR, max_bytes: int = BLOB_CACHE_MAX_MB * 1024 * 1024,
+                 min_age_sec: int = BLOB_CACHE_MIN_AGE_SEC, links_root: str = UPLOAD_DIR,
+                 evict_ratio: float = BLOB_CACHE_EVICT_RATIO):
+        self.root = root
+        # Папки пользователей (<links_root>/<tg_id>) с жесткими ссылками на блобы
+        self.links_root = links_root
+        self.max_bytes = max_bytes
+        self.min_age_sec = min_age_sec
+        self.evict_ratio = evict_ratio
+        self._lock = threading.Lock()
+        self._stripes = [threading.Lock() for _ in range(_STRIPES)]
+        self._evictor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="blob-evict")
+        self._eviction: Optional[Future] = None
+        self._index: Optional["OrderedDict[str, Tuple[str, int, float]]"] = None
+        self._bytes = 0
+        # sha256 -> время, когда содержимое последний раз переиспользовали в этом процессе
+        # (ссылка в БД появится позже, до коммита gc() не должен удалить блоб)
+        self._reused: Dict[str, float] = {}
+        self._counters = {
+            "stored": 0, "deduplicated": 0, "linked": 0,
+            "bytes_stored": 0, "bytes_deduplicated": 0, "gc_deleted": 0, "gc_bytes": 0,
+            "cache_hits": 0, "cache_misses": 0, "rehydrated": 0, "bytes_rehydrated": 0,
+            "evicted": 0, "bytes_evicted": 0, "reuploaded": 0,
+        }
+
+    def path_for(self, sha256: str, ext: str) -> str:
+        return os.path.join(self.root, sha256[:2], f"{sha256}{ext.lower()}")
+
+    @staticmethod
+    def object_name(sha256: str, ext: str) -> str:
+        return f"{BLOB_PREFIX}{sha256}{ext.lower()}"
+
+    def _load_index(self):
+        """LRU-индекс локальных блобов; при старте порядок — по mtime (touch обновляет его при чтении)."""
+        files = []
+        for dirpath, _, names in os.walk(self.root):
+            for name in names:
+                if is_sha256(name[:64]):
+                    path = os.path.join(dirpath, name)
+                    st = os.stat(path)
+                    files.append((st.st_mtime, name[:64], path, st.st_size))
+        self._index = OrderedDict()
+        self._bytes = 0
+        for mtime, sha256, path, size in sorted(files):
+            self._index[sha256] = (path, size, mtime)
+            self._bytes += size
+
+    def _track(self, sha256: str, path: str, size: int):
+        with self._lock:
+            if self._index is None:
+                self._load_index()
+            if sha256 in self._index:
+                self._bytes -= self._index[sha256][1]
+            self._index[sha256] = (path, size, time.time())
+            self._index.move_to_end(sha256)
+            self._bytes += size
+            if self._bytes > self.max_bytes and (self._eviction is None or self._eviction.done()):
+                self._eviction = self._evictor.submit(self._evict_safely)
+
+    def _untrack(self, sha256: str):
+        with self._lock:
+            entry = self._index.pop(sha256, None) if self._index is not None else None
+            if entry is not None:
+                self._bytes -= entry[1]
+
+    def find(self, sha256: str) -> Optional[str]:
+        """Локальный путь блоба (обращение продлевает его жизнь в кэше) или None."""
+        if not is_sha256(sha256):
+            return None
+        with self._lock:
+            if self._index is None:
+                self._load_index()
+            entry = self._index.get(sha256)
+        if entry is not None and os.path.exists(entry[0]):
+            self._touch(sha256, entry)
+            return entry[0]
+        # Блоб мог записать или вытеснить другой процесс
+        self._untrack(sha256)
+        bucket = os.path.join(self.root, sha256[:2])
+        try:
+            names = os.listdir(bucket)
+        except FileNotFoundError:
+            return None
+        for name in names:
+            if name.startswith(sha256):
+                path = os.path.join(bucket, name)
+                self._track(sha256, path, os.path.getsize(path))
+                return path
+        return None
+
+    def _touch(self, sha256: str, entry: Tuple[str, int, float]):
+        now = time.time()
+        with self._lock:
+            if sha256 in self._index:
+                self._index[sha256] = (entry[0], entry[1], now)
+                self._index.move_to_end(sha256)
+        if now - entry[2] > 60:
+            try:
+                os.utime(entry[0])
+            except OSError:
+                pass
+
+    def _evict_safely(self):
+        try:
+            self.evict()
+        except Exception as e:
+            logger.error(f"Ошибка вытеснения блобов: {e}", exc_info=True)
+
+    def wait_evicted(self, timeout: Optional[float] = None):
+        """Дожидается запущенного вытеснения (тесты, остановка)."""
+        eviction = self._eviction
+        if eviction is not None:
+            eviction.result(timeout)
+
+    def evict(self):
+        """
+        Удаляет самые давние блобы (и их ссылки у пользователей), пока кэш не уложится
+        в evict_ratio от лимита. Обходит папки пользователей, поэтому запускается в фоне из _track.
+        """
+        victims = []
+        with self._lock:
+            target = self.max_bytes * self.evict_ratio
+            cutoff = time.time() - self.min_age_sec
+            for sha256, (path, size, used_at) in self._index.items():
+                if self._bytes <= target:
+                    break
+                if used_at > cutoff:
+                    continue
+                victims.append((sha256, path, size))
+                self._bytes -= size
+            for sha256, _, _ in victims:
+                del self._index[sha256]
+        if not victims:
+            return
+        inodes = set()
+        for sha256, path, size in victims:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            inodes.add((st.st_dev, st.st_ino))
+        root = os.path.abspath(self.root)
+        for dirpath, dirnames, names in os.walk(self.links_root):
+            if os.path.abspath(dirpath) == root:
+                dirnames[:] = []
+                continue
+            for name in names:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if (st.st_dev, st.st_ino) in inodes:
+                    os.unlink(path)
+        evicted, freed = 0, 0
+        for sha256, path, size in victims:
+            with self._lock:
+                # Блоб снова понадобился (find) во время обхода — оставляем его в кэше
+                if sha256 in self._index:
+                    continue
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            evicted += 1
+            freed += size
+        with self._lock:
+            self._counters["evicted"] += evicted
+            self._counters["bytes_evicted"] += freed
+        logger.info(f"Кэш блобов: вытеснено {evicted} ({freed} байт)")
+
+    def _count(self, stored: bool, size: int):
+        with self._lock:
+            self._counters["stored" if stored else "deduplicated"] += 1
+            self._counters["bytes_stored" if stored else "bytes_deduplicated"] += size
+
+    def _mark_reused(self, sha256: str):
+        with self._lock:
+            self._reused[sha256] = time.time()
+
+    def _stripe(self, sha256: str) -> threading.Lock:
+        return self._stripes[int(sha256[:2], 16) % _STRIPES]
+
+    def _reuse(self, sha256: str) -> Optional[str]:
+        """
+        Локальный блоб для повторного использования (вызывается под _stripe). Локальная копия
+        не доказывает, что блоб жив: gc() другого экземпляра мог удалить его из MinIO —
+        тогда объект заливается заново из локального файла.
+        """
+        path = self.find(sha256)
+        if path is None:
+            return None
+        object_name = self.object_name(sha256, _ext(path))
+        try:
+            minio_client.stat_object(MINIO_BUCKET, object_name)
+        except S3Error as e:
+            if e.code not in _MISSING_CODES:
+                logger.error(f"Ошибка проверки {object_name} в MinIO: {e}")
+                raise HTTPException(500, f"MinIO error: {e}")
+            content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+            minio_upload_batch([(path, object_name, content_type)], skip_unchanged=False)
+            with self._lock:
+                self._counters["reuploaded"] += 1
+            logger.warning(f"Блоб {sha256[:12]} отсутствовал в MinIO и залит заново из локального кэша")
+        self._mark_reused(sha256)
+        return path
+
+    def _drop_local(self, sha256: str):
+        """Удаляет локальную копию блоба и убирает ее из индекса кэша."""
+        with self._lock:
+            entry = self._index.pop(sha256, None) if self._index is not None else None
+            if entry is not None:
+                self._bytes -= entry[1]
+            bucket = os.path.join(self.root, sha256[:2])
+            try:
+                names = os.listdir(bucket)
+            except FileNotFoundError:
+                names = []
+            for name in names:
+                if name.startswith(sha256):
+                    os.unlink(os.path.join(bucket, name))
+
+    def put(self, data: bytes, filename: str, sha256: Optional[str] = None) -> str:
+        """
+        Путь блоба; если такое содержимое уже есть локально, запись пропускается
+        (но наличие объекта в MinIO проверяется, см. _reuse).
+        Новый блоб сразу уходит в MinIO (уже лежащий там не перезаливается).
+        """
+        sha256 = sha256 or hashlib.sha256(data).hexdigest()
+        with self._stripe(sha256):
+            path = self._reuse(sha256)
+            if path is not None:
+                self._count(False, len(data))
+                return path
+            ext = _ext(filename)
+            content_type = mimetypes.guess_type(f"x{ext}")[0] or "application/octet-stream"
+            minio_upload_batch([(data, self.object_name(sha256, ext), content_type)])
+            path = self.path_for(sha256, ext)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_bytes_atomic(path, data)
+            self._track(sha256, path, len(data))
+        self._count(True, len(data))
+        logger.info(f"Блоб {sha256[:12]} ({filename}, {len(data)} байт) сохранен")
+        return path
+
+    @staticmethod
+    def _download(object_name: str) -> bytes:
+        try:
+            response = minio_client.get_object(MINIO_BUCKET, object_name)
+            try:
+                return response.read()
+            finally:
+                response.close()
+                response.release_conn()
+        except S3Error as e:
+            logger.error(f"Объект {object_name} не найден в MinIO: {e}")
+            raise HTTPException(404, "File not found")
+
+    def ensure(self, sha256: str, ext: str) -> str:
+        """Локальный путь блоба; при промахе кэша блоб скачивается из MinIO (с проверкой хэша)."""
+        path = self.find(sha256)
+        if path is not None:
+            with self._lock:
+                self._counters["cache_hits"] += 1
+            return path
+        data = self._download(self.object_name(sha256, ext))
+        if hashlib.sha256(data).hexdigest() != sha256:
+            raise HTTPException(500, f"Blob {sha256[:12]} is corrupted in MinIO")
+        path = self.path_for(sha256, ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_bytes_atomic(path, data)
+        self._track(sha256, path, len(data))
+        with self._lock:
+            self._counters["cache_misses"] += 1
+            self._counters["rehydrated"] += 1
+            self._counters["bytes_rehydrated"] += len(data)
+        logger.info(f"Блоб {sha256[:12]} восстановлен из MinIO ({len(data)} байт)")
+        return path
+
+    def materialize(self, sha256: str, ext: str, user_dir: str, filename: str) -> str:
+        """Файл пользователя на диске: если его нет (вытеснен, другой экземпляр API), ссылка создается заново."""
+        target = os.path.join(user_dir, os.path.basename(filename))
+        path = self.ensure(sha256, ext)
+        if os.path.exists(target) and os.path.samefile(target, path):
+            return target
+        os.makedirs(user_dir, exist_ok=True)
+        return self.link(path, user_dir, filename)
+
+    def rehydrate(self, db: Session, user_id: int, user_dir: str, names: Iterable[str]) -> int:
+        """
+        Файлы пользователя по его ссылкам: отсутствующие локально восстанавливаются, у остальных
+        продлевается жизнь в кэше. Возвращает число восстановленных.
+        """
+        restored = 0
+        for name in names:
+            existed = os.path.exists(os.path.join(user_dir, name))
+            blob = (
+                db.query(Blob).join(BlobRef, BlobRef.sha256 == Blob.sha256)
+                .filter(BlobRef.user_id == user_id, BlobRef.name == name)
+                .order_by(BlobRef.updated_at.desc()).first()
+            )
+            if blob is None:
+                if not existed:
+                    logger.warning(f"Файл {name} пользователя {user_id} отсутствует локально и не найден в блобах")
+                continue
+            self.materialize(blob.sha256, blob.ext or "", user_dir, name)
+            restored += not existed
+        return restored
+
+    def ref_names(self, db: Session, user_id: int, kind: str) -> List[str]:
+        return [name for (name,) in db.query(BlobRef.name).filter_by(user_id=user_id, kind=kind)]
+
+    def put_file(self, src_path: str, filename: str, sha256: Optional[str] = None) -> str:
+        """То же для файла на диске: при известном sha256 файл даже не читается."""
+        if sha256:
+            with self._stripe(sha256):
+                path = self._reuse(sha256)
+            if path is not None:
+                self._count(False, os.path.getsize(src_path))
+                return path
+        with open(src_path, "rb") as f:
+            return self.put(f.read(), filename, sha256)
+
+    def link(self, blob_path: str, user_dir: str, filename: str) -> str:
+        """Жесткая ссылка на блоб в папке пользователя (копия, если ссылку сделать нельзя)."""
+        target = os.path.join(user_dir, os.path.basename(filename))
+        if os.path.exists(target) and os.path.samefile(target, blob_path):
+            return target
+        fd, tmp_path = tempfile.mkstemp(dir=user_dir, prefix=".tmp_")
+        os.close(fd)
+        os.unlink(tmp_path)
+        try:
+            os.link(blob_path, tmp_path)
+        except OSError:
+            with open(blob_path, "rb") as f:
+                write_bytes_atomic(tmp_path, f.read())
+        os.replace(tmp_path, target)
+        with self._lock:
+            self._counters["linked"] += 1
+        return target
+
+    def add_ref(self, db: Session, user_id: int, sha256: str, kind: str, name: str,
+                size: Optional[int] = None, content_type: Optional[str] = None) -> BlobRef:
+        """Ссылка пользователя на блоб под именем name (повторная запись того же имени переназначает ее)."""
+        blob = db.get(Blob, sha256)
+        if blob is None:
+            path = self.find(sha256)
+            blob = Blob(
+                sha256=sha256,
+                ext=_ext(name),
+                size=size if size is not None else (os.path.getsize(path) if path else None),
+                content_type=content_type
+            )
+            db.add(blob)
+        else:
+            blob.used_at = datetime.utcnow()
+        ref = db.query(BlobRef).filter_by(user_id=user_id, kind=kind, name=name).first()
+        if ref is None:
+            ref = BlobRef(user_id=user_id, kind=kind, name=name, sha256=sha256)
+            db.add(ref)
+        else:
+            ref.sha256 = sha256
+        ref.updated_at = datetime.utcnow()
+        return ref
+
+    def store(self, db: Session, user_id: int, kind: str, data: bytes, filename: str, user_dir: str,
+              sha256: Optional[str] = None, content_type: Optional[str] = None) -> str:
+        """Содержимое в хранилище, ссылка в папке пользователя и в БД; возвращает путь в папке."""
+        sha256 = sha256 or hashlib.sha256(data).hexdigest()
+        target = self.link(self.put(data, filename, sha256), user_dir, filename)
+        self.add_ref(db, user_id, sha256, kind, os.path.basename(filename), len(data), content_type)
+        return target
+
+    def adopt(self, db: Session, user_id: int, kind: str, path: str, legacy_object: str) -> str:
+        """
+        Файл, сохраненный до хранилища блобов: содержимое берется с диска, иначе по прежнему ключу
+        MinIO (<tg_id>/<имя>), и записывается как блоб со ссылкой пользователя. Возвращает sha256.
+        """
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                data = f.read()
+        else:
+            data = self._download(legacy_object)
+        sha256 = hashlib.sha256(data).hexdigest()
+        user_dir = os.path.dirname(path)
+        os.makedirs(user_dir, exist_ok=True)
+        self.store(db, user_id, kind, data, path, user_dir, sha256)
+        logger.info(f"Файл {legacy_object} перенесен в хранилище блобов ({sha256[:12]})")
+        return sha256
+
+    def prune_refs(self, db: Session, user_id: int, kind: str, prefix: str, keep: int, user_dir: str) -> List[str]:
+        """
+        Оставляет keep последних ссылок вида kind с именем на prefix; остальные удаляются вместе
+        с файлами в папке пользователя (сами блобы потом убирает gc()).
+        """
+        refs = (
+            db.query(BlobRef)
+            .filter(BlobRef.user_id == user_id, BlobRef.kind == kind, BlobRef.name.startswith(prefix, autoescape=True))
+            .order_by(BlobRef.updated_at.desc()).all()
+        )
+        stale = refs[keep:]
+        for ref in stale:
+            db.delete(ref)
+            try:
+                os.unlink(os.path.join(user_dir, ref.name))
+            except FileNotFoundError:
+                pass
+        return [ref.name for ref in stale]
+
+    def object_for(self, db: Session, tg_id: str, filename: str) -> str:
+        """Ключ MinIO для файла пользователя: блоб по ссылке, иначе прежний <tg_id>/<filename>."""
+        blob = (
+            db.query(Blob).join(BlobRef, BlobRef.sha256 == Blob.sha256).join(User, User.id == BlobRef.user_id)
+            .filter(User.tg_id == tg_id, BlobRef.name == filename)
+            .order_by(BlobRef.updated_at.desc()).first()
+        )
+        if blob is None:
+            return f"{tg_id}/{filename}"
+        return self.object_name(blob.sha256, blob.ext or "")
+
+    def negotiate(self, db: Session, user_id: int, items: Iterable[Dict[str, str]], user_dir: str,
+                  kind: str = "font", extensions=FONT_EXTENSIONS) -> Dict[str, List[str]]:
+        """
+        Для списка {name, sha256}: известное хранилищу содержимое сразу связывается с пользователем,
+        остальное возвращается в missing — его нужно прислать. Известным считается блоб из БД
+        (источник истины — MinIO): вытесненный из локального кэша скачивается, а не запрашивается у бота.
+        """
+        linked, missing = [], []
+        for item in items:
+            name = os.path.basename(item.get("name") or "")
+            sha256 = (item.get("sha256") or "").lower()
+            if not name.lower().endswith(extensions) or not is_sha256(sha256):
+                continue
+            self._mark_reused(sha256)
+            blob = db.get(Blob, sha256)
+            try:
+                if blob is not None:
+                    self.materialize(sha256, blob.ext or _ext(name), user_dir, name)
+                else:
+                    path = self.find(sha256)
+                    if path is None:
+                        missing.append(sha256)
+                        continue
+                    self.link(path, user_dir, name)
+            except HTTPException:
+                missing.append(sha256)
+                continue
+            self.add_ref(db, user_id, sha256, kind, name)
+            linked.append(sha256)
+        return {"missing": missing, "linked": linked}
+
+    def gc(self, db: Session, grace_sec: int = BLOB_GC_GRACE_SEC) -> dict:
+        """
+        Удаляет блобы без ссылок (локально, в MinIO и в БД), не использованные последние grace_sec.
+        Перед удалением каждого блоба условие проверяется заново в той же транзакции: ссылка,
+        добавленная после выборки, спасает блоб, а запись новой ссылки ждет коммита удаления.
+        Содержимое, переиспользованное в этом процессе (put/negotiate до add_ref), не удаляется;
+        локальная копия стирается раньше объекта в MinIO, под блокировкой sha256, общей с put.
+        """
+        started = time.perf_counter()
+        cutoff = datetime.utcnow() - timedelta(seconds=grace_sec)
+        with self._lock:
+            reused_after = time.time() - grace_sec
+            self._reused = {sha256: at for sha256, at in self._reused.items() if at > reused_after}
+            reused = set(self._reused)
+        orphan = (
+            ~exists().where(BlobRef.sha256 == Blob.sha256),
+            func.coalesce(Blob.used_at, Blob.created_at) < cutoff,
+        )
+        candidates = db.query(Blob.sha256, Blob.ext, Blob.size).filter(*orphan).all()
+        deleted, freed = 0, 0
+        for sha256, ext, size in candidates:
+            if sha256 in reused:
+                continue
+            if not db.query(Blob).filter(Blob.sha256 == sha256, *orphan).delete(synchronize_session=False):
+                db.rollback()
+                continue
+            # Локальная копия удаляется до объекта в MinIO: put этого содержимого после нее
+            # зальет объект заново, а не сошлется на удаленный
+            with self._stripe(sha256):
+                with self._lock:
+                    reused_now = self._reused.get(sha256, 0) > reused_after
+                if reused_now:
+                    db.rollback()
+                    continue
+                self._drop_local(sha256)
+                try:
+                    minio_client.remove_object(MINIO_BUCKET, self.object_name(sha256, ext or ""))
+                except S3Error as e:
+                    db.rollback()
+                    logger.warning(f"Блоб {sha256[:12]} не удален из MinIO: {e}")
+                    continue
+                db.commit()
+            deleted += 1
+            freed += size or 0
+        with self._lock:
+            self._counters["gc_deleted"] += deleted
+            self._counters["gc_bytes"] += freed
+        logger.info(f"GC блобов: удалено {deleted} из {len(candidates)} ({freed} байт) за {time.perf_counter() - started:.3f} с")
+        return {"deleted": deleted, "bytes": freed}
+
+    def run_gc_forever(self, interval_sec: int = BLOB_GC_INTERVAL_SEC):
+        """Периодический GC в фоновом потоке (своя сессия на каждый проход)."""
+        while True:
+            time.sleep(interval_sec)
+            db = SessionLocal()
+            try:
+                self.gc(db)
+            except Exception as e:
+                db.rollback()
+                logger.error(f"Ошибка GC блобов: {e}", exc_info=True)
+            finally:
+                db.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                **self._counters,
+                "cached_blobs": len(self._index or {}),
+                "cached_bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+blob_store = BlobStore()
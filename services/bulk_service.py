@@ -0,0 +1,156 @@
+import os
+import csv
+import io
+import json
+import time
+import asyncio
+import zipfile
+from typing import List, Dict, Any, Optional, AsyncIterator
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
+from models.db import User, Template
+from utils.pdf import draw_replacements, merge_pdf_bytes
+from services.pdf_pool import pdf_pool
+from services.template_service import load_template_layout, plan_render, ensure_template_files
+import logging_conf
+
+logger = logging_conf.logger.getChild("bulk_service")
+
+BULK_MAX_ROWS = int(os.getenv("BULK_MAX_ROWS", "1000"))
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", str(max(2, pdf_pool.workers * 2))))
+BULK_FORMATS = ("zip", "pdf")
+
+
+def parse_rows_csv(text: str) -> List[Dict[str, str]]:
+    """Строки CSV: заголовок — названия полей («Total», «Service 1», ...), пустые ячейки не меняют поле."""
+    reader = csv.DictReader(io.StringIO(text))
+    return [{k.strip(): v for k, v in row.items() if k and v not in (None, "")} for row in reader]
+
+
+class _ZipStream:
+    """Несжимаемый приемник для zipfile: отдает записанные байты порциями (поток без seek)."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class BulkJob:
+    """Пакет строк по одному шаблону: разметка, шрифты и исходник разбираются один раз на весь пакет."""
+
+    def __init__(self, invoice_name: str, base, fields: dict, font_map: dict, rows: List[Dict[str, Any]]):
+        self.invoice_name = invoice_name
+        self.base = base
+        self.fields = fields
+        self.font_map = font_map
+        self.rows = rows
+        self.report: List[dict] = []
+
+    def file_name(self, row_num: int) -> str:
+        return f"{self.invoice_name}_{row_num:04d}.pdf"
+
+    async def _render_row(self, row_num: int, row: Dict[str, Any], semaphore: asyncio.Semaphore) -> Optional[bytes]:
+        async with semaphore:
+            started = time.perf_counter()
+            entry = {"row": row_num}
+            try:
+                if not isinstance(row, dict):
+                    raise ValueError("row must be an object of field values")
+                editable_fields, replacements, ops, font_buffers = plan_render(
+                    self.base, self.fields, row, self.font_map
+                )
+                known = {name for name, _ in editable_fields}
+                unknown = [k for k in row if k not in known]
+                data = await pdf_pool.run_async(draw_replacements, self.base.data, ops, font_buffers) if ops \
+                    else self.base.data
+                entry.update(file=self.file_name(row_num), changed=len(ops))
+                if unknown:
+                    entry["unknown_fields"] = unknown
+                return data
+            except Exception as e:
+                entry["error"] = str(getattr(e, "detail", e)) or e.__class__.__name__
+                logger.warning(f"Пакет {self.invoice_name}: строка {row_num} не отрисована: {entry['error']}")
+                return None
+            finally:
+                entry["seconds"] = round(time.perf_counter() - started, 4)
+                self.report.append(entry)
+
+    async def rendered(self) -> AsyncIterator[tuple]:
+        """(номер строки, PDF или None) в порядке строк; рендер идет параллельно с ограничением."""
+        semaphore = asyncio.Semaphore(BULK_CONCURRENCY)
+        tasks = [
+            asyncio.create_task(self._render_row(num, row, semaphore))
+            for num, row in enumerate(self.rows, 1)
+        ]
+        try:
+            for num, task in enumerate(tasks, 1):
+                yield num, await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def summary(self) -> dict:
+        report = sorted(self.report, key=lambda e: e["row"])
+        return {
+            "rows": len(self.rows),
+            "rendered": sum(1 for e in report if "error" not in e),
+            "failed": sum(1 for e in report if "error" in e),
+            "results": report,
+        }
+
+    async def stream_zip(self) -> AsyncIterator[bytes]:
+        """ZIP отдается по мере готовности строк; в конце — report.json с результатом по каждой строке."""
+        sink = _ZipStream()
+        archive = zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_STORED)
+        async for num, data in self.rendered():
+            if data is not None:
+                archive.writestr(self.file_name(num), data)
+                yield sink.drain()
+        archive.writestr("report.json", json.dumps(self.summary(), ensure_ascii=False, indent=2))
+        archive.close()
+        yield sink.drain()
+        logger.info(f"Пакет {self.invoice_name}: {self.summary()['rendered']}/{len(self.rows)} строк в ZIP")
+
+    async def merged_pdf(self) -> bytes:
+        parts = [data async for _, data in self.rendered() if data is not None]
+        if not parts:
+            raise HTTPException(422, {"message": "No rows rendered", **self.summary()})
+        merged = await pdf_pool.run_async(merge_pdf_bytes, parts)
+        logger.info(f"Пакет {self.invoice_name}: {len(parts)}/{len(self.rows)} строк в одном PDF")
+        return merged
+
+
+async def prepare_bulk_job(tg_id: str, template_id: Optional[int], rows: List[Dict[str, Any]], db: Session) -> BulkJob:
+    logger.info(f"Пакетная генерация для {tg_id}: шаблон {template_id or 'последний'}, строк {len(rows)}")
+    if not rows:
+        raise HTTPException(400, "No rows provided")
+    if len(rows) > BULK_MAX_ROWS:
+        raise HTTPException(400, f"Too many rows >{BULK_MAX_ROWS}")
+    user = db.query(User).filter_by(tg_id=tg_id).first()
+    if not user:
+        logger.warning(f"User {tg_id} не найден при пакетной генерации")
+        raise HTTPException(404, "User not found")
+    query = db.query(Template).filter_by(user_id=user.id)
+    if template_id is not None:
+        template = query.filter_by(id=template_id).first()
+    else:
+        template = query.order_by(Template.updated_at.desc()).first()
+    if not template:
+        logger.warning(f"Template {template_id} для {tg_id} не найден")
+        raise HTTPException(404, "Template not found")
+    font_map = await run_in_threadpool(ensure_template_files, template, db)
+    base, fields = await run_in_threadpool(load_template_layout, template, template.file_path, font_map)
+    db.commit()
+    return BulkJob(template.invoice_name, base, fields, font_map, rows)
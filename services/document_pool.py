@@ -0,0 +1,147 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+import logging_conf
+from utils.pdf import parse_pdf_bytes
+from utils.span_index import SpanIndex
+from services.pdf_pool import pdf_pool
+
+logger = logging_conf.logger.getChild("document_pool")
+
+DOC_POOL_MAX_ENTRIES = int(os.getenv("DOC_POOL_MAX_ENTRIES", "32"))
+DOC_POOL_MAX_MB = float(os.getenv("DOC_POOL_MAX_MB", "256"))
+
+# Грубая оценка памяти на один спан с глифами (dict блока + IndexedSpan).
+SPAN_OVERHEAD_BYTES = 600
+
+
+class BaseDocument:
+    """
+    Разобранный исходник шаблона: байты PDF, спаны с индексом и буферы TTF.
+    Неизменяем; рендер идет по копии байтов в draw_replacements в пуле процессов.
+    """
+
+    def __init__(self, key: Tuple, path: str, stamp: Tuple[int, int], data: bytes, sha256: str,
+                 parsed: dict, font_buffers: Dict[str, bytes]):
+        self.key = key
+        self.path = path
+        self.stamp = stamp
+        self.data = data
+        self.sha256 = sha256
+        self.fonts = parsed["fonts"]
+        self.blocks = parsed["blocks"]
+        self.page_sizes = parsed["page_sizes"]
+        self.span_index = SpanIndex.from_tuples(parsed["spans"])
+        self.font_buffers = font_buffers
+        self.size_bytes = (
+            len(self.data) + sum(len(b) for b in font_buffers.values())
+            + len(self.blocks) * SPAN_OVERHEAD_BYTES
+        )
+
+
+def _file_stamp(path: str) -> Tuple[int, int]:
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+def _read_fonts(font_map: Optional[Dict[str, str]]) -> Dict[str, bytes]:
+    buffers = {}
+    for font_path in set((font_map or {}).values()):
+        if font_path in buffers:
+            continue
+        try:
+            with open(font_path, "rb") as f:
+                buffers[font_path] = f.read()
+        except OSError as e:
+            logger.warning(f"Не удалось прочитать шрифт {font_path}: {e}")
+    return buffers
+
+
+class DocumentPool:
+    """
+    Потокобезопасный LRU-пул разобранных исходников шаблонов, ключ — (id шаблона, хэш файла).
+    Ограничен числом записей и суммарным объемом; файл на диске сверяется по mtime и размеру.
+    """
+
+    def __init__(self, max_entries: int = DOC_POOL_MAX_ENTRIES, max_mb: float = DOC_POOL_MAX_MB):
+        self.max_entries = max_entries
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._entries: "OrderedDict[Tuple, BaseDocument]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "stale": 0, "evictions": 0, "evicted_bytes": 0}
+
+    def _font_key(self, font_map: Optional[Dict[str, str]]) -> Tuple:
+        return tuple(sorted((font_map or {}).items()))
+
+    def acquire(self, template_id, file_hash: Optional[str], path: str,
+                font_map: Optional[Dict[str, str]] = None, parsed: Optional[dict] = None) -> BaseDocument:
+        """
+        Базовый документ из пула; при промахе или изменении файла разбирается заново.
+        parsed — готовый разбор (например, общего шаблона), используется, если хэш файла совпал с file_hash.
+        """
+        key = (template_id, file_hash, self._font_key(font_map))
+        stamp = _file_stamp(path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.stamp == stamp and entry.path == path:
+                self._entries.move_to_end(key)
+                self._counters["hits"] += 1
+                return entry
+            if entry is not None:
+                self._counters["stale"] += 1
+                self._remove(key)
+            self._counters["misses"] += 1
+
+        with open(path, "rb") as f:
+            data = f.read()
+        sha256 = hashlib.sha256(data).hexdigest()
+        if parsed is None or sha256 != file_hash:
+            parsed = pdf_pool.run(parse_pdf_bytes, data)
+        entry = BaseDocument(key, path, stamp, data, sha256, parsed, _read_fonts(font_map))
+        if file_hash and entry.sha256 != file_hash:
+            # Файл изменился относительно сохраненной разметки: не кэшируем под старым хэшем
+            return entry
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if entry.size_bytes > self.max_bytes:
+                logger.info(f"Документ {path} ({entry.size_bytes} байт) больше лимита пула, не кэшируется")
+                return entry
+            self._entries[key] = entry
+            self._bytes += entry.size_bytes
+            self._evict()
+        return entry
+
+    def invalidate(self, template_id):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == template_id]:
+                self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry.size_bytes
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            key, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.size_bytes
+            self._counters["evictions"] += 1
+            self._counters["evicted_bytes"] += entry.size_bytes
+            logger.info(f"Документ {entry.path} вытеснен из пула")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                **self._counters,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+            }
+
+
+document_pool = DocumentPool()
+
@@ -0,0 +1,143 @@
+import os
+import time
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+import logging_conf
+
+logger = logging_conf.logger.getChild("edit_coalescer")
+
+EDIT_COALESCE_WINDOW_SEC = float(os.getenv("EDIT_COALESCE_WINDOW_SEC", "1.5"))
+
+
+class EditSuperseded(Exception):
+    """Рендер устарел: пока он ждал или шел, пришли новые правки того же шаблона."""
+
+
+class _EditBatch:
+    def __init__(self, changes: dict, deadline: float):
+        self.changes = dict(changes)
+        self.deadline = deadline
+        self.requests = 0
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.cancelled = False
+        # Партия, начатая, пока эта рендерилась: ее состояние включает правки этой
+        self.successor: Optional["_EditBatch"] = None
+
+
+class EditCoalescer:
+    """
+    Склейка частых правок одного шаблона. Правки, пришедшие в течение window_sec после первой,
+    сливаются в одно желаемое состояние и рендерятся один раз; все запросы получают общий результат.
+    Если во время рендера приходят новые правки, устаревший рендер отменяется (apply проверяет
+    superseded()), а его запросы ждут следующую партию — она начинается с их состояния.
+    Окно отсчитывает таймер, и рендер идет в его потоке: потоки запросов только ждут результат.
+    """
+
+    def __init__(self, window_sec: float = EDIT_COALESCE_WINDOW_SEC):
+        self.window_sec = window_sec
+        self._lock = threading.Lock()
+        # _pending — партия, которая еще собирает правки; _latest — самая новая партия шаблона
+        self._pending: Dict[Hashable, _EditBatch] = {}
+        self._latest: Dict[Hashable, _EditBatch] = {}
+        self._counters = {"requests": 0, "merged": 0, "renders": 0, "cancelled": 0}
+
+    def desired(self, template_id: Hashable) -> Optional[dict]:
+        """Состояние, которое будет отрисовано (с еще не примененными правками), или None."""
+        with self._lock:
+            batch = self._latest.get(template_id)
+            return dict(batch.changes) if batch is not None else None
+
+    def wait(self, template_id: Hashable):
+        """Ждет, пока будут отрисованы (или завершатся ошибкой) все правки, принятые до вызова."""
+        with self._lock:
+            batch = self._latest.get(template_id)
+        while batch is not None:
+            batch.done.wait()
+            with self._lock:
+                batch = batch.successor if batch.cancelled else None
+
+    def submit(self, template_id: Hashable, changes: dict,
+               apply: Callable[[dict, Callable[[], bool]], Any]) -> Tuple[Any, int, bool]:
+        """
+        Добавляет правку и ждет рендер итогового состояния: (результат, число склеенных запросов,
+        final — False, если правку этого запроса перекрыл более поздний запрос).
+        """
+        with self._lock:
+            self._counters["requests"] += 1
+            batch = self._pending.get(template_id)
+            leader = batch is None
+            if leader:
+                previous = self._latest.get(template_id)
+                batch = _EditBatch(previous.changes if previous else {}, time.monotonic() + self.window_sec)
+                if previous is not None:
+                    previous.successor = batch
+                self._pending[template_id] = self._latest[template_id] = batch
+            else:
+                self._counters["merged"] += 1
+            batch.changes.update(changes)
+            batch.requests += 1
+            ticket = batch.requests
+        if leader:
+            timer = threading.Timer(max(0.0, batch.deadline - time.monotonic()), self._flush,
+                                    (template_id, batch, apply))
+            timer.daemon = True
+            timer.start()
+        return self._wait(batch, ticket)
+
+    def _flush(self, template_id: Hashable, batch: _EditBatch, apply):
+        """Окно партии закрылось: рендер ее итогового состояния (в потоке таймера)."""
+        with self._lock:
+            if self._pending.get(template_id) is batch:
+                del self._pending[template_id]
+        if batch.requests > 1:
+            logger.info(f"Шаблон {template_id}: {batch.requests} правок склеены в один рендер")
+
+        def superseded() -> bool:
+            with self._lock:
+                return batch.successor is not None
+
+        try:
+            while True:
+                try:
+                    batch.result = apply(dict(batch.changes), superseded)
+                    with self._lock:
+                        self._counters["renders"] += 1
+                    break
+                except EditSuperseded:
+                    # Отмена могла прийти из чужого рендера с теми же значениями (single-flight):
+                    # если у этой партии нет преемника, рендер повторяется
+                    with self._lock:
+                        if batch.successor is None:
+                            continue
+                        batch.cancelled = True
+                        self._counters["cancelled"] += 1
+                    logger.info(f"Шаблон {template_id}: рендер отменен, есть более новые правки")
+                    break
+        except BaseException as e:
+            batch.error = e
+        finally:
+            with self._lock:
+                if self._latest.get(template_id) is batch:
+                    del self._latest[template_id]
+            batch.done.set()
+
+    @staticmethod
+    def _wait(batch: _EditBatch, ticket: int) -> Tuple[Any, int, bool]:
+        final = True
+        while True:
+            batch.done.wait()
+            if not batch.cancelled:
+                break
+            batch, final = batch.successor, False
+        if batch.error is not None:
+            raise batch.error
+        return batch.result, batch.requests, final and ticket == batch.requests
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._counters, "pending": len(self._pending), "active_templates": len(self._latest)}
+
+
+edit_coalescer = EditCoalescer()
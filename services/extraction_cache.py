@@ -0,0 +1,211 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional
+import logging_conf
+
+logger = logging_conf.logger.getChild("extraction_cache")
+
+CACHE_PATH = os.getenv("GEMINI_CACHE_PATH", os.path.join("cache", "gemini_cache.sqlite3"))
+CACHE_MEMORY_ENTRIES = int(os.getenv("GEMINI_CACHE_MEMORY_ENTRIES", "512"))
+CACHE_DISK_ENTRIES = int(os.getenv("GEMINI_CACHE_DISK_ENTRIES", "20000"))
+CACHE_DISK_MAX_MB = int(os.getenv("GEMINI_CACHE_DISK_MAX_MB", "256"))
+CACHE_TTL_SEC = int(os.getenv("GEMINI_CACHE_TTL_SEC", str(30 * 24 * 3600)))
+# Как часто удаляются просроченные записи и сверяются счетчики с таблицей (файл могут писать несколько процессов)
+CACHE_EXPIRE_INTERVAL_SEC = int(os.getenv("GEMINI_CACHE_EXPIRE_INTERVAL_SEC", "600"))
+
+
+def normalize_blocks(blocks: List[dict]) -> List[list]:
+    """Приводит блоки к стабильному виду: одинаковые документы дают одинаковый ключ."""
+    normalized = []
+    for b in blocks:
+        normalized.append([
+            b.get("page", 0),
+            b.get("text", ""),
+            [round(float(c), 2) for c in (b.get("bbox") or [])],
+            b.get("font", ""),
+            round(float(b.get("size", 0.0)), 2),
+            b.get("flags", 0),
+        ])
+    return normalized
+
+
+def make_cache_key(blocks: List[dict], model_name: str, prompt_version: str, extra: str = "") -> str:
+    payload = json.dumps(
+        {"blocks": normalize_blocks(blocks), "model": model_name, "prompt": prompt_version, "extra": extra},
+        ensure_ascii=False, sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ExtractionCache:
+    """
+    Двухуровневый кэш результатов извлечения полей:
+    LRU в памяти процесса перед постоянным хранилищем SQLite. Вытеснение по TTL, числу записей
+    и суммарному размеру значений на диске (disk_bytes). Число записей и их размер ведутся счетчиками,
+    поэтому запись не сканирует таблицу; просроченные записи удаляются раз в expire_interval_sec.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = CACHE_PATH,
+        memory_entries: int = CACHE_MEMORY_ENTRIES,
+        disk_entries: int = CACHE_DISK_ENTRIES,
+        ttl_sec: int = CACHE_TTL_SEC,
+        disk_bytes: int = CACHE_DISK_MAX_MB * 1024 * 1024,
+        expire_interval_sec: int = CACHE_EXPIRE_INTERVAL_SEC
+    ):
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        self.disk_bytes = disk_bytes
+        self.ttl_sec = ttl_sec
+        self.expire_interval_sec = expire_interval_sec
+        self._entries = 0
+        self._bytes = 0
+        self._expired_at = time.time()
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {
+            "memory_hits": 0, "disk_hits": 0, "misses": 0,
+            "memory_evictions": 0, "disk_evictions": 0, "expired": 0,
+        }
+        self._conn = None
+        if path:
+            try:
+                if os.path.dirname(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                self._conn = sqlite3.connect(path, check_same_thread=False)
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS extraction_cache ("
+                    "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                    "created_at REAL NOT NULL, accessed_at REAL NOT NULL, size INTEGER)"
+                )
+                columns = {row[1] for row in self._conn.execute("PRAGMA table_info(extraction_cache)")}
+                if "size" not in columns:
+                    self._conn.execute("ALTER TABLE extraction_cache ADD COLUMN size INTEGER")
+                self._conn.execute("UPDATE extraction_cache SET size = LENGTH(value) WHERE size IS NULL")
+                self._conn.execute(
+                    "CREATE INDEX IF NOT EXISTS ix_extraction_cache_accessed ON extraction_cache (accessed_at)"
+                )
+                self._conn.execute(
+                    "CREATE INDEX IF NOT EXISTS ix_extraction_cache_created ON extraction_cache (created_at)"
+                )
+                self._conn.commit()
+                self._resync()
+            except sqlite3.Error as e:
+                logger.error(f"Не удалось открыть кэш {path}, работаем только в памяти: {e}")
+                self._conn = None
+
+    def _resync(self):
+        self._entries, self._bytes = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM extraction_cache"
+        ).fetchone()
+
+    def _delete(self, where: str, params: tuple) -> int:
+        """Удаляет записи по условию (по индексированной колонке) с учетом счетчиков."""
+        count, size = self._conn.execute(
+            f"SELECT COUNT(*), COALESCE(SUM(size), 0) FROM extraction_cache WHERE {where}", params
+        ).fetchone()
+        if count:
+            self._conn.execute(f"DELETE FROM extraction_cache WHERE {where}", params)
+            self._entries -= count
+            self._bytes -= size
+        return count
+
+    def _expire(self, now: float):
+        """Раз в expire_interval_sec: удаление просроченных записей и сверка счетчиков с таблицей."""
+        if now - self._expired_at < self.expire_interval_sec:
+            return
+        self._expired_at = now
+        if self.ttl_sec > 0:
+            self._counters["expired"] += self._delete("created_at < ?", (now - self.ttl_sec,))
+        self._resync()
+
+    def _expired(self, created_at: float, now: float) -> bool:
+        return self.ttl_sec > 0 and now - created_at > self.ttl_sec
+
+    def _remember(self, key: str, value: str, created_at: float):
+        self._memory[key] = (value, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+            self._counters["memory_evictions"] += 1
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            item = self._memory.get(key)
+            if item is not None:
+                value, created_at = item
+                if not self._expired(created_at, now):
+                    self._memory.move_to_end(key)
+                    self._counters["memory_hits"] += 1
+                    return json.loads(value)
+                del self._memory[key]
+                self._counters["expired"] += 1
+            if self._conn is not None:
+                row = self._conn.execute(
+                    "SELECT value, created_at FROM extraction_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    value, created_at = row
+                    if not self._expired(created_at, now):
+                        self._conn.execute("UPDATE extraction_cache SET accessed_at = ? WHERE key = ?", (now, key))
+                        self._conn.commit()
+                        self._remember(key, value, created_at)
+                        self._counters["disk_hits"] += 1
+                        return json.loads(value)
+                    self._delete("key = ?", (key,))
+                    self._conn.commit()
+                    self._counters["expired"] += 1
+            self._counters["misses"] += 1
+            return None
+
+    def set(self, key: str, data: Dict[str, Any]):
+        now = time.time()
+        value = json.dumps(data, ensure_ascii=False)
+        with self._lock:
+            self._remember(key, value, now)
+            if self._conn is None:
+                return
+            self._delete("key = ?", (key,))
+            self._conn.execute(
+                "INSERT INTO extraction_cache (key, value, created_at, accessed_at, size) VALUES (?, ?, ?, ?, ?)",
+                (key, value, now, now, len(value))
+            )
+            self._entries += 1
+            self._bytes += len(value)
+            self._expire(now)
+            if self._entries > self.disk_entries or self._bytes > self.disk_bytes:
+                self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """Удаляет давно не читанные записи, пока кэш не уложится в disk_entries и disk_bytes."""
+        victims = []
+        entries, total = self._entries, self._bytes
+        rows = self._conn.execute("SELECT key, size FROM extraction_cache ORDER BY accessed_at ASC")
+        for key, size in rows:
+            if entries <= self.disk_entries and total <= self.disk_bytes:
+                break
+            victims.append((key,))
+            entries -= 1
+            total -= size or 0
+        self._conn.executemany("DELETE FROM extraction_cache WHERE key = ?", victims)
+        self._entries, self._bytes = entries, total
+        self._counters["disk_evictions"] += len(victims)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._counters)
+            stats["memory_entries"] = len(self._memory)
+            stats["disk_entries"] = self._entries
+            stats["disk_bytes"] = self._bytes
+        hits = stats["memory_hits"] + stats["disk_hits"]
+        total = hits + stats["misses"]
+        stats["hit_rate"] = round(hits / total, 4) if total else 0.0
+        return stats
@@ -0,0 +1,171 @@
+import os
+import time
+import random
+import asyncio
+import threading
+import weakref
+from collections import deque
+from typing import Dict, Optional
+import google.generativeai as genai
+from google.api_core.exceptions import GoogleAPICallError
+import logging_conf
+
+logger = logging_conf.logger.getChild("gemini_client")
+
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "8"))
+GEMINI_TIMEOUT_SEC = float(os.getenv("GEMINI_TIMEOUT_SEC", "90"))
+GEMINI_RETRIES = int(os.getenv("GEMINI_RETRIES", "2"))
+GEMINI_BACKOFF_SEC = float(os.getenv("GEMINI_BACKOFF_SEC", "0.5"))
+GEMINI_HEDGE = os.getenv("GEMINI_HEDGE", "0") == "1"
+GEMINI_HEDGE_MIN_SAMPLES = int(os.getenv("GEMINI_HEDGE_MIN_SAMPLES", "20"))
+
+
+def is_retryable(e: Exception) -> bool:
+    """Повторяются только временные ошибки: таймаут, обрыв соединения, 429 и 5xx."""
+    if isinstance(e, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    if isinstance(e, GoogleAPICallError) and e.code is not None:
+        return int(e.code) == 429 or int(e.code) >= 500
+    return False
+
+
+class GeminiClient:
+    """
+    Асинхронный клиент Gemini: переиспользует объекты моделей, ограничивает число
+    одновременных запросов, задает дедлайн на вызов, повторяет с джиттером и
+    (опционально) отправляет хедж-запрос, если ответ дольше p95. Ошибки запроса (4xx,
+    блокировка по безопасности) не повторяются.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = GEMINI_CONCURRENCY,
+        timeout_sec: float = GEMINI_TIMEOUT_SEC,
+        retries: int = GEMINI_RETRIES,
+        backoff_sec: float = GEMINI_BACKOFF_SEC,
+        hedge: bool = GEMINI_HEDGE,
+        hedge_min_samples: int = GEMINI_HEDGE_MIN_SAMPLES
+    ):
+        self.concurrency = concurrency
+        self.timeout_sec = timeout_sec
+        self.retries = retries
+        self.backoff_sec = backoff_sec
+        self.hedge = hedge
+        self.hedge_min_samples = hedge_min_samples
+        self._models: Dict[str, genai.GenerativeModel] = {}
+        self._models_lock = threading.Lock()
+        self._semaphores = weakref.WeakKeyDictionary()
+        self._latencies = deque(maxlen=256)
+        self._counters = {"calls": 0, "errors": 0, "timeouts": 0, "retries": 0, "hedges": 0, "hedge_wins": 0}
+
+    def model(self, model_name: str) -> genai.GenerativeModel:
+        """Возвращает закэшированный объект модели (создается один раз на имя)."""
+        with self._models_lock:
+            model = self._models.get(model_name)
+            if model is None:
+                model = genai.GenerativeModel(model_name)
+                self._models[model_name] = model
+            return model
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        sem = self._semaphores.get(loop)
+        if sem is None:
+            sem = asyncio.Semaphore(self.concurrency)
+            self._semaphores[loop] = sem
+        return sem
+
+    def record_latency(self, seconds: float):
+        self._latencies.append(seconds)
+
+    def p95(self) -> Optional[float]:
+        if len(self._latencies) < self.hedge_min_samples:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    async def _call_once(self, prompt: str, model_name: str, max_tokens: Optional[int],
+                         acquired: Optional[asyncio.Event] = None) -> str:
+        model = self.model(model_name)
+        async with self._semaphore():
+            if acquired is not None:
+                acquired.set()
+            started = time.perf_counter()
+            response = await asyncio.wait_for(
+                model.generate_content_async(
+                    prompt,
+                    generation_config={"max_output_tokens": max_tokens} if max_tokens else None
+                ),
+                timeout=self.timeout_sec
+            )
+            self.record_latency(time.perf_counter() - started)
+            return response.text
+
+    async def _call_hedged(self, prompt: str, model_name: str, max_tokens: Optional[int]) -> str:
+        threshold = self.p95() if self.hedge else None
+        if threshold is None:
+            return await self._call_once(prompt, model_name, max_tokens)
+        # p95 — время самого запроса, поэтому отсчет идет с момента, когда запрос получил слот
+        acquired = asyncio.Event()
+        first = asyncio.ensure_future(self._call_once(prompt, model_name, max_tokens, acquired))
+        slot = asyncio.ensure_future(acquired.wait())
+        try:
+            await asyncio.wait({first, slot}, return_when=asyncio.FIRST_COMPLETED)
+            if not first.done():
+                await asyncio.wait({first}, timeout=threshold)
+        except asyncio.CancelledError:
+            first.cancel()
+            raise
+        finally:
+            slot.cancel()
+        if first.done():
+            return first.result()
+        self._counters["hedges"] += 1
+        logger.info(f"Gemini отвечает дольше p95 ({threshold:.2f}s), отправляем хедж-запрос")
+        second = asyncio.ensure_future(self._call_once(prompt, model_name, max_tokens))
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self._counters["hedge_wins"] += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def generate(self, prompt: str, model_name: str, max_tokens: Optional[int] = None) -> str:
+        """Вызов Gemini с дедлайном, повторами (экспоненциальная задержка с джиттером) и хеджированием."""
+        self._counters["calls"] += 1
+        attempt = 0
+        while True:
+            try:
+                return await self._call_hedged(prompt, model_name, max_tokens)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    self._counters["timeouts"] += 1
+                if attempt >= self.retries or not is_retryable(e):
+                    self._counters["errors"] += 1
+                    raise
+                delay = random.uniform(0, self.backoff_sec * (2 ** attempt))
+                attempt += 1
+                self._counters["retries"] += 1
+                logger.warning(f"Gemini error ({e!r}), попытка {attempt}/{self.retries} через {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+    def stats(self) -> Dict[str, object]:
+        stats = dict(self._counters)
+        stats["p95_sec"] = self.p95()
+        stats["samples"] = len(self._latencies)
+        stats["concurrency"] = self.concurrency
+        return stats
+
+
+gemini_client = GeminiClient()
@@ -1,10 +1,21 @@
 import os
 import json
+import asyncio
 import logging
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Any, Optional, Union
 import google.generativeai as genai
+from fastapi.concurrency import run_in_threadpool
 
 import logging_conf
+from services.extraction_cache import ExtractionCache, make_cache_key
+from services.gemini_client import gemini_client, GEMINI_CONCURRENCY
+from utils.prompt_encoding import (
+    encode_blocks, raw_blocks_json, estimate_tokens, prompt_size_counter, split_blocks_by_page, chunk_blocks_by_budget
+)
+from utils.field_rules import extract_fields_by_rules
+from utils.line_items import detect_line_items
 
 from dotenv import load_dotenv
 load_dotenv(dotenv_path=".env")
@@ -17,6 +28,26 @@ logger.info("GEMINI_API_KEY loaded: %s", os.environ.get("GEMINI_API_KEY"))
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY") or "your_key"
 genai.configure(api_key=GEMINI_API_KEY)
 
+GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "models/gemini-2.5-flash-preview-05-20")
+# Меняйте версию при любом изменении промпта — старые записи кэша перестанут совпадать
+PROMPT_VERSION = "3"
+# json — исходные спаны с точными bbox (по умолчанию); compact — строки в табличной кодировке:
+# меньше токенов, но bbox значения внутри строки модель сужает приблизительно
+PROMPT_MODE = os.environ.get("GEMINI_PROMPT_MODE", "json")
+PROMPT_TOKEN_BUDGET = int(os.environ.get("GEMINI_PROMPT_TOKEN_BUDGET", "60000"))
+# Документы от CHUNK_MIN_PAGES страниц извлекаются параллельно кусками по PAGES_PER_CHUNK страниц
+CHUNK_MIN_PAGES = int(os.environ.get("GEMINI_CHUNK_MIN_PAGES", "3"))
+PAGES_PER_CHUNK = int(os.environ.get("GEMINI_PAGES_PER_CHUNK", "2"))
+
+LINE_ITEM_FIELDS = ("Descriptions", "Description")
+# Итоговые суммы обычно в конце документа: при равной confidence побеждает последний кусок
+TRAILING_FIELDS = ("Total", "Subtotal", "Amount", "Currency")
+# hybrid — правила + Gemini для недостающих полей, rules — без LLM, llm — только Gemini
+EXTRACTION_MODE = os.environ.get("EXTRACTION_MODE", "hybrid")
+RULES_MIN_CONFIDENCE = float(os.environ.get("RULES_MIN_CONFIDENCE", "0.8"))
+
+extraction_cache = ExtractionCache()
+
 FIELDS_TO_EXTRACT = [
     "Invoice Number", "Invoice Date", "Due Date", "Client Name",
     "Company Name", "Client Address", "Client Phone", "Client Email",
@@ -28,13 +59,13 @@ FIELDS_TO_EXTRACT = [
 
 def ask_gemini(
     prompt: str,
-    model_name: str = "models/gemini-2.5-flash-preview-05-20",
+    model_name: str = GEMINI_MODEL,
     max_tokens: Optional[int] = None,
 ) -> str:
     """Отправить промпт в Gemini и вернуть сырой текст-ответ."""
     logger.info("Gemini prompt: %s", prompt[:500])
     try:
-        model = genai.GenerativeModel(model_name)
+        model = gemini_client.model(model_name)
         response = model.generate_content(
             prompt,
             generation_config={"max_output_tokens": max_tokens} if max_tokens else None
@@ -46,6 +77,22 @@ def ask_gemini(
         return ""
 
 
+async def ask_gemini_async(
+    prompt: str,
+    model_name: str = GEMINI_MODEL,
+    max_tokens: Optional[int] = None,
+) -> str:
+    """Асинхронная версия ask_gemini через общий клиент (таймауты, повторы, лимит параллелизма)."""
+    logger.info("Gemini prompt: %s", prompt[:500])
+    try:
+        text = await gemini_client.generate(prompt, model_name, max_tokens)
+        logger.info("Gemini response received (%d chars)", len(text or ""))
+        return text
+    except Exception as e:
+        logger.error(f"Gemini error: {e}", exc_info=True)
+        return ""
+
+
 def extract_json_from_gemini(text: str) -> str:
     """Вырезать JSON из ответа Gemini (если есть)."""
     start = text.find('{')
@@ -56,29 +103,110 @@ def extract_json_from_gemini(text: str) -> str:
     return text[start:end+1]
 
 
-def build_parsing_prompt(blocks: List[dict]) -> str:
+def build_parsing_prompt(blocks: List[dict], mode: Optional[str] = None, fields: Optional[List[str]] = None) -> str:
     """Собирает промпт для Gemini из массива текстовых блоков PDF."""
-    fields_list = ', '.join(FIELDS_TO_EXTRACT)
-    system_prompt = (
-        "You are given an array of text blocks from a PDF invoice. "
-        "Each block contains 'text', its bounding box ('bbox'), font, size, and 'page' number. "
+    mode = mode or PROMPT_MODE
+    fields_list = ', '.join(fields or FIELDS_TO_EXTRACT)
+    raw_json = raw_blocks_json(blocks)
+    if mode == "json":
+        system_prompt = (
+            "You are given an array of text blocks from a PDF invoice. "
+            "Each block contains 'text', its bounding box ('bbox'), font, size, and 'page' number. "
+        )
+        user_prompt = "blocks:\n" + raw_json
+    else:
+        system_prompt = (
+            "You are given text lines from a PDF invoice as a compact table. "
+            "First comes a 'fonts' table (id=font_name/size), then one row per line: "
+            "page|x0|y0|x1|y1|font|text, where x0..y1 is the line bounding box and font is an id from the fonts table. "
+            "When a value is only part of a line, narrow x0/x1 to the value proportionally to its character position. "
+            "In the answer use the real font name and size from the fonts table, not the id. "
+        )
+        user_prompt = encode_blocks(blocks, mode)
+    system_prompt += (
         f"For each of the following fields [{fields_list}], "
         "find ONLY the value (not including label, key, or prefix) and return the exact bbox, font, and size for that value (not the whole line, not including any label). "
         "For fields like 'Descriptions' or 'Description' (service lines), if there are multiple, return a list of all with value/bbox/font/size/page. "
+        "For every found value also return 'confidence' from 0 to 1: how sure you are that it is this field of this invoice "
+        "(low for values that only look similar, e.g. a carried-forward subtotal instead of the final total). "
         "Return valid JSON like: "
-        "{\"Description\": {\"value\": \"...\", \"bbox\": [x0, y0, x1, y1], \"font\": \"...\", \"size\": 11.0, \"page\": page_num}, ...}, if not found — set to null. Do NOT add any explanation or non-JSON text."
+        "{\"Description\": {\"value\": \"...\", \"bbox\": [x0, y0, x1, y1], \"font\": \"...\", \"size\": 11.0, \"page\": page_num, \"confidence\": 0.9}, ...}, if not found — set to null. Do NOT add any explanation or non-JSON text."
+    )
+    prompt_size_counter.record(len(raw_json), len(user_prompt))
+    logger.info(
+        "Prompt blocks: %d chars (~%d tokens) raw, %d chars (~%d tokens) in mode %s",
+        len(raw_json), estimate_tokens(raw_json), len(user_prompt), estimate_tokens(user_prompt), mode
     )
-    user_prompt = "blocks:\n" + json.dumps(blocks, ensure_ascii=False)
     return f"{system_prompt}\n{user_prompt}"
 
 
-def extract_fields_with_bbox_gemini(blocks: List[dict]) -> Dict[str, Union[dict, list, None]]:
+def plan_chunks(blocks: List[dict]) -> List[List[dict]]:
     """
-    Для блока текста PDF вызывает Gemini, парсит JSON-ответ и возвращает словарь полей.
+    Делит блоки на куски для параллельного извлечения: короткие документы идут одним куском,
+    длинные — группами по PAGES_PER_CHUNK страниц. Кусок больше бюджета токенов (в кодировке
+    PROMPT_MODE) делится дальше, а не обрезается: итоги и реквизиты в конце документа не теряются.
     """
-    logger.info("Start extracting fields with Gemini...")
-    prompt = build_parsing_prompt(blocks)
-    resp_text = ask_gemini(prompt)
+    encode = partial(encode_blocks, mode=PROMPT_MODE)
+    pages = split_blocks_by_page(blocks)
+    if len(pages) < CHUNK_MIN_PAGES:
+        return chunk_blocks_by_budget(blocks, PROMPT_TOKEN_BUDGET, encode)
+    page_lists = list(pages.values())
+    chunks = []
+    for i in range(0, len(page_lists), PAGES_PER_CHUNK):
+        group = [b for page_blocks in page_lists[i:i + PAGES_PER_CHUNK] for b in page_blocks]
+        chunks.extend(chunk_blocks_by_budget(group, PROMPT_TOKEN_BUDGET, encode))
+    return chunks
+
+
+def _confidence(value) -> float:
+    if isinstance(value, dict):
+        try:
+            return float(value.get("confidence", 0.0))
+        except (TypeError, ValueError):
+            return 0.0
+    return 0.0
+
+
+def _has_value(value) -> bool:
+    if isinstance(value, dict):
+        return value.get("value") not in (None, "", [])
+    if isinstance(value, list):
+        return any(_has_value(v) for v in value)
+    return False
+
+
+def merge_chunk_fields(results: List[Dict[str, Union[dict, list, None]]]) -> Dict[str, Union[dict, list, None]]:
+    """
+    Объединяет результаты по кускам (в порядке страниц): строки услуг склеиваются,
+    для остальных полей берется значение с большей confidence; при равенстве итоговые суммы
+    (TRAILING_FIELDS) берутся из последнего куска, остальные поля — из первого.
+    """
+    merged: Dict[str, Union[dict, list, None]] = {}
+    for fields in results:
+        for key, value in (fields or {}).items():
+            if key in LINE_ITEM_FIELDS:
+                items = value if isinstance(value, list) else [value]
+                items = [item for item in items if _has_value(item)]
+                if items:
+                    merged[key] = (merged.get(key) or []) + items
+                else:
+                    merged.setdefault(key, None)
+                continue
+            current = merged.get(key)
+            if not _has_value(value):
+                merged.setdefault(key, value)
+                continue
+            if not _has_value(current):
+                merged[key] = value
+                continue
+            delta = _confidence(value) - _confidence(current)
+            if delta > 0 or (delta == 0 and key in TRAILING_FIELDS):
+                merged[key] = value
+    return merged
+
+
+def parse_gemini_fields(resp_text: str) -> Dict[str, Union[dict, list, None]]:
+    """Разбирает ответ Gemini в словарь полей."""
     resp_text = (resp_text or "").strip()
     if not resp_text:
         logger.error("Gemini вернул пустой ответ!")
@@ -91,3 +219,117 @@ def extract_fields_with_bbox_gemini(blocks: List[dict]) -> Dict[str, Union[dict,
         logger.error(f"Gemini output parse error:\n{resp_text}")
         raise
     return fields
+
+
+def _chunk_cache_key(blocks: List[dict], fields: List[str]) -> str:
+    return make_cache_key(blocks, GEMINI_MODEL, PROMPT_VERSION, f"{PROMPT_MODE}|{','.join(fields)}")
+
+
+def _lookup_chunk(blocks: List[dict], fields: List[str]):
+    """Ключ кэша и ответ из кэша, а при промахе — промпт для Gemini (хэширование, SQLite, кодирование)."""
+    cache_key = _chunk_cache_key(blocks, fields)
+    cached = extraction_cache.get(cache_key)
+    if cached is not None:
+        logger.info("Fields taken from extraction cache: %s", list(cached.keys()))
+        return cache_key, cached, None
+    return cache_key, None, build_parsing_prompt(blocks, fields=fields)
+
+
+def _extract_chunk(blocks: List[dict], fields: List[str]) -> Dict[str, Union[dict, list, None]]:
+    cache_key, cached, prompt = _lookup_chunk(blocks, fields)
+    if cached is not None:
+        return cached
+    result = parse_gemini_fields(ask_gemini(prompt))
+    extraction_cache.set(cache_key, result)
+    return result
+
+
+async def _extract_chunk_async(blocks: List[dict], fields: List[str]) -> Dict[str, Union[dict, list, None]]:
+    cache_key, cached, prompt = await run_in_threadpool(_lookup_chunk, blocks, fields)
+    if cached is not None:
+        return cached
+    result = parse_gemini_fields(await ask_gemini_async(prompt))
+    await run_in_threadpool(extraction_cache.set, cache_key, result)
+    return result
+
+
+def extract_rule_fields(blocks: List[dict], table_regions: Optional[Dict[int, List[List[float]]]] = None):
+    """
+    Локальный проход правилами и поиском таблицы позиций перед Gemini.
+    Возвращает (поля от правил, поля, которые нужно спросить у Gemini, блоки для промпта).
+    Если таблица позиций найдена целиком (до строки итогов), ее спаны в промпт не попадают;
+    иначе позиции спрашиваются и у Gemini, а найденные правилами остаются запасным вариантом.
+    """
+    if EXTRACTION_MODE == "llm":
+        return {}, list(FIELDS_TO_EXTRACT), blocks
+    rule_fields = extract_fields_by_rules(blocks)
+    items, table_indices, complete = detect_line_items(blocks, table_regions)
+    llm_blocks = blocks
+    if items:
+        rule_fields["Descriptions"] = items
+    if items and complete:
+        excluded = set(table_indices)
+        llm_blocks = [b for i, b in enumerate(blocks) if i not in excluded]
+    if EXTRACTION_MODE == "rules":
+        return rule_fields, [], llm_blocks
+    confident = {k for k, v in rule_fields.items() if _confidence(v) >= RULES_MIN_CONFIDENCE}
+    if items and complete:
+        confident.update(LINE_ITEM_FIELDS)
+    missing = [f for f in FIELDS_TO_EXTRACT if f not in confident]
+    logger.info("Rules resolved %d field(s), asking Gemini for %d", len(confident), len(missing))
+    return rule_fields, missing, llm_blocks
+
+
+def combine_with_rules(llm_fields: Dict[str, Union[dict, list, None]], rule_fields: Dict[str, Union[dict, list]]):
+    """
+    Уверенные результаты правил имеют приоритет, остальные — запасной вариант, если Gemini не нашел поле.
+    Позиции полной таблицы у Gemini не спрашиваются (см. extract_rule_fields) и берутся от правил;
+    для неполной таблицы важнее позиции от Gemini, а найденные правилами — запасной вариант.
+    """
+    result = dict(llm_fields)
+    for key, value in rule_fields.items():
+        if _confidence(value) >= RULES_MIN_CONFIDENCE or not _has_value(result.get(key)):
+            result[key] = value
+    for key in FIELDS_TO_EXTRACT:
+        result.setdefault(key, None)
+    return result
+
+
+def extract_fields_with_bbox_gemini(
+    blocks: List[dict],
+    table_regions: Optional[Dict[int, List[List[float]]]] = None
+) -> Dict[str, Union[dict, list, None]]:
+    """
+    Для блока текста PDF вызывает Gemini, парсит JSON-ответ и возвращает словарь полей.
+    Поля со строгим форматом и таблица позиций сначала ищутся локально, длинные документы
+    извлекаются параллельно по группам страниц.
+    """
+    rule_fields, missing, llm_blocks = extract_rule_fields(blocks, table_regions)
+    if not missing:
+        return combine_with_rules({}, rule_fields)
+    chunks = plan_chunks(llm_blocks)
+    logger.info("Start extracting fields with Gemini (%d chunk(s))...", len(chunks))
+    if len(chunks) == 1:
+        return combine_with_rules(_extract_chunk(chunks[0], missing), rule_fields)
+    with ThreadPoolExecutor(max_workers=min(len(chunks), GEMINI_CONCURRENCY)) as pool:
+        results = list(pool.map(partial(_extract_chunk, fields=missing), chunks))
+    return combine_with_rules(merge_chunk_fields(results), rule_fields)
+
+
+async def extract_fields_with_bbox_gemini_async(
+    blocks: List[dict],
+    table_regions: Optional[Dict[int, List[List[float]]]] = None
+) -> Dict[str, Union[dict, list, None]]:
+    """
+    Асинхронная версия extract_fields_with_bbox_gemini (не занимает поток на время ответа LLM).
+    Правила, поиск таблицы, кодирование промптов и кэш (SQLite) работают в пуле потоков.
+    """
+    rule_fields, missing, llm_blocks = await run_in_threadpool(extract_rule_fields, blocks, table_regions)
+    if not missing:
+        return combine_with_rules({}, rule_fields)
+    chunks = await run_in_threadpool(plan_chunks, llm_blocks)
+    logger.info("Start extracting fields with Gemini (async, %d chunk(s))...", len(chunks))
+    if len(chunks) == 1:
+        return combine_with_rules(await _extract_chunk_async(chunks[0], missing), rule_fields)
+    results = await asyncio.gather(*(_extract_chunk_async(chunk, missing) for chunk in chunks))
+    return combine_with_rules(merge_chunk_fields(list(results)), rule_fields)
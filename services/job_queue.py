@@ -0,0 +1,291 @@
+import io
+import os
+import json
+import time
+import uuid
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Awaitable, Callable, Optional
+from fastapi import HTTPException
+from minio.error import S3Error
+from schemas.template import TemplateScenario, TemplateStatus
+from services.minio_service import minio_client, MINIO_BUCKET
+import logging_conf
+
+logger = logging_conf.logger.getChild("job_queue")
+
+TEMPLATE_WORKERS = int(os.getenv("TEMPLATE_WORKERS", "2"))
+TEMPLATE_QUEUE_MAX = int(os.getenv("TEMPLATE_QUEUE_MAX", "100"))
+SCENARIO_RETENTION = int(os.getenv("SCENARIO_RETENTION", "1000"))
+# 1 — состояние фоновых сценариев пишется в MinIO, и опрос /scenario/{id} работает на любом экземпляре API
+SCENARIO_PERSIST = os.getenv("SCENARIO_PERSIST", "1") == "1"
+SCENARIO_PREFIX = "scenarios/"
+
+# Статус сценария, пока выполняется шаг
+STEP_STATUS = {
+    "upload": TemplateStatus.uploaded,
+    "extract_fonts": TemplateStatus.parsing,
+    "process_pdf": TemplateStatus.parsing,
+    "parse_fields": TemplateStatus.gemini_processing,
+    "save_files": TemplateStatus.parsing,
+}
+
+
+def _now() -> str:
+    return datetime.utcnow().isoformat(timespec="milliseconds")
+
+
+def _error_text(e: Exception) -> str:
+    return str(e.detail if isinstance(e, HTTPException) else e) or e.__class__.__name__
+
+
+class ScenarioJob:
+    """Сценарий обработки шаблона: текущий шаг, лог шагов с временем и длительностью, итог."""
+
+    def __init__(self, tg_id: str, kind: str):
+        self.scenario_id = f"{tg_id}_{uuid.uuid4().hex}"
+        self.tg_id = tg_id
+        self.kind = kind
+        self.status = TemplateStatus.started
+        self.step: Optional[str] = None
+        self.error: Optional[str] = None
+        self.log = []
+        self._result: Optional[dict] = None
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        # Вызывается при каждом изменении состояния (сохранение в ScenarioStore)
+        self.on_change: Optional[Callable[["ScenarioJob"], None]] = None
+
+    @property
+    def result(self) -> Optional[dict]:
+        return self._result
+
+    @result.setter
+    def result(self, value: Optional[dict]):
+        self._result = value
+        self._changed()
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change(self)
+
+    def state(self) -> dict:
+        return {
+            "scenario_id": self.scenario_id, "tg_id": self.tg_id, "kind": self.kind,
+            "status": self.status.value, "step": self.step, "error": self.error, "log": self.log,
+            "result": self._result, "created_at": self.created_at, "finished_at": self.finished_at,
+        }
+
+    @classmethod
+    def from_state(cls, state: dict) -> "ScenarioJob":
+        job = cls.__new__(cls)
+        job.scenario_id, job.tg_id, job.kind = state["scenario_id"], state["tg_id"], state["kind"]
+        job.status = TemplateStatus(state["status"])
+        job.step, job.error, job.log = state.get("step"), state.get("error"), state.get("log") or []
+        job._result = state.get("result")
+        job.created_at, job.finished_at = state.get("created_at"), state.get("finished_at")
+        job.on_change = None
+        return job
+
+    @property
+    def done(self) -> bool:
+        return self.status in (TemplateStatus.finished, TemplateStatus.error)
+
+    @asynccontextmanager
+    async def step_context(self, name: str):
+        """Шаг сценария: запись в логе (step, status, started_at, finished_at, duration_sec, message)."""
+        entry = {"step": name, "status": "running", "started_at": _now(), "time": datetime.utcnow().strftime("%H:%M:%S")}
+        self.log.append(entry)
+        self.step = name
+        self.status = STEP_STATUS.get(name, TemplateStatus.parsing)
+        self._changed()
+        started = time.perf_counter()
+        try:
+            yield entry
+        except Exception as e:
+            entry["status"] = "error"
+            entry["error"] = _error_text(e)
+            raise
+        else:
+            entry["status"] = "done"
+        finally:
+            entry["finished_at"] = _now()
+            entry["duration_sec"] = round(time.perf_counter() - started, 3)
+            self._changed()
+
+    async def run_step(self, name: str, awaitable: Awaitable):
+        async with self.step_context(name):
+            return await awaitable
+
+    def finish(self):
+        self.status = TemplateStatus.finished
+        self.finished_at = time.time()
+        self._changed()
+
+    def fail(self, e: Exception):
+        self.status = TemplateStatus.error
+        self.error = _error_text(e)
+        self.finished_at = time.time()
+        self._changed()
+
+    def scenario(self) -> TemplateScenario:
+        return TemplateScenario(
+            scenario_id=self.scenario_id,
+            status=self.status,
+            step=self.step,
+            error_message=self.error[:256] if self.error else None,
+            log=[dict(entry) for entry in self.log]
+        )
+
+
+class ScenarioStore:
+    """
+    Состояние фоновых сценариев в MinIO (scenarios/<id>.json). Запись идет в одном фоновом потоке:
+    не блокирует event loop и сохраняет порядок изменений одного сценария.
+    """
+
+    def __init__(self, prefix: str = SCENARIO_PREFIX):
+        self.prefix = prefix
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="scenario-store")
+        self._counters = {"saved": 0, "loaded": 0, "failed": 0}
+
+    def _object(self, scenario_id: str) -> str:
+        return f"{self.prefix}{scenario_id}.json"
+
+    def save(self, job: ScenarioJob):
+        self._executor.submit(self._write, job.scenario_id, json.dumps(job.state(), ensure_ascii=False, default=str))
+
+    def _write(self, scenario_id: str, payload: str):
+        data = payload.encode("utf-8")
+        try:
+            minio_client.put_object(MINIO_BUCKET, self._object(scenario_id), io.BytesIO(data), len(data),
+                                    content_type="application/json")
+            self._counters["saved"] += 1
+        except Exception as e:
+            self._counters["failed"] += 1
+            logger.warning(f"Сценарий {scenario_id} не сохранен в MinIO: {e}")
+
+    def load(self, scenario_id: str) -> Optional[ScenarioJob]:
+        """Сценарий другого экземпляра API (вызывается из потока, не из event loop)."""
+        try:
+            response = minio_client.get_object(MINIO_BUCKET, self._object(scenario_id))
+            try:
+                state = json.loads(response.read())
+            finally:
+                response.close()
+                response.release_conn()
+        except S3Error as e:
+            if e.code not in ("NoSuchKey", "NoSuchObject"):
+                logger.warning(f"Сценарий {scenario_id} не прочитан из MinIO: {e}")
+            return None
+        except Exception as e:
+            logger.warning(f"Сценарий {scenario_id} не прочитан из MinIO: {e}")
+            return None
+        self._counters["loaded"] += 1
+        return ScenarioJob.from_state(state)
+
+    def delete(self, scenario_id: str):
+        def remove():
+            try:
+                minio_client.remove_object(MINIO_BUCKET, self._object(scenario_id))
+            except Exception as e:
+                logger.warning(f"Сценарий {scenario_id} не удален из MinIO: {e}")
+        self._executor.submit(remove)
+
+    def stats(self) -> dict:
+        return dict(self._counters)
+
+
+class JobQueue:
+    """
+    Очередь фоновой обработки шаблонов: ограниченная asyncio.Queue и пул воркеров в цикле событий API.
+    Сценарии хранятся в памяти (последние SCENARIO_RETENTION); фоновые еще и в store, чтобы прогресс
+    можно было опросить на другом экземпляре API. Без store опрос работает только на том же узле.
+    """
+
+    def __init__(self, workers: int = TEMPLATE_WORKERS, max_depth: int = TEMPLATE_QUEUE_MAX,
+                 retention: int = SCENARIO_RETENTION, store: Optional[ScenarioStore] = None):
+        self.workers = workers
+        self.max_depth = max_depth
+        self.retention = retention
+        self.store = store
+        self._jobs: "OrderedDict[str, ScenarioJob]" = OrderedDict()
+        self._queue: Optional[asyncio.Queue] = None
+        self._loop = None
+        self._tasks = []
+        self._running = 0
+        self._counters = {"submitted": 0, "finished": 0, "failed": 0, "rejected": 0}
+
+    def create(self, tg_id: str, kind: str) -> ScenarioJob:
+        job = ScenarioJob(tg_id, kind)
+        self._jobs[job.scenario_id] = job
+        while len(self._jobs) > self.retention:
+            oldest_id = next((sid for sid, j in self._jobs.items() if j.done), None)
+            if oldest_id is None:
+                break
+            oldest = self._jobs.pop(oldest_id)
+            if self.store is not None and oldest.on_change is not None:
+                self.store.delete(oldest_id)
+        return job
+
+    def get(self, scenario_id: str) -> Optional[ScenarioJob]:
+        job = self._jobs.get(scenario_id)
+        if job is None and self.store is not None:
+            job = self.store.load(scenario_id)
+        return job
+
+    def _ensure_workers(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        self._loop = loop
+        self._queue = asyncio.Queue(maxsize=self.max_depth)
+        self._tasks = [loop.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info(f"Запущено {self.workers} воркеров обработки шаблонов")
+
+    def submit(self, job: ScenarioJob, run: Callable[[], Awaitable]):
+        """Ставит сценарий в очередь; при переполнении — 503, чтобы бот повторил позже."""
+        self._ensure_workers()
+        try:
+            self._queue.put_nowait((job, run))
+        except asyncio.QueueFull:
+            self._counters["rejected"] += 1
+            job.fail(RuntimeError("queue is full"))
+            raise HTTPException(503, "Template queue is full, try again later")
+        self._counters["submitted"] += 1
+        if self.store is not None:
+            job.on_change = self.store.save
+            self.store.save(job)
+        logger.info(f"Сценарий {job.scenario_id} ({job.kind}) поставлен в очередь, глубина {self._queue.qsize()}")
+
+    async def _worker(self, num: int):
+        while True:
+            job, run = await self._queue.get()
+            self._running += 1
+            try:
+                await run()
+                self._counters["finished"] += 1
+            except Exception as e:
+                self._counters["failed"] += 1
+                if not job.done:
+                    job.fail(e)
+                logger.error(f"Сценарий {job.scenario_id} завершился ошибкой: {_error_text(e)}")
+            finally:
+                self._running -= 1
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        return {
+            **self._counters,
+            "queued": self._queue.qsize() if self._queue else 0,
+            "running": self._running,
+            "workers": self.workers,
+            "scenarios": len(self._jobs),
+            **({"store": self.store.stats()} if self.store is not None else {}),
+        }
+
+
+job_queue = JobQueue(store=ScenarioStore() if SCENARIO_PERSIST else None)
@@ -1,6 +1,14 @@
+import io
 import os
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
+from typing import List, Tuple, Dict, Optional, Union
+import urllib3
 from minio import Minio
+from minio.error import S3Error
 from fastapi import HTTPException
 import logging_conf
 
@@ -10,45 +18,181 @@ MINIO_ENDPOINT = os.getenv("MINIO_ENDPOINT", "localhost:9000")
 MINIO_ACCESS_KEY = os.getenv("MINIO_ACCESS_KEY", "minioadmin")
 MINIO_SECRET_KEY = os.getenv("MINIO_SECRET_KEY", "minioadmin")
 MINIO_BUCKET = os.getenv("MINIO_BUCKET", "invoices")
+MINIO_UPLOAD_CONCURRENCY = int(os.getenv("MINIO_UPLOAD_CONCURRENCY", "4"))
+MINIO_MAX_CONNECTIONS = int(os.getenv("MINIO_MAX_CONNECTIONS", "16"))
+
+# Метаданные объекта с SHA-256 содержимого: по ним пропускаются повторные загрузки
+SHA256_META = "sha256"
 
 minio_client = Minio(
     MINIO_ENDPOINT,
     access_key=MINIO_ACCESS_KEY,
     secret_key=MINIO_SECRET_KEY,
-    secure=False
+    secure=False,
+    http_client=urllib3.PoolManager(
+        timeout=urllib3.Timeout(connect=5, read=60),
+        maxsize=MINIO_MAX_CONNECTIONS,
+        retries=urllib3.Retry(total=3, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504])
+    )
 )
 
+_upload_executor = ThreadPoolExecutor(max_workers=MINIO_UPLOAD_CONCURRENCY, thread_name_prefix="minio-upload")
+_upload_lock = threading.Lock()
+_upload_counters = {"uploaded": 0, "skipped": 0, "failed": 0, "bytes_uploaded": 0, "bytes_skipped": 0}
 
-def minio_upload(local_path: str, object_name: str, content_type: str = "application/octet-stream") -> str:
-    """Загрузка файла в MinIO и возврат публичного URL (если бакет публичный)"""
-    logger.info(f"Uploading {local_path} as {object_name} [{content_type}] в бакет {MINIO_BUCKET}")
+
+def object_url(object_name: str) -> str:
+    return f"http://{MINIO_ENDPOINT}/{MINIO_BUCKET}/{object_name}"
+
+
+def _file_sha256(local_path: str) -> Tuple[str, int]:
+    h = hashlib.sha256()
+    size = 0
+    with open(local_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+            size += len(chunk)
+    return h.hexdigest(), size
+
+
+def _stored_sha256(object_name: str) -> Optional[str]:
     try:
+        stat = minio_client.stat_object(MINIO_BUCKET, object_name)
+    except S3Error as e:
+        if e.code in ("NoSuchKey", "NoSuchObject", "ResourceNotFound"):
+            return None
+        raise
+    return (stat.metadata or {}).get(f"x-amz-meta-{SHA256_META}")
+
+
+def _upload_one(source: Union[str, bytes], object_name: str, content_type: str, skip_unchanged: bool) -> dict:
+    started = time.perf_counter()
+    if isinstance(source, bytes):
+        digest, size = hashlib.sha256(source).hexdigest(), len(source)
+    else:
+        digest, size = _file_sha256(source)
+    skipped = skip_unchanged and _stored_sha256(object_name) == digest
+    if not skipped and isinstance(source, bytes):
+        minio_client.put_object(
+            MINIO_BUCKET,
+            object_name,
+            io.BytesIO(source),
+            size,
+            content_type=content_type,
+            metadata={SHA256_META: digest}
+        )
+    elif not skipped:
         minio_client.fput_object(
             MINIO_BUCKET,
             object_name,
-            local_path,
-            content_type=content_type
+            source,
+            content_type=content_type,
+            metadata={SHA256_META: digest}
         )
+    elapsed = round(time.perf_counter() - started, 4)
+    with _upload_lock:
+        _upload_counters["skipped" if skipped else "uploaded"] += 1
+        _upload_counters["bytes_skipped" if skipped else "bytes_uploaded"] += size
+    return {
+        "object_name": object_name,
+        "url": object_url(object_name),
+        "sha256": digest,
+        "size": size,
+        "skipped": skipped,
+        "seconds": elapsed,
+    }
+
+
+def minio_upload(local_path: str, object_name: str, content_type: str = "application/octet-stream") -> str:
+    """Загрузка файла в MinIO и возврат публичного URL (если бакет публичный)"""
+    logger.info(f"Uploading {local_path} as {object_name} [{content_type}] в бакет {MINIO_BUCKET}")
+    try:
+        _upload_one(local_path, object_name, content_type, skip_unchanged=False)
         logger.info(f"Файл {object_name} успешно загружен в MinIO")
     except Exception as e:
+        with _upload_lock:
+            _upload_counters["failed"] += 1
         logger.error(f"MinIO upload error for {object_name}: {e}", exc_info=True)
         raise HTTPException(500, detail=f"MinIO upload error: {e}")
-    return f"http://{MINIO_ENDPOINT}/{MINIO_BUCKET}/{object_name}"
+    return object_url(object_name)
+
+
+def minio_upload_batch(items: List[Tuple[Union[str, bytes], str, str]], skip_unchanged: bool = True) -> Dict[str, dict]:
+    """
+    Параллельная загрузка набора файлов [(local_path или байты, object_name, content_type)].
+    Объекты, у которых SHA-256 в метаданных совпадает с локальным файлом, не перезаливаются.
+    Возвращает {object_name: {url, sha256, size, skipped, seconds}}; при ошибке — HTTPException 500.
+    """
+    started = time.perf_counter()
+    futures = {
+        object_name: _upload_executor.submit(_upload_one, source, object_name, content_type, skip_unchanged)
+        for source, object_name, content_type in items
+    }
+    results: Dict[str, dict] = {}
+    errors = []
+    for object_name, future in futures.items():
+        try:
+            results[object_name] = future.result()
+        except Exception as e:
+            with _upload_lock:
+                _upload_counters["failed"] += 1
+            logger.error(f"MinIO upload error for {object_name}: {e}", exc_info=True)
+            errors.append(f"{object_name}: {e}")
+    for object_name, r in results.items():
+        logger.info(
+            f"MinIO {object_name}: {'без изменений, пропущен' if r['skipped'] else 'загружен'} "
+            f"({r['size']} байт, {r['seconds']} с)"
+        )
+    logger.info(f"Пакетная загрузка {len(items)} объектов за {time.perf_counter() - started:.3f} с")
+    if errors:
+        raise HTTPException(500, detail=f"MinIO upload error: {'; '.join(errors)}")
+    return results
+
+
+def open_object_stream(object_name: str, chunk_size: int = 256 * 1024):
+    """
+    Открывает объект MinIO для потоковой отдачи: (итератор кусков, размер).
+    Ошибки (нет объекта — 404) возникают здесь, до начала ответа.
+    """
+    try:
+        response = minio_client.get_object(MINIO_BUCKET, object_name)
+    except S3Error as e:
+        if e.code in ("NoSuchKey", "NoSuchObject", "ResourceNotFound"):
+            raise HTTPException(404, "File not found")
+        logger.error(f"Ошибка чтения {object_name} из MinIO: {e}")
+        raise HTTPException(500, f"MinIO error: {e}")
+
+    def chunks():
+        try:
+            yield from response.stream(chunk_size)
+        finally:
+            response.close()
+            response.release_conn()
+
+    size = response.headers.get("content-length")
+    return chunks(), int(size) if size else None
+
+
+def upload_stats() -> dict:
+    with _upload_lock:
+        return dict(_upload_counters)
 
 
 def get_presigned_url(
     tg_id: str,
     filename: str,
-    expires: int = 300
+    expires: int = 300,
+    object_name: Optional[str] = None
 ) -> str:
-    """Генерация presigned-ссылки на объект в MinIO"""
-    object_name = f"{tg_id}/{filename}"
+    """Генерация presigned-ссылки на объект в MinIO (object_name — ключ блоба, если файл в хранилище блобов)"""
+    object_name = object_name or f"{tg_id}/{filename}"
     logger.info(f"Генерирую presigned URL для {object_name}, expires={expires}")
     try:
         url = minio_client.presigned_get_object(
             MINIO_BUCKET,
             object_name,
-            expires=timedelta(seconds=expires)
+            expires=timedelta(seconds=expires),
+            response_headers={"response-content-disposition": f'attachment; filename="{filename}"'}
         )
         logger.info(f"Presigned URL успешно сгенерирован для {object_name}")
     except Exception as e:
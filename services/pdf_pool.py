@@ -0,0 +1,242 @@
+import os
+import time
+import asyncio
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, Optional, Tuple
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+import logging_conf
+
+logger = logging_conf.logger.getChild("pdf_pool")
+
+PDF_POOL_WORKERS = int(os.getenv("PDF_POOL_WORKERS", str(min(4, os.cpu_count() or 1))))
+PDF_POOL_MAX_TASKS = int(os.getenv("PDF_POOL_MAX_TASKS", "200"))
+PDF_TASK_TIMEOUT_SEC = float(os.getenv("PDF_TASK_TIMEOUT_SEC", "60"))
+# Как часто ожидающий поток проверяет, не превысила ли начавшаяся задача таймаут
+_POLL_SEC = 0.1
+
+
+_events = None
+
+
+def _warm_worker(events):
+    """
+    Запоминает очередь событий пула (через нее задачи сообщают о старте) и импортирует PyMuPDF
+    и утилиты, чтобы первая задача не платила за импорт.
+    """
+    global _events
+    _events = events
+    import fitz  # noqa: F401
+    import utils.pdf  # noqa: F401
+
+
+def _run_task(task_id: int, fn: Callable, *args):
+    """Задача в рабочем процессе: сначала сообщает пулу, в каком процессе и когда она началась."""
+    _events.put((task_id, os.getpid(), time.time()))
+    return fn(*args)
+
+
+class _TaskTimeout(Exception):
+    def __init__(self, pid: int):
+        self.pid = pid
+
+
+class PdfProcessPool:
+    """
+    Пул рабочих процессов для CPU-тяжелой работы PyMuPDF (разбор, рендер), вне GIL процесса API.
+    Задачи получают и возвращают байты и простые структуры. Процесс перезапускается после
+    max_tasks задач. Таймаут отсчитывается с начала выполнения задачи в процессе (ожидание
+    в очереди не считается); зависшая задача убивает свой процесс, пул пересоздается, а остальные
+    задачи сломанного пула повторяются в новом. При workers=0 задачи выполняются в вызывающем потоке.
+    """
+
+    def __init__(self, workers: int = PDF_POOL_WORKERS, max_tasks: int = PDF_POOL_MAX_TASKS,
+                 timeout: float = PDF_TASK_TIMEOUT_SEC):
+        self.workers = workers
+        self.max_tasks = max_tasks
+        self.timeout = timeout
+        self._executor: Optional[ProcessPoolExecutor] = None
+        # Очередь событий старта задач каждого пула и уже полученные (task_id -> (pid, время старта))
+        self._events: Dict[ProcessPoolExecutor, object] = {}
+        self._started: Dict[int, Tuple[int, float]] = {}
+        self._task_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._counters = {"submitted": 0, "completed": 0, "failed": 0, "timeouts": 0, "restarts": 0, "retried": 0}
+        self._busy_sec = 0.0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                context = multiprocessing.get_context("spawn")
+                events = context.SimpleQueue()
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=context,
+                    initializer=_warm_worker,
+                    initargs=(events,),
+                    max_tasks_per_child=self.max_tasks or None
+                )
+                self._events[self._executor] = events
+                logger.info(f"Запущен пул PDF-процессов: {self.workers} воркеров")
+            return self._executor
+
+    def _submit(self, executor: ProcessPoolExecutor, fn: Callable, args) -> Tuple[int, Future]:
+        task_id = next(self._task_ids)
+        return task_id, executor.submit(_run_task, task_id, fn, *args)
+
+    def _overdue(self, executor: ProcessPoolExecutor, task_id: int, timeout: float) -> Optional[int]:
+        """PID процесса, если задача выполняется дольше timeout; пока она ждет в очереди — None."""
+        with self._lock:
+            events = self._events.get(executor)
+            while events is not None and not events.empty():
+                started_id, pid, started_at = events.get()
+                self._started[started_id] = (pid, started_at)
+            started = self._started.get(task_id)
+        if started is not None and time.time() - started[1] > timeout:
+            return started[0]
+        return None
+
+    def _forget(self, task_id: int):
+        with self._lock:
+            self._started.pop(task_id, None)
+
+    def _discard(self, executor: ProcessPoolExecutor) -> bool:
+        """Сбрасывает сломанный пул; новые задачи пойдут в новый. Очередь не отменяется."""
+        with self._lock:
+            if self._executor is not executor:
+                return False
+            self._executor = None
+            self._events.pop(executor, None)
+            self._counters["restarts"] += 1
+        executor.shutdown(wait=False)
+        return True
+
+    def _kill(self, executor: ProcessPoolExecutor, pid: int):
+        """
+        Зависшую задачу иначе не остановить: завершается только ее процесс. Пул после этого
+        сломан — его остальные задачи получают BrokenProcessPool и повторяются в новом пуле.
+        """
+        self._discard(executor)
+        for process in multiprocessing.active_children():
+            if process.pid == pid:
+                process.terminate()
+        logger.warning(f"Задача в PDF-процессе {pid} превысила таймаут, процесс остановлен")
+
+    def _start(self) -> float:
+        with self._lock:
+            self._in_flight += 1
+            self._counters["submitted"] += 1
+        return time.perf_counter()
+
+    def _finish(self, started: float, ok: bool, timed_out: bool = False):
+        with self._lock:
+            self._in_flight -= 1
+            self._busy_sec += time.perf_counter() - started
+            self._counters["completed" if ok else "failed"] += 1
+            if timed_out:
+                self._counters["timeouts"] += 1
+
+    def _wait(self, executor: ProcessPoolExecutor, task_id: int, future: Future, timeout: float):
+        while True:
+            try:
+                return future.result(timeout=_POLL_SEC)
+            except FutureTimeout:
+                pid = self._overdue(executor, task_id, timeout)
+                if pid is not None:
+                    raise _TaskTimeout(pid)
+
+    async def _wait_async(self, executor: ProcessPoolExecutor, task_id: int, future: Future, timeout: float):
+        wrapped = asyncio.wrap_future(future)
+        while True:
+            done, _ = await asyncio.wait({wrapped}, timeout=_POLL_SEC)
+            if done:
+                return wrapped.result()
+            pid = self._overdue(executor, task_id, timeout)
+            if pid is not None:
+                wrapped.cancel()
+                raise _TaskTimeout(pid)
+
+    def run(self, fn: Callable, *args, timeout: Optional[float] = None, retry: bool = True):
+        """Синхронный вызов (из потоков FastAPI): результат fn(*args) из рабочего процесса."""
+        if self.workers <= 0:
+            return fn(*args)
+        executor = self._get_executor()
+        started = self._start()
+        task_id, future = self._submit(executor, fn, args)
+        try:
+            result = self._wait(executor, task_id, future, timeout or self.timeout)
+        except _TaskTimeout as e:
+            self._finish(started, False, timed_out=True)
+            self._kill(executor, e.pid)
+            raise HTTPException(504, f"PDF task {fn.__name__} timed out")
+        except BrokenProcessPool:
+            self._finish(started, False)
+            self._discard(executor)
+            if retry:
+                self._count_retry()
+                return self.run(fn, *args, timeout=timeout, retry=False)
+            raise HTTPException(503, "PDF worker pool is unavailable")
+        except Exception:
+            self._finish(started, False)
+            raise
+        finally:
+            self._forget(task_id)
+        self._finish(started, True)
+        return result
+
+    async def run_async(self, fn: Callable, *args, timeout: Optional[float] = None, retry: bool = True):
+        """То же для async-кода: ожидание без блокировки цикла событий."""
+        if self.workers <= 0:
+            return await run_in_threadpool(fn, *args)
+        executor = self._get_executor()
+        started = self._start()
+        task_id, future = self._submit(executor, fn, args)
+        try:
+            result = await self._wait_async(executor, task_id, future, timeout or self.timeout)
+        except _TaskTimeout as e:
+            self._finish(started, False, timed_out=True)
+            self._kill(executor, e.pid)
+            raise HTTPException(504, f"PDF task {fn.__name__} timed out")
+        except BrokenProcessPool:
+            self._finish(started, False)
+            self._discard(executor)
+            if retry:
+                self._count_retry()
+                return await self.run_async(fn, *args, timeout=timeout, retry=False)
+            raise HTTPException(503, "PDF worker pool is unavailable")
+        except (Exception, asyncio.CancelledError):
+            self._finish(started, False)
+            raise
+        finally:
+            self._forget(task_id)
+        self._finish(started, True)
+        return result
+
+    def _count_retry(self):
+        with self._lock:
+            self._counters["retried"] += 1
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+            self._events.pop(executor, None)
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                **self._counters,
+                "workers": self.workers,
+                "in_flight": self._in_flight,
+                "queued": max(0, self._in_flight - self.workers),
+                "busy_sec": round(self._busy_sec, 3),
+            }
+
+
+pdf_pool = PdfProcessPool()
@@ -0,0 +1,77 @@
+import time
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+import logging_conf
+
+logger = logging_conf.logger.getChild("render_flight")
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class RenderFlight:
+    """
+    Рендеры одного шаблона выполняются по очереди (блокировка на шаблон), а одинаковые
+    запросы (тот же шаблон и те же значения, например двойное нажатие «Подтвердить»)
+    не рендерятся повторно: ждут выполняющийся и получают его результат.
+    """
+
+    def __init__(self):
+        self._guard = threading.Lock()
+        self._locks: Dict[Hashable, threading.Lock] = {}
+        self._flights: Dict[Tuple[Hashable, str], _Flight] = {}
+        self._counters = {"runs": 0, "coalesced": 0, "failed": 0, "lock_wait_sec": 0.0}
+
+    def _lock_for(self, template_id: Hashable) -> threading.Lock:
+        with self._guard:
+            return self._locks.setdefault(template_id, threading.Lock())
+
+    def run(self, template_id: Hashable, key: str, fn: Callable[[], Any]) -> Any:
+        flight_key = (template_id, key)
+        with self._guard:
+            flight = self._flights.get(flight_key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[flight_key] = _Flight()
+            else:
+                self._counters["coalesced"] += 1
+        if not leader:
+            logger.info(f"Шаблон {template_id}: такой же рендер уже выполняется, ждем его результат")
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            started = time.perf_counter()
+            with self._lock_for(template_id):
+                waited = time.perf_counter() - started
+                flight.result = fn()
+            with self._guard:
+                self._counters["runs"] += 1
+                self._counters["lock_wait_sec"] += waited
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            with self._guard:
+                self._counters["failed"] += 1
+            raise
+        finally:
+            with self._guard:
+                self._flights.pop(flight_key, None)
+            flight.done.set()
+
+    def stats(self) -> dict:
+        with self._guard:
+            return {
+                **self._counters,
+                "lock_wait_sec": round(self._counters["lock_wait_sec"], 4),
+                "in_flight": len(self._flights),
+            }
+
+
+render_flight = RenderFlight()
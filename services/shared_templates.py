@@ -0,0 +1,228 @@
+import os
+import io
+import json
+import time
+import hashlib
+import threading
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+from minio.error import S3Error
+from fastapi import HTTPException
+from utils.pdf import parse_pdf_bytes, analyze_template_data
+from utils.ingest import write_bytes_atomic
+from services.pdf_pool import pdf_pool
+from services.minio_service import minio_client, MINIO_BUCKET
+from services.gemini_service import extract_fields_with_bbox_gemini
+from services.template_catalog import template_catalog
+import logging_conf
+
+logger = logging_conf.logger.getChild("shared_templates")
+
+SHARED_ARTIFACTS_DIR = os.getenv("SHARED_ARTIFACTS_DIR", os.path.join("cache", "shared_templates"))
+SHARED_ARTIFACTS_PREBUILD = os.getenv("SHARED_ARTIFACTS_PREBUILD", "0") == "1"
+
+ARTIFACTS_SUFFIX = ".artifacts.json"
+# Меняется при изменении формата артефактов: старые пересобираются
+ARTIFACTS_VERSION = 1
+SOURCE_ETAG_META = "source-etag"
+
+_MISSING_CODES = ("NoSuchKey", "NoSuchObject", "ResourceNotFound")
+
+
+def _artifacts_object(object_name: str) -> str:
+    return f"{object_name}{ARTIFACTS_SUFFIX}"
+
+
+class SharedTemplateStore:
+    """
+    Готовые результаты разбора общих шаблонов (templates/*): шрифты, спаны, поля Gemini.
+    Ключ — ETag объекта в MinIO: артефакты строятся один раз на версию шаблона и лежат
+    рядом с ним в MinIO (<object>.artifacts.json) и в локальном кэше вместе с исходником.
+    """
+
+    def __init__(self, cache_dir: str = SHARED_ARTIFACTS_DIR):
+        self.cache_dir = cache_dir
+        self._memory: Dict[str, dict] = {}
+        self._by_sha: Dict[str, dict] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+        self._counters = {"memory_hits": 0, "local_hits": 0, "minio_hits": 0, "builds": 0, "build_sec": 0.0}
+
+    def _lock_for(self, object_name: str) -> threading.Lock:
+        with self._locks_guard:
+            return self._locks.setdefault(object_name, threading.Lock())
+
+    @staticmethod
+    def _key(object_name: str) -> str:
+        return hashlib.sha256(object_name.encode("utf-8")).hexdigest()[:16]
+
+    def _local_base(self, object_name: str, etag: str) -> str:
+        return os.path.join(self.cache_dir, f"{self._key(object_name)}_{etag}")
+
+    def source_path(self, object_name: str, etag: str) -> str:
+        return self._local_base(object_name, etag) + os.path.splitext(object_name)[1].lower()
+
+    def _drop_stale(self, object_name: str, etag: str):
+        """Удаляет локальные файлы прежних версий шаблона."""
+        prefix = f"{self._key(object_name)}_"
+        current = f"{prefix}{etag}"
+        for name in os.listdir(self.cache_dir):
+            if name.startswith(prefix) and not name.startswith(current):
+                try:
+                    os.unlink(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+
+    def current_etag(self, object_name: str) -> str:
+        try:
+            stat = minio_client.stat_object(MINIO_BUCKET, object_name)
+        except S3Error as e:
+            if e.code in _MISSING_CODES:
+                template_catalog.invalidate()
+                raise HTTPException(404, f"Template {object_name} not found")
+            raise HTTPException(500, f"MinIO error: {e}")
+        return stat.etag.strip('"')
+
+    def fetch_source(self, object_name: str) -> Tuple[str, str]:
+        """(локальный путь исходника, ETag); скачивается из MinIO только при новой версии."""
+        etag = self.current_etag(object_name)
+        path = self.source_path(object_name, etag)
+        with self._lock_for(object_name):
+            if os.path.exists(path):
+                return path, etag
+            os.makedirs(self.cache_dir, exist_ok=True)
+            try:
+                # If-Match: версия в кэше гарантированно соответствует ETag в имени файла
+                response = minio_client.get_object(
+                    MINIO_BUCKET, object_name, request_headers={"If-Match": f'"{etag}"'}
+                )
+                try:
+                    data = response.read()
+                finally:
+                    response.close()
+                    response.release_conn()
+            except S3Error as e:
+                logger.error(f"Ошибка скачивания шаблона {object_name}: {e}")
+                raise HTTPException(500, f"MinIO download error: {e}")
+            write_bytes_atomic(path, data)
+            self._drop_stale(object_name, etag)
+            logger.info(f"Общий шаблон {object_name} (etag {etag}) сохранен в {path}")
+        return path, etag
+
+    def _load_local(self, object_name: str, etag: str) -> Optional[dict]:
+        try:
+            with open(self._local_base(object_name, etag) + ".json", encoding="utf-8") as f:
+                artifacts = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return artifacts if self._valid(artifacts, etag) else None
+
+    def _load_minio(self, object_name: str, etag: str) -> Optional[dict]:
+        try:
+            response = minio_client.get_object(MINIO_BUCKET, _artifacts_object(object_name))
+            try:
+                artifacts = json.loads(response.read())
+            finally:
+                response.close()
+                response.release_conn()
+        except S3Error as e:
+            if e.code not in _MISSING_CODES:
+                logger.warning(f"Не удалось прочитать артефакты {object_name} из MinIO: {e}")
+            return None
+        except ValueError:
+            return None
+        return artifacts if self._valid(artifacts, etag) else None
+
+    @staticmethod
+    def _valid(artifacts: dict, etag: str) -> bool:
+        return artifacts.get("version") == ARTIFACTS_VERSION and artifacts.get("etag") == etag
+
+    def _build(self, object_name: str, etag: str, path: str) -> dict:
+        started = time.perf_counter()
+        with open(path, "rb") as f:
+            data = f.read()
+        ext = os.path.splitext(path)[1]
+        analysis = pdf_pool.run(analyze_template_data, data, ext)
+        parsed_data = extract_fields_with_bbox_gemini(analysis["blocks"], analysis["table_regions"])
+        artifacts = {
+            "version": ARTIFACTS_VERSION,
+            "object_name": object_name,
+            "etag": etag,
+            "sha256": analysis["sha256"],
+            "fonts": list(analysis["fonts"]),
+            "parsed_data": parsed_data,
+            "parsed": pdf_pool.run(parse_pdf_bytes, data) if ext.lower() == ".pdf" else None,
+            "built_at": datetime.utcnow().isoformat(timespec="seconds"),
+        }
+        body = json.dumps(artifacts, ensure_ascii=False).encode("utf-8")
+        try:
+            minio_client.put_object(
+                MINIO_BUCKET, _artifacts_object(object_name), io.BytesIO(body), len(body),
+                content_type="application/json", metadata={SOURCE_ETAG_META: etag}
+            )
+        except S3Error as e:
+            # Артефакты останутся в локальном кэше; другие инстансы соберут их сами
+            logger.warning(f"Не удалось сохранить артефакты {object_name} в MinIO: {e}")
+        elapsed = time.perf_counter() - started
+        self._counters["builds"] += 1
+        self._counters["build_sec"] += elapsed
+        logger.info(f"Артефакты общего шаблона {object_name} (etag {etag}) построены за {elapsed:.2f} с")
+        return artifacts
+
+    def artifacts(self, object_name: str, etag: str, path: str) -> Tuple[dict, str]:
+        """
+        Артефакты версии etag и откуда они взяты: memory, local, minio или build.
+        Параллельные запросы одного шаблона ждут одну сборку.
+        """
+        with self._lock_for(object_name):
+            cached = self._memory.get(object_name)
+            if cached is not None and cached["etag"] == etag:
+                self._counters["memory_hits"] += 1
+                return cached, "memory"
+            source = "local"
+            artifacts = self._load_local(object_name, etag)
+            if artifacts is None:
+                source = "minio"
+                artifacts = self._load_minio(object_name, etag)
+            if artifacts is None:
+                source = "build"
+                artifacts = self._build(object_name, etag, path)
+            else:
+                self._counters[f"{source}_hits"] += 1
+            if source != "local":
+                write_bytes_atomic(
+                    self._local_base(object_name, etag) + ".json",
+                    json.dumps(artifacts, ensure_ascii=False).encode("utf-8")
+                )
+            if cached is not None:
+                self._by_sha.pop(cached["sha256"], None)
+            self._memory[object_name] = artifacts
+            self._by_sha[artifacts["sha256"]] = artifacts
+            return artifacts, source
+
+    def parsed_for(self, sha256: Optional[str]) -> Optional[dict]:
+        """Готовый разбор PDF (спаны, блоки) по хэшу содержимого, если это известный общий шаблон."""
+        artifacts = self._by_sha.get(sha256) if sha256 else None
+        return artifacts.get("parsed") if artifacts else None
+
+    def prebuild(self, object_name: str) -> dict:
+        path, etag = self.fetch_source(object_name)
+        return self.artifacts(object_name, etag, path)[0]
+
+    def prebuild_all(self):
+        """Сборка артефактов для всех общих шаблонов (при старте, если SHARED_ARTIFACTS_PREBUILD=1)."""
+        for entry in template_catalog.entries():
+            try:
+                self.prebuild(entry["object_name"])
+            except Exception as e:
+                logger.error(f"Артефакты {entry['object_name']} не построены: {getattr(e, 'detail', e)}")
+
+    def stats(self) -> dict:
+        return {
+            **self._counters,
+            "build_sec": round(self._counters["build_sec"], 3),
+            "templates": len(self._memory),
+        }
+
+
+shared_templates = SharedTemplateStore()
@@ -0,0 +1,133 @@
+import os
+import time
+import hashlib
+import threading
+from typing import List, Optional
+from minio.error import S3Error
+from fastapi import HTTPException
+from services.minio_service import minio_client, MINIO_BUCKET
+import logging_conf
+
+logger = logging_conf.logger.getChild("template_catalog")
+
+TEMPLATE_CATALOG_TTL_SEC = float(os.getenv("TEMPLATE_CATALOG_TTL_SEC", "300"))
+# Неизвестный id перечитывает каталог не чаще раза в этот интервал
+CATALOG_MISS_REFRESH_SEC = 5.0
+TEMPLATE_PAGE_SIZE = 10
+TEMPLATE_PAGE_SIZE_MAX = 100
+
+TEMPLATES_PREFIX = "templates/"
+TEMPLATE_EXTENSIONS = (".pdf", ".docx")
+
+
+def template_id_for(object_name: str) -> str:
+    """Стабильный id шаблона: не зависит от позиции в списке и одинаков на всех инстансах."""
+    return hashlib.sha256(object_name.encode("utf-8")).hexdigest()[:12]
+
+
+class TemplateCatalog:
+    """
+    Каталог общих шаблонов (templates/* в MinIO) в памяти: список объектов запрашивается
+    не чаще раза в ttl секунд или после invalidate(). Версия каталога — хэш имен и ETag
+    объектов, по ней отдаются условные ответы (ETag / If-None-Match).
+    """
+
+    def __init__(self, ttl: float = TEMPLATE_CATALOG_TTL_SEC):
+        self.ttl = ttl
+        self._entries: List[dict] = []
+        self._by_id = {}
+        self._version = ""
+        self._loaded_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "refreshes": 0, "invalidations": 0, "refresh_sec": 0.0}
+
+    def _fresh(self) -> bool:
+        return self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    def _refresh(self):
+        started = time.perf_counter()
+        entries = []
+        try:
+            for obj in minio_client.list_objects(MINIO_BUCKET, prefix=TEMPLATES_PREFIX, recursive=True):
+                if obj.object_name.lower().endswith(TEMPLATE_EXTENSIONS):
+                    entries.append({
+                        "template_id": template_id_for(obj.object_name),
+                        "template_name": os.path.basename(obj.object_name),
+                        "object_name": obj.object_name,
+                        "size": obj.size,
+                        "etag": (obj.etag or "").strip('"'),
+                    })
+        except S3Error as e:
+            logger.error(f"Ошибка получения шаблонов из MinIO: {e}")
+            raise HTTPException(500, f"MinIO error: {e}")
+        entries.sort(key=lambda e: (e["template_name"].lower(), e["object_name"]))
+        version = hashlib.sha256(
+            "\n".join(f"{e['object_name']}\t{e['etag']}" for e in entries).encode("utf-8")
+        ).hexdigest()[:16]
+        self._entries = entries
+        self._by_id = {e["template_id"]: e for e in entries}
+        self._version = version
+        self._loaded_at = time.monotonic()
+        elapsed = time.perf_counter() - started
+        self._counters["refreshes"] += 1
+        self._counters["refresh_sec"] += elapsed
+        logger.info(f"Каталог шаблонов обновлен: {len(entries)} шт. за {elapsed:.3f} с, версия {version}")
+
+    def _ensure(self):
+        with self._lock:
+            if self._fresh():
+                self._counters["hits"] += 1
+            else:
+                self._refresh()
+
+    def page(self, page: int = 1, page_size: int = TEMPLATE_PAGE_SIZE) -> dict:
+        self._ensure()
+        entries, version = self._entries, self._version
+        start = (page - 1) * page_size
+        return {
+            "templates": [
+                {k: e[k] for k in ("template_id", "template_name", "object_name")}
+                for e in entries[start:start + page_size]
+            ],
+            "total": len(entries),
+            "page": page,
+            "page_size": page_size,
+            "pages": (len(entries) + page_size - 1) // page_size,
+            "version": version,
+        }
+
+    def entries(self) -> List[dict]:
+        self._ensure()
+        return list(self._entries)
+
+    def version(self) -> str:
+        self._ensure()
+        return self._version
+
+    def get(self, template_id: str) -> Optional[dict]:
+        """Шаблон по id; неизвестный id перечитывает каталог один раз (мог появиться после кэширования)."""
+        self._ensure()
+        entry = self._by_id.get(template_id)
+        if entry is None:
+            with self._lock:
+                if self._loaded_at is None or time.monotonic() - self._loaded_at >= CATALOG_MISS_REFRESH_SEC:
+                    self._refresh()
+            entry = self._by_id.get(template_id)
+        return entry
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+            self._counters["invalidations"] += 1
+        logger.info("Каталог шаблонов сброшен")
+
+    def stats(self) -> dict:
+        return {
+            **self._counters,
+            "refresh_sec": round(self._counters["refresh_sec"], 3),
+            "templates": len(self._entries),
+            "version": self._version,
+        }
+
+
+template_catalog = TemplateCatalog()
@@ -1,26 +1,42 @@
 import os
+import json
+import asyncio
+import hashlib
 from datetime import datetime
-from minio.error import S3Error
+from typing import Optional
 from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
 from sqlalchemy.orm import Session
+from fastapi.concurrency import run_in_threadpool
 from schemas.template import (
     RegisterUserRequest, TemplateUploadResponse, TemplateUpdateRequest, ConfirmTemplateResponse,
-    LatestTemplateResponse, UpdateTemplateResponse, FontUploadResponse, TemplateScenario, TemplateStatus
+    LatestTemplateResponse, UpdateTemplateResponse, FontUploadResponse, TemplateScenario, TemplateStatus,
+    ScenarioStatusResponse
 )
-from models.db import User, Template
+from models.db import User, Template, Blob, SessionLocal
 from utils.pdf import (
-    extract_fonts_from_pdf, extract_fonts_from_docx,
-    save_extracted_fonts_list, save_parsed_data_json, extract_blocks_from_pdf, process_invoice_and_replace
+    save_extracted_fonts_list, save_parsed_data_json, analyze_template_file, analyze_template_data,
+    collect_editable_fields, build_replacements, plan_replacement_ops, draw_replacements
 )
+from utils.ingest import read_upload, UploadTooLarge
 from utils.font_map import build_font_map
-from services.minio_service import minio_upload, minio_client, MINIO_BUCKET
-from services.gemini_service import extract_fields_with_bbox_gemini
+from services.document_pool import document_pool
+from services.pdf_pool import pdf_pool
+from services.job_queue import job_queue, ScenarioJob
+from services.shared_templates import shared_templates
+from services.blob_store import blob_store, UPLOAD_DIR
+from services.render_flight import render_flight
+from services.edit_coalescer import edit_coalescer, EditSuperseded
+from services.template_catalog import template_catalog, TEMPLATES_PREFIX, TEMPLATE_PAGE_SIZE
+from services.minio_service import minio_upload_batch, object_url
+from services.gemini_service import extract_fields_with_bbox_gemini, extract_fields_with_bbox_gemini_async
 
 import logging_conf
 logger = logging_conf.logger.getChild("template_service")
 
-UPLOAD_DIR = "uploads"
 MAX_TEMPLATE_SIZE_MB = 10
+# Сколько последних версий готового PDF хранится у пользователя (старые убирает GC блобов)
+RENDER_OUTPUT_VERSIONS = int(os.getenv("RENDER_OUTPUT_VERSIONS", "5"))
 
 
 def register_user_service(data: RegisterUserRequest, db: Session):
@@ -35,93 +51,295 @@ def register_user_service(data: RegisterUserRequest, db: Session):
     return {"message": "User registered"}
 
 
-def upload_template_service(tg_id, file, ttf_files, db: Session):
-    scenario_id = f"{tg_id}_{datetime.utcnow().isoformat()}"
+def find_user(db: Session, tg_id: str) -> Optional[User]:
+    return db.query(User).filter_by(tg_id=tg_id).first()
+
+
+def get_template_layout(template: Template, file_hash: str):
+    """
+    Возвращает сохраненную разметку полей (bbox, шрифты) шаблона.
+    None — если разметки нет или исходный файл изменился и нужен повторный парсинг.
+    """
+    if not template.layout or not template.file_hash:
+        return None
+    if file_hash != template.file_hash:
+        logger.info(f"Исходный файл {template.file_path} изменился, разметка будет извлечена заново")
+        return None
+    return template.layout
+
+
+def store_template_layout(template: Template, file_hash: str, layout: dict):
+    template.layout = layout
+    template.file_hash = file_hash
+
+
+def load_template_layout(template: Template, pdf_path: str, font_map: dict):
+    """Базовый документ из пула и разметка полей шаблона (извлекается и сохраняется, если ее нет)."""
+    base = document_pool.acquire(
+        template.id, template.file_hash, pdf_path, font_map, parsed=shared_templates.parsed_for(template.file_hash)
+    )
+    fields = get_template_layout(template, base.sha256)
+    if fields is None:
+        ext = os.path.splitext(pdf_path)[1]
+        analysis = pdf_pool.run(analyze_template_data, base.data, ext, base.sha256)
+        fields = extract_fields_with_bbox_gemini(analysis["blocks"], analysis["table_regions"])
+        store_template_layout(template, base.sha256, fields)
+    return base, fields
+
+
+def ensure_template_blob(template: Template, db: Session) -> str:
+    """
+    sha256 исходника шаблона в хранилище блобов. Шаблон, сохраненный до хранилища (нет file_hash
+    или строки Blob), переносится туда при первом обращении: с диска или по прежнему ключу MinIO.
+    """
+    if template.file_hash and db.get(Blob, template.file_hash) is not None:
+        return template.file_hash
+    user_dir = os.path.dirname(template.file_path)
+    legacy_object = f"{os.path.basename(user_dir)}/{os.path.basename(template.file_path)}"
+    template.file_hash = blob_store.adopt(db, template.user_id, "template", template.file_path, legacy_object)
+    db.commit()
+    return template.file_hash
+
+
+def ensure_template_files(template: Template, db: Session) -> dict:
+    """
+    Исходник и шрифты шаблона на локальном диске (вытесненные из кэша или загруженные
+    на другой экземпляр API скачиваются из MinIO). Возвращает font_map.
+    """
+    ensure_template_blob(template, db)
+    user_dir = os.path.dirname(template.file_path)
+    if not os.path.exists(template.file_path):
+        ext = os.path.splitext(template.file_path)[1]
+        blob_store.materialize(template.file_hash, ext, user_dir, template.file_path)
+    else:
+        blob_store.find(template.file_hash)
+    blob_store.rehydrate(db, template.user_id, user_dir, blob_store.ref_names(db, template.user_id, "font"))
+    return template.font_map or build_font_map(user_dir)
+
+
+def plan_render(base, fields: dict, changes: dict, font_map: dict):
+    """Замены и операции отрисовки для одного набора значений; шрифты — буферы из пула."""
+    editable_fields = collect_editable_fields(fields)
+    replacements = build_replacements(editable_fields, changes)
+    ops = plan_replacement_ops(base.span_index, replacements, font_map)
+    for op in ops:
+        if op["fontfile"] not in base.font_buffers:
+            op["fontfile"] = None
+    font_buffers = {op["fontfile"]: base.font_buffers[op["fontfile"]] for op in ops if op["fontfile"]}
+    return editable_fields, replacements, ops, font_buffers
+
+
+def output_pdf_prefix(invoice_name: str) -> str:
+    return f"{invoice_name}_updated_"
+
+
+def output_pdf_name(invoice_name: str, sha256: str) -> str:
+    """Имя версии готового PDF: по содержимому, поэтому файл и ключ в MinIO после записи не меняются."""
+    return f"{output_pdf_prefix(invoice_name)}{sha256[:12]}.pdf"
+
+
+def render_key(action: str, template: Template, changes: dict) -> str:
+    """Ключ одинаковых запросов на рендер (single-flight): действие, версия исходника и значения."""
+    payload = json.dumps([action, template.file_hash, changes], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def render_template(template: Template, pdf_path: str, output_dir: str, changes: dict, font_map: dict,
+                    superseded=None):
+    """
+    Рендер по сохраненной разметке. Исходник, спаны и шрифты берутся из пула разобранных документов;
+    bbox старых значений считаются здесь, а отрисовка идет в пуле PDF-процессов по байтам.
+    Результат — новая неизменяемая версия <invoice>_updated_<sha>.pdf (блоб и ссылка в output_dir).
+    Если superseded() к концу отрисовки истинно, результат отбрасывается до записи в хранилище и MinIO.
+    """
+    base, fields = load_template_layout(template, pdf_path, font_map)
+    editable_fields, replacements, ops, font_buffers = plan_render(base, fields, changes, font_map)
+    pdf_bytes = pdf_pool.run(draw_replacements, base.data, ops, font_buffers) if ops else base.data
+    if superseded is not None and superseded():
+        raise EditSuperseded()
+    sha256 = hashlib.sha256(pdf_bytes).hexdigest()
+    output_name = output_pdf_name(template.invoice_name, sha256)
+    output_pdf = blob_store.link(blob_store.put(pdf_bytes, output_name, sha256), output_dir, output_name)
+    return {
+        "changed_count": len(ops),
+        "output_pdf": output_pdf,
+        "output_name": output_name,
+        "sha256": sha256,
+        "fields_found": {k: v.get("value") for k, v in editable_fields},
+        "fields_changed": {k: changes[k] for k in replacements},
+        "fields": fields
+    }
+
+
+async def process_template_file(job: ScenarioJob, db: Session, user_id: int, file_path: str, font_map: dict,
+                                data: Optional[bytes] = None, sha256: Optional[str] = None) -> dict:
+    """
+    Шаги обработки шаблона: extract_fonts (разбор PDF за один проход в пуле процессов), process_pdf
+    (только сохранение исходника: блоб в хранилище и MinIO, ссылка в папке пользователя — параллельно
+    с разбором), parse_fields (правила + Gemini), save_files (файлы и запись в БД).
+    Если data не передан, исходник уже лежит на диске.
+    """
+    ext = os.path.splitext(file_path)[1]
+    if data is not None:
+        sha256 = sha256 or hashlib.sha256(data).hexdigest()
+
+        def store_source():
+            return blob_store.link(blob_store.put(data, file_path, sha256), os.path.dirname(file_path), file_path)
+
+        analysis, _ = await asyncio.gather(
+            job.run_step("extract_fonts", pdf_pool.run_async(analyze_template_data, data, ext, sha256)),
+            job.run_step("process_pdf", run_in_threadpool(store_source)),
+        )
+        logger.info(f"Файл шаблона сохранен: {file_path} ({len(data)} байт)")
+    else:
+        analysis = await job.run_step("extract_fonts", pdf_pool.run_async(analyze_template_file, file_path))
+    extracted_fonts = set(analysis["fonts"])
+    logger.info(f"Извлечены шрифты: {list(extracted_fonts)}")
+
+    async with job.step_context("parse_fields") as entry:
+        parsed_data = await extract_fields_with_bbox_gemini_async(analysis["blocks"], analysis["table_regions"])
+        entry["message"] = f"найдено полей: {len(parsed_data) if parsed_data else 0}"
+    logger.info(f"Парсинг Gemini выполнен, найдено полей: {len(parsed_data) if parsed_data else 0}")
+
+    return await save_template_record(
+        job, db, user_id, file_path, font_map, list(extracted_fonts), parsed_data, analysis["sha256"]
+    )
+
+
+async def save_template_record(job: ScenarioJob, db: Session, user_id: int, file_path: str, font_map: dict,
+                               fonts: list, parsed_data: dict, file_hash: str) -> dict:
+    """Шаг save_files: списки шрифтов и полей рядом с исходником, запись Template с разметкой и ссылка на блоб."""
+    user_dir = os.path.dirname(file_path)
+    invoice_name = os.path.splitext(os.path.basename(file_path))[0]
+
+    def save_files():
+        fonts_txt = save_extracted_fonts_list(user_dir, invoice_name, fonts)
+        parsed_json = save_parsed_data_json(user_dir, invoice_name, parsed_data)
+        db_template = Template(
+            user_id=user_id,
+            file_path=file_path,
+            ttf_list=fonts,
+            parsed_data=parsed_data,
+            font_map=font_map,
+            layout=parsed_data,
+            file_hash=file_hash,
+            updated_at=datetime.utcnow(),
+            invoice_name=invoice_name
+        )
+        db.add(db_template)
+        blob_store.add_ref(db, user_id, file_hash, "template", os.path.basename(file_path))
+        db.commit()
+        return fonts_txt, parsed_json
+
+    # Запись файлов и коммит синхронные — в пуле потоков, чтобы не держать event loop
+    fonts_txt, parsed_json = await job.run_step("save_files", run_in_threadpool(save_files))
+    logger.info(f"Template DB object создан: {file_path}")
+    return {
+        "fonts": fonts,
+        "parsed_data": parsed_data,
+        "invoice_name": invoice_name,
+        "local_pdf": file_path,
+        "local_fonts": fonts_txt,
+        "local_json": parsed_json,
+        "font_map": font_map,
+    }
+
+
+async def run_template_job(job: ScenarioJob, pipeline, build_response, db: Optional[Session] = None):
+    """
+    Выполняет сценарий и сохраняет ответ в job.result. Без db (фоновый воркер) открывает
+    собственную сессию: сессия запроса к этому моменту уже закрыта.
+    """
+    own_session = db is None
+    if own_session:
+        db = SessionLocal()
+    try:
+        payload = await pipeline(db)
+        job.finish()
+        response = build_response(payload, job.scenario())
+        job.result = jsonable_encoder(response)
+        return response
+    except Exception as e:
+        await run_in_threadpool(db.rollback)
+        job.fail(e)
+        raise
+    finally:
+        if own_session:
+            db.close()
+
+
+async def upload_template_service(tg_id, file, ttf_files, db: Session, background: bool = False):
     logger.info(f"Upload template для {tg_id}: {file.filename}")
-    user = db.query(User).filter_by(tg_id=tg_id).first()
+    # Запросы к БД и файловой системе синхронные: в потоках, чтобы не блокировать event loop
+    user = await run_in_threadpool(find_user, db, tg_id)
     if not user:
         logger.warning(f"User {tg_id} not found при загрузке шаблона")
         raise HTTPException(404, "User not found")
     user_dir = os.path.join(UPLOAD_DIR, tg_id)
-    os.makedirs(user_dir, exist_ok=True)
     invoice_name, ext = os.path.splitext(file.filename)
     ext = ext.lower()
     if ext not in (".pdf", ".docx"):
         logger.warning(f"Недопустимый формат: {ext}")
         raise HTTPException(400, "Only PDF and DOCX supported")
+    await run_in_threadpool(os.makedirs, user_dir, exist_ok=True)
     file_path = os.path.join(user_dir, f"{invoice_name}{ext}")
-    file.file.seek(0)
-    size_mb = file.file.seek(0, os.SEEK_END) / (1024*1024)
-    file.file.seek(0)
-    if size_mb > MAX_TEMPLATE_SIZE_MB:
-        logger.warning(f"Файл слишком большой: {size_mb} MB")
-        raise HTTPException(400, f"File too large >{MAX_TEMPLATE_SIZE_MB} MB")
-    with open(file_path, "wb") as f:
-        import shutil
-        shutil.copyfileobj(file.file, f)
-    logger.info(f"Файл шаблона сохранен: {file_path}")
-
-    font_map = {}
-    if ttf_files:
-        for ttf_file in ttf_files:
-            ttf_name = ttf_file.filename
-            font_base = os.path.splitext(ttf_name)[0]
-            ttf_path = os.path.join(user_dir, ttf_name)
-            with open(ttf_path, "wb") as f:
-                shutil.copyfileobj(ttf_file.file, f)
-            font_map[font_base] = ttf_path
-        if "default" not in font_map and font_map:
-            font_map["default"] = list(font_map.values())[0]
-        logger.info(f"Загружено TTF: {list(font_map.keys())}")
-    else:
-        font_map = build_font_map(user_dir)
-        logger.info("Font map построен автоматически")
-
-    extracted_fonts = set()
-    if ext == ".pdf":
-        extracted_fonts.update(extract_fonts_from_pdf(file_path))
-    elif ext == ".docx":
-        extracted_fonts.update(extract_fonts_from_docx(file_path))
-    logger.info(f"Извлечены шрифты: {list(extracted_fonts)}")
-
-    blocks = extract_blocks_from_pdf(file_path)
-    parsed_data = extract_fields_with_bbox_gemini(blocks)
-    logger.info(f"Парсинг Gemini выполнен, найдено полей: {len(parsed_data) if parsed_data else 0}")
-
-    fonts_txt = save_extracted_fonts_list(user_dir, invoice_name, list(extracted_fonts))
-    parsed_json = save_parsed_data_json(user_dir, invoice_name, parsed_data)
-
-    db_template = Template(
-        user_id=user.id,
-        file_path=file_path,
-        ttf_list=list(extracted_fonts),
-        parsed_data=parsed_data,
-        font_map=font_map,
-        updated_at=datetime.utcnow(),
-        invoice_name=invoice_name
-    )
-    db.add(db_template)
-    db.commit()
-    logger.info(f"Template DB object создан (user {tg_id})")
-
-    scenario = TemplateScenario(
-        scenario_id=scenario_id,
-        status=TemplateStatus.parsing,
-        step="save_files",
-        log=[]
-    )
+    job = job_queue.create(tg_id, "upload")
 
-    return TemplateUploadResponse(
-        message="Template uploaded locally. Confirm to upload to MinIO.",
-        fonts=list(extracted_fonts),
-        parsed_data=parsed_data,
-        invoice_name=invoice_name,
-        local_pdf=file_path,
-        local_fonts=fonts_txt,
-        local_json=parsed_json,
-        font_map=font_map,
-        scenario=scenario
+    try:
+        async with job.step_context("upload") as entry:
+            try:
+                upload = await read_upload(file, MAX_TEMPLATE_SIZE_MB * 1024 * 1024)
+            except UploadTooLarge:
+                logger.warning(f"Файл слишком большой: >{MAX_TEMPLATE_SIZE_MB} MB")
+                raise HTTPException(400, f"File too large >{MAX_TEMPLATE_SIZE_MB} MB")
+
+            # Присылаются только шрифты, которых нет в хранилище (см. /fonts/missing);
+            # уже известные связаны с папкой пользователя и попадают в font_map из нее
+            uploaded = []
+            for ttf_file in ttf_files or []:
+                try:
+                    ttf = await read_upload(ttf_file, MAX_TEMPLATE_SIZE_MB * 1024 * 1024)
+                except UploadTooLarge:
+                    raise HTTPException(400, f"Font file too large >{MAX_TEMPLATE_SIZE_MB} MB")
+                uploaded.append(await run_in_threadpool(
+                    blob_store.store, db, user.id, "font", ttf.data, ttf.filename, user_dir, ttf.sha256, "font/ttf"
+                ))
+            await run_in_threadpool(db.commit)
+            font_map = await run_in_threadpool(build_font_map, user_dir)
+            if uploaded and os.path.splitext(os.path.basename(font_map["default"]))[0] != "default":
+                font_map["default"] = uploaded[0]
+            logger.info(f"Загружено TTF: {len(uploaded)}, font map: {list(font_map.keys())}")
+            entry["message"] = f"{file.filename}: {upload.size} байт"
+    except Exception as e:
+        job.fail(e)
+        raise
+
+    def pipeline(session: Session):
+        return process_template_file(job, session, user.id, file_path, font_map, upload.data, upload.sha256)
+
+    def build_response(payload: dict, scenario: TemplateScenario):
+        return TemplateUploadResponse(
+            message="Template uploaded locally. Confirm to upload to MinIO.",
+            scenario=scenario,
+            **payload
+        )
+
+    if background:
+        job_queue.submit(job, lambda: run_template_job(job, pipeline, build_response))
+        return job
+    return await run_template_job(job, pipeline, build_response, db)
+
+
+def save_output_version(db: Session, template: Template, result: dict):
+    """Ссылка на новую версию готового PDF; версии старше RENDER_OUTPUT_VERSIONS отпускаются."""
+    user_dir = os.path.dirname(template.file_path)
+    blob_store.add_ref(db, template.user_id, result["sha256"], "output", result["output_name"],
+                       content_type="application/pdf")
+    pruned = blob_store.prune_refs(
+        db, template.user_id, "output", output_pdf_prefix(template.invoice_name), RENDER_OUTPUT_VERSIONS, user_dir
     )
+    if pruned:
+        logger.info(f"Старые версии {template.invoice_name}: {pruned}")
 
 
 def confirm_latest_template_service(tg_id, db: Session):
@@ -134,30 +352,41 @@ def confirm_latest_template_service(tg_id, db: Session):
     if not template:
         logger.warning(f"Template для {tg_id} не найден")
         raise HTTPException(404, "Template not found")
+    # Правки, которые пользователь уже видит (desired), сначала дорисовываются и сохраняются
+    edit_coalescer.wait(template.id)
+    db.refresh(template)
+    # Повторное подтверждение того же состояния (двойное нажатие) ждет уже идущий рендер
+    key = render_key("confirm", template, template.parsed_data)
+    return render_flight.run(template.id, key, lambda: confirm_template(tg_id, template, db))
+
+
+def confirm_template(tg_id: str, template: Template, db: Session) -> ConfirmTemplateResponse:
+    """Рендер и выгрузка подтвержденного шаблона; выполняется под блокировкой шаблона."""
+    db.refresh(template)
     invoice_name = template.invoice_name
     user_dir = os.path.dirname(template.file_path)
     ext = os.path.splitext(template.file_path)[1].lower()
     pdf_path = os.path.join(user_dir, f"{invoice_name}{ext}")
-    fonts_txt = os.path.join(user_dir, f"{invoice_name}_extracted_fonts.txt")
-    parsed_json = os.path.join(user_dir, f"{invoice_name}_parsed_fields.json")
-    updated_pdf_name = f"{invoice_name}_updated.pdf"
-    updated_pdf = os.path.join(user_dir, updated_pdf_name)
-    font_map = template.font_map or build_font_map(user_dir)
-
-    result = process_invoice_and_replace(
-        pdf_path=pdf_path,
-        output_pdf=updated_pdf,
-        changes=template.parsed_data or {},
-        font_map=font_map,
-        extract_fields_with_bbox_gemini=extract_fields_with_bbox_gemini
-    )
-    logger.info(f"PDF обработан для {tg_id}, изменено: {result.get('changed_count', 0)} полей")
+    font_map = ensure_template_files(template, db)
+    # Списки шрифтов и полей пересобираются из БД: локальной копии на этом экземпляре может не быть
+    fonts_txt = save_extracted_fonts_list(user_dir, invoice_name, template.ttf_list or [])
+    parsed_json = save_parsed_data_json(user_dir, invoice_name, template.parsed_data or {})
 
-    url_pdf = minio_upload(pdf_path, f"{tg_id}/{invoice_name}{ext}", "application/pdf")
-    url_fonts = minio_upload(fonts_txt, f"{tg_id}/{invoice_name}_extracted_fonts.txt", "text/plain")
-    url_json = minio_upload(parsed_json, f"{tg_id}/{invoice_name}_parsed_fields.json", "application/json")
-    url_updated_pdf = minio_upload(updated_pdf, f"{tg_id}/{updated_pdf_name}", "application/pdf")
+    result = render_template(template, pdf_path, user_dir, template.parsed_data or {}, font_map)
+    logger.info(f"PDF обработан для {tg_id}, изменено: {result.get('changed_count', 0)} полей")
 
+    # Исходник и готовый PDF уже в MinIO под ключами блобов (записаны при сохранении или перенесены
+    # в ensure_template_blob), догружаются только списки
+    uploads = minio_upload_batch([
+        (fonts_txt, f"{tg_id}/{invoice_name}_extracted_fonts.txt", "text/plain"),
+        (parsed_json, f"{tg_id}/{invoice_name}_parsed_fields.json", "application/json"),
+    ])
+    url_pdf = object_url(blob_store.object_name(template.file_hash, ext))
+    url_fonts = uploads[f"{tg_id}/{invoice_name}_extracted_fonts.txt"]["url"]
+    url_json = uploads[f"{tg_id}/{invoice_name}_parsed_fields.json"]["url"]
+    url_updated_pdf = object_url(blob_store.object_name(result["sha256"], ".pdf"))
+
+    save_output_version(db, template, result)
     template.is_active = 1
     template.updated_at = datetime.utcnow()
     db.commit()
@@ -174,13 +403,42 @@ def confirm_latest_template_service(tg_id, db: Session):
         message="✅ Шаблон подтвержден.",
         pdf_url=url_pdf,
         updated_pdf_url=url_updated_pdf,
-        updated_pdf_name=updated_pdf_name,
+        updated_pdf_name=result["output_name"],
+        updated_pdf_sha256=result["sha256"],
         extracted_fonts_url=url_fonts,
         parsed_json_url=url_json,
         scenario=scenario
     )
 
 
+def missing_fonts_service(tg_id: str, fonts: list, db: Session) -> dict:
+    """Согласование шрифтов по хэшам: известные связываются с пользователем, остальные — missing."""
+    user = db.query(User).filter_by(tg_id=tg_id).first()
+    if not user:
+        logger.warning(f"User {tg_id} not found при согласовании шрифтов")
+        raise HTTPException(404, "User not found")
+    user_dir = os.path.join(UPLOAD_DIR, tg_id)
+    os.makedirs(user_dir, exist_ok=True)
+    result = blob_store.negotiate(db, user.id, fonts, user_dir)
+    db.commit()
+    logger.info(f"Шрифты {tg_id}: уже есть {len(result['linked'])}, нужно прислать {len(result['missing'])}")
+    return result
+
+
+def rendered_pdf_path(tg_id: str, filename: str) -> Optional[str]:
+    """Готовый PDF пользователя на диске; None — файла локально нет, его отдает MinIO."""
+    if os.path.basename(filename) != filename or not filename.lower().endswith(".pdf"):
+        raise HTTPException(400, "Invalid filename")
+    if not tg_id or os.path.basename(tg_id) != tg_id or tg_id in (".", "..") or "\\" in tg_id:
+        raise HTTPException(400, "Invalid tg_id")
+    path = os.path.join(UPLOAD_DIR, tg_id, filename)
+    # Симлинки внутри uploads/ тоже не должны выводить за его пределы
+    root = os.path.realpath(UPLOAD_DIR)
+    if os.path.commonpath([root, os.path.realpath(path)]) != root:
+        raise HTTPException(400, "Invalid path")
+    return path if os.path.isfile(path) else None
+
+
 def latest_template_service(tg_id, db: Session):
     logger.info(f"Получение последнего шаблона для {tg_id}")
     user = db.query(User).filter_by(tg_id=tg_id).first()
@@ -199,9 +457,11 @@ def latest_template_service(tg_id, db: Session):
         log=[]
     )
     logger.info(f"Возврат информации о последнем шаблоне для {tg_id}")
+    # Пока правки склеиваются, отдается желаемое состояние: следующая правка строится поверх него
+    desired = edit_coalescer.desired(template.id)
     return LatestTemplateResponse(
         file_path=template.file_path,
-        parsed_data=template.parsed_data or {},
+        parsed_data=desired if desired is not None else template.parsed_data or {},
         scenario=scenario
     )
 
@@ -220,27 +480,46 @@ def update_latest_template_service(tg_id, payload, db: Session):
     if not template:
         logger.warning(f"Template для {tg_id} не найден при update")
         raise HTTPException(404, "Template not found")
+
+
+    def apply(changes: dict, superseded) -> UpdateTemplateResponse:
+        key = render_key("update", template, changes)
+        return render_flight.run(template.id, key, lambda: update_template(tg_id, template, changes, db, superseded))
+
+    # Частые правки склеиваются: рендерится и выгружается только итоговое состояние
+    response, merged, final = edit_coalescer.submit(template.id, parsed_in, apply)
+    return response.model_copy(update={"coalesced_edits": merged, "superseded": not final})
+
+
+def update_template(tg_id: str, template: Template, parsed_in: dict, db: Session,
+                    superseded=None) -> UpdateTemplateResponse:
+    """
+    Рендер с новыми значениями и выгрузка; выполняется под блокировкой шаблона.
+    superseded() — появились ли более новые правки: тогда рендер и выгрузка отменяются (EditSuperseded).
+    """
+    superseded = superseded or (lambda: False)
+    if superseded():
+        raise EditSuperseded()
+    db.refresh(template)
     invoice_name = template.invoice_name
     user_dir = os.path.dirname(template.file_path)
     ext = os.path.splitext(template.file_path)[1].lower()
     pdf_path = os.path.join(user_dir, f"{invoice_name}{ext}")
-    updated_pdf = os.path.join(user_dir, f"{invoice_name}_updated.pdf")
-    font_map = template.font_map or build_font_map(user_dir)
-    result = process_invoice_and_replace(
-        pdf_path=pdf_path,
-        output_pdf=updated_pdf,
-        changes=parsed_in,
-        font_map=font_map,
-        extract_fields_with_bbox_gemini=extract_fields_with_bbox_gemini
-    )
+    font_map = ensure_template_files(template, db)
+    result = render_template(template, pdf_path, user_dir, parsed_in, font_map, superseded)
     template.parsed_data = parsed_in
     template.updated_at = datetime.utcnow()
+    save_output_version(db, template, result)
     db.commit()
-    fonts_txt = os.path.join(user_dir, f"{invoice_name}_extracted_fonts.txt")
+    fonts_txt = save_extracted_fonts_list(user_dir, invoice_name, template.ttf_list or [])
     parsed_json = save_parsed_data_json(user_dir, invoice_name, parsed_in)
-    url_updated_pdf = minio_upload(updated_pdf, f"{tg_id}/{invoice_name}_updated.pdf", "application/pdf")
-    url_json = minio_upload(parsed_json, f"{tg_id}/{invoice_name}_parsed_fields.json", "application/json")
-    url_fonts = minio_upload(fonts_txt, f"{tg_id}/{invoice_name}_extracted_fonts.txt", "text/plain")
+    uploads = minio_upload_batch([
+        (parsed_json, f"{tg_id}/{invoice_name}_parsed_fields.json", "application/json"),
+        (fonts_txt, f"{tg_id}/{invoice_name}_extracted_fonts.txt", "text/plain"),
+    ])
+    url_updated_pdf = object_url(blob_store.object_name(result["sha256"], ".pdf"))
+    url_json = uploads[f"{tg_id}/{invoice_name}_parsed_fields.json"]["url"]
+    url_fonts = uploads[f"{tg_id}/{invoice_name}_extracted_fonts.txt"]["url"]
 
     logger.info(f"Шаблон {invoice_name} обновлен для {tg_id}")
 
@@ -254,6 +533,8 @@ def update_latest_template_service(tg_id, payload, db: Session):
     return UpdateTemplateResponse(
         message="Template updated",
         updated_pdf_url=url_updated_pdf,
+        updated_pdf_name=result["output_name"],
+        updated_pdf_sha256=result["sha256"],
         parsed_json_url=url_json,
         extracted_fonts_url=url_fonts,
         fields_changed=result.get("fields_changed", {}),
@@ -262,109 +543,85 @@ def update_latest_template_service(tg_id, payload, db: Session):
     )
 
 
-def upload_font_service(tg_id, ttf_file):
+def upload_font_service(tg_id, ttf_file, db: Session):
     logger.info(f"Загрузка шрифта для {tg_id}: {ttf_file.filename}")
+    user = db.query(User).filter_by(tg_id=tg_id).first()
+    if not user:
+        logger.warning(f"User {tg_id} not found при загрузке шрифта")
+        raise HTTPException(404, "User not found")
     user_dir = os.path.join(UPLOAD_DIR, tg_id)
     os.makedirs(user_dir, exist_ok=True)
-    ttf_name = ttf_file.filename
-    ttf_path = os.path.join(user_dir, ttf_name)
-    with open(ttf_path, "wb") as f:
-        import shutil
-        shutil.copyfileobj(ttf_file.file, f)
-    from minio import Minio
-    from services.minio_service import MINIO_BUCKET, minio_client
-    minio_client.fput_object(
-        MINIO_BUCKET,
-        f"{tg_id}/{ttf_name}",
-        ttf_path,
-        content_type="font/ttf"
-    )
+    ttf_name = os.path.basename(ttf_file.filename)
+    data = ttf_file.file.read()
+    sha256 = hashlib.sha256(data).hexdigest()
+    blob_store.store(db, user.id, "font", data, ttf_name, user_dir, sha256, "font/ttf")
+    db.commit()
     logger.info(f"Шрифт {ttf_name} успешно загружен для {tg_id}")
     return FontUploadResponse(message="Font uploaded", font_name=ttf_name)
 
 
-TEMPLATES_PREFIX = "templates/"
+def get_templates_service(page: int = 1, page_size: int = TEMPLATE_PAGE_SIZE):
+    """Страница каталога общих шаблонов (из кэша, MinIO опрашивается не чаще TTL)."""
+    catalog = template_catalog.page(page, page_size)
+    logger.info(f"Каталог шаблонов: страница {page}/{catalog['pages']}, всего {catalog['total']}")
+    return catalog
 
 
-def get_templates_service(db: Session):
-    logger.info("Получение списка шаблонов из Minio")
-    try:
-        templates = []
-        for obj in minio_client.list_objects(MINIO_BUCKET, prefix=TEMPLATES_PREFIX, recursive=True):
-            if obj.object_name.endswith(".pdf") or obj.object_name.endswith(".docx"):
-                templates.append({
-                    "template_name": os.path.basename(obj.object_name),
-                    "object_name": obj.object_name
-                })
-        logger.info(f"Найдено {len(templates)} шаблонов")
-        return {"templates": templates}
-    except S3Error as e:
-        logger.error(f"Ошибка получения шаблонов из MinIO: {e}")
-        raise HTTPException(500, f"MinIO error: {e}")
-
-
-def select_template_service(tg_id: str, template_name: str, db: Session):
-    logger.info(f"Пользователь {tg_id} выбирает шаблон {template_name} из общих")
-    user = db.query(User).filter_by(tg_id=tg_id).first()
+async def select_template_service(tg_id: str, template_name: Optional[str], db: Session, background: bool = False,
+                                  template_id: Optional[str] = None):
+    logger.info(f"Пользователь {tg_id} выбирает шаблон {template_id or template_name} из общих")
+    user = await run_in_threadpool(find_user, db, tg_id)
     if not user:
         logger.warning(f"User {tg_id} not found при выборе шаблона")
         raise HTTPException(404, "User not found")
+    if template_id:
+        # Обновление каталога по TTL/промаху — list_objects в MinIO, поэтому в пуле потоков
+        entry = await run_in_threadpool(template_catalog.get, template_id)
+        if entry is None:
+            logger.warning(f"Шаблон с id {template_id} не найден в каталоге")
+            raise HTTPException(404, "Template not found")
+        src_object, template_name = entry["object_name"], entry["template_name"]
+    elif template_name:
+        src_object = f"{TEMPLATES_PREFIX}{template_name}"
+    else:
+        raise HTTPException(400, "template_id or template_name is required")
     user_dir = os.path.join(UPLOAD_DIR, tg_id)
-    os.makedirs(user_dir, exist_ok=True)
-    src_object = f"{TEMPLATES_PREFIX}{template_name}"
     ext = os.path.splitext(template_name)[1].lower()
     if ext not in (".pdf", ".docx"):
         logger.warning(f"Недопустимый формат шаблона: {ext}")
         raise HTTPException(400, "Только PDF или DOCX шаблоны поддерживаются")
+    await run_in_threadpool(os.makedirs, user_dir, exist_ok=True)
     dst_path = os.path.join(user_dir, template_name)
-    try:
-        minio_client.fget_object(MINIO_BUCKET, src_object, dst_path)
-        logger.info(f"Шаблон {template_name} скачан в {dst_path}")
-    except S3Error as e:
-        logger.error(f"Ошибка скачивания шаблона {template_name}: {e}")
-        raise HTTPException(500, f"MinIO download error: {e}")
-
-    font_map = build_font_map(user_dir)
-    extracted_fonts = set()
-    if ext == ".pdf":
-        extracted_fonts.update(extract_fonts_from_pdf(dst_path))
-    elif ext == ".docx":
-        extracted_fonts.update(extract_fonts_from_docx(dst_path))
-    logger.info(f"Шрифты из шаблона {template_name} извлечены: {list(extracted_fonts)}")
-
-    blocks = extract_blocks_from_pdf(dst_path)
-    parsed_data = extract_fields_with_bbox_gemini(blocks)
-    fonts_txt = save_extracted_fonts_list(user_dir, os.path.splitext(template_name)[0], list(extracted_fonts))
-    parsed_json = save_parsed_data_json(user_dir, os.path.splitext(template_name)[0], parsed_data)
-
-    db_template = Template(
-        user_id=user.id,
-        file_path=dst_path,
-        ttf_list=list(extracted_fonts),
-        parsed_data=parsed_data,
-        font_map=font_map,
-        updated_at=datetime.utcnow(),
-        invoice_name=os.path.splitext(template_name)[0]
-    )
-    db.add(db_template)
-    db.commit()
-    logger.info(f"Template DB object создан по шаблону {template_name} для {tg_id}")
-
-    scenario = TemplateScenario(
-        scenario_id=f"{tg_id}_{datetime.utcnow().isoformat()}",
-        status=TemplateStatus.uploaded,
-        step="template_selected",
-        log=[]
-    )
-
-    return {
-        "message": "Template selected and uploaded.",
-        "fonts": list(extracted_fonts),
-        "parsed_data": parsed_data,
-        "invoice_name": os.path.splitext(template_name)[0],
-        "local_pdf": dst_path,
-        "local_fonts": fonts_txt,
-        "local_json": parsed_json,
-        "font_map": font_map,
-        "scenario": scenario
-    }
+    job = job_queue.create(tg_id, "select")
+
+    async def pipeline(session: Session):
+        # Разбор и поля общего шаблона готовятся один раз на его версию (ETag), пользователю — ссылка на блоб
+        async with job.step_context("upload") as entry:
+            source_path, etag = await run_in_threadpool(shared_templates.fetch_source, src_object)
+            blob_path = await run_in_threadpool(blob_store.put_file, source_path, template_name)
+            await run_in_threadpool(blob_store.link, blob_path, user_dir, template_name)
+            logger.info(f"Шаблон {template_name} (etag {etag}) связан с {dst_path}")
+            entry["message"] = f"{src_object} (etag {etag})"
+        async with job.step_context("parse_fields") as entry:
+            artifacts, source = await run_in_threadpool(shared_templates.artifacts, src_object, etag, source_path)
+            entry["message"] = f"готовые артефакты ({source})" if source != "build" else "артефакты построены"
+        font_map = await run_in_threadpool(build_font_map, user_dir)
+        return await save_template_record(
+            job, session, user.id, dst_path, font_map,
+            artifacts["fonts"], artifacts["parsed_data"], artifacts["sha256"]
+        )
+
+    def build_response(payload: dict, scenario: TemplateScenario):
+        return {"message": "Template selected and uploaded.", **payload, "scenario": scenario}
+
+    if background:
+        job_queue.submit(job, lambda: run_template_job(job, pipeline, build_response))
+        return job
+    return await run_template_job(job, pipeline, build_response, db)
+
+
+def get_scenario_service(tg_id: str, scenario_id: str) -> ScenarioStatusResponse:
+    job = job_queue.get(scenario_id)
+    if job is None or job.tg_id != tg_id:
+        raise HTTPException(404, "Scenario not found")
+    return ScenarioStatusResponse(scenario=job.scenario(), result=job.result)
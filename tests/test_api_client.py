@@ -0,0 +1,71 @@
+import asyncio
+from aiohttp import web
+from utils.api_client import ApiClient
+
+
+async def _serve(handlers):
+    app = web.Application()
+    for method, path, handler in handlers:
+        app.router.add_route(method, path, handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://127.0.0.1:{port}/"
+
+
+def test_retries_idempotent_requests_and_reuses_connections():
+    calls = {"get": 0, "post": 0}
+
+    async def flaky_get(request):
+        calls["get"] += 1
+        if calls["get"] == 1:
+            return web.Response(status=503)
+        return web.json_response({"ok": True})
+
+    async def failing_post(request):
+        calls["post"] += 1
+        return web.Response(status=503)
+
+    async def scenario():
+        runner, base = await _serve([("GET", "/api/v1/item", flaky_get), ("POST", "/api/v1/item", failing_post)])
+        api = ApiClient(base, retries=2, backoff_sec=0)
+        try:
+            await api.start()
+            resp = await api.get("api/v1/item")
+            assert resp.status == 200 and resp.json() == {"ok": True}
+            assert (await api.post("/api/v1/item")).status == 503
+            for _ in range(3):
+                await api.get("/api/v1/item")
+            return api.stats()
+        finally:
+            await api.close()
+            await runner.cleanup()
+
+    stats = asyncio.run(scenario())
+    assert calls == {"get": 5, "post": 1}
+    assert stats["retries"] == 1
+    assert stats["connections_created"] == 1
+    assert stats["connections_reused"] >= 5
+    assert stats["endpoints"]["GET /api/v1/item"]["samples"] == 5
+
+
+def test_stream_yields_body_in_chunks():
+    payload = b"%PDF" + b"x" * 200_000
+
+    async def pdf(request):
+        return web.Response(body=payload, content_type="application/pdf")
+
+    async def scenario():
+        runner, base = await _serve([("GET", "/api/v1/file/rendered", pdf)])
+        api = ApiClient(base)
+        try:
+            return [chunk async for chunk in api.stream("/api/v1/file/rendered", chunk_size=65536)]
+        finally:
+            await api.close()
+            await runner.cleanup()
+
+    chunks = asyncio.run(scenario())
+    assert b"".join(chunks) == payload
+    assert max(len(c) for c in chunks) <= 65536
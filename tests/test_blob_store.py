@@ -0,0 +1,256 @@
+import os
+import hashlib
+import shutil
+import pytest
+from datetime import datetime, timedelta
+from minio.error import S3Error
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from models.db import Base, User, Template, Blob, BlobRef, get_db
+from services import blob_store as blobs
+from services import template_service
+from services.template_service import UPLOAD_DIR
+
+FONT = b"\x00\x01\x00\x00fake-ttf-body"
+FONT_SHA = hashlib.sha256(FONT).hexdigest()
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+    def close(self):
+        pass
+
+    def release_conn(self):
+        pass
+
+
+class FakeMinio:
+    def __init__(self):
+        self.objects = {}
+        self.removed = []
+        self.failing = set()
+
+    def upload_batch(self, items, skip_unchanged=True):
+        for source, name, content_type in items:
+            if isinstance(source, str):
+                with open(source, "rb") as f:
+                    source = f.read()
+            self.objects[name] = source
+        return {}
+
+    def stat_object(self, bucket, name):
+        if name not in self.objects:
+            raise S3Error("NoSuchKey", "missing", name, None, None, None)
+
+    def get_object(self, bucket, name):
+        return FakeResponse(self.objects[name])
+
+    def remove_object(self, bucket, name):
+        if name in self.failing:
+            raise S3Error("InternalError", "unavailable", name, None, None, None)
+        self.removed.append(name)
+        self.objects.pop(name, None)
+
+
+@pytest.fixture(autouse=True)
+def minio(monkeypatch):
+    fake = FakeMinio()
+    monkeypatch.setattr(blobs, "minio_client", fake)
+    monkeypatch.setattr(blobs, "minio_upload_batch", fake.upload_batch)
+    return fake
+
+
+@pytest.fixture
+def db(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'blobs.db'}", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    try:
+        yield session
+    finally:
+        session.close()
+        engine.dispose()
+
+
+def test_content_is_stored_once_and_referenced_per_user(tmp_path, db):
+    store = blobs.BlobStore(str(tmp_path / "blobs"))
+    alice, bob = User(tg_id="alice"), User(tg_id="bob")
+    db.add_all([alice, bob])
+    db.commit()
+    alice_dir, bob_dir = tmp_path / "alice", tmp_path / "bob"
+    alice_dir.mkdir()
+    bob_dir.mkdir()
+
+    assert store.negotiate(db, alice.id, [{"name": "Brand.ttf", "sha256": FONT_SHA}], str(alice_dir))["missing"] == [FONT_SHA]
+    store.store(db, alice.id, "font", FONT, "Brand.ttf", str(alice_dir))
+    result = store.negotiate(db, bob.id, [{"name": "Brand-Regular.ttf", "sha256": FONT_SHA}], str(bob_dir))
+    db.commit()
+
+    assert result == {"missing": [], "linked": [FONT_SHA]}
+    assert (bob_dir / "Brand-Regular.ttf").read_bytes() == FONT
+    assert os.path.samefile(alice_dir / "Brand.ttf", store.path_for(FONT_SHA, ".ttf"))
+    assert store.stats()["stored"] == 1
+    assert db.query(Blob).count() == 1 and db.query(BlobRef).count() == 2
+    assert store.object_for(db, "bob", "Brand-Regular.ttf") == f"blobs/{FONT_SHA}.ttf"
+    assert store.object_for(db, "bob", "other.pdf") == "bob/other.pdf"
+
+
+def test_negotiate_counts_evicted_fonts_as_known(tmp_path, db, minio):
+    store = blobs.BlobStore(str(tmp_path / "blobs"))
+    erin, frank = User(tg_id="erin"), User(tg_id="frank")
+    db.add_all([erin, frank])
+    db.commit()
+    erin_dir, frank_dir = tmp_path / "erin", tmp_path / "frank"
+    erin_dir.mkdir()
+    frank_dir.mkdir()
+    store.store(db, erin.id, "font", FONT, "Brand.ttf", str(erin_dir))
+    db.commit()
+    os.unlink(store.path_for(FONT_SHA, ".ttf"))
+
+    result = store.negotiate(db, frank.id, [{"name": "Brand.ttf", "sha256": FONT_SHA}], str(frank_dir))
+
+    assert result == {"missing": [], "linked": [FONT_SHA]}
+    assert (frank_dir / "Brand.ttf").read_bytes() == FONT
+    assert store.stats()["rehydrated"] == 1
+
+
+def test_gc_removes_only_unreferenced_blobs(tmp_path, db, minio):
+    store = blobs.BlobStore(str(tmp_path / "blobs"))
+    user = User(tg_id="carol")
+    db.add(user)
+    db.commit()
+    user_dir = tmp_path / "carol"
+    user_dir.mkdir()
+
+    first = store.store(db, user.id, "output", b"%PDF-1", "invoice_updated.pdf", str(user_dir))
+    first_sha = hashlib.sha256(b"%PDF-1").hexdigest()
+    store.store(db, user.id, "output", b"%PDF-2", "invoice_updated.pdf", str(user_dir))
+    db.commit()
+
+    assert store.gc(db, grace_sec=0) == {"deleted": 1, "bytes": 6}
+    assert minio.removed == [f"blobs/{first_sha}.pdf"]
+    assert store.find(first_sha) is None
+    assert open(first, "rb").read() == b"%PDF-2"
+    assert [b.size for b in db.query(Blob).all()] == [6]
+
+
+def test_gc_spares_reused_blobs_and_counts_only_deleted(tmp_path, db, minio):
+    store = blobs.BlobStore(str(tmp_path / "blobs"))
+    user = User(tg_id="gina")
+    db.add(user)
+    db.commit()
+    user_dir = tmp_path / "gina"
+    user_dir.mkdir()
+    for name in ("a", "b", "c"):
+        store.store(db, user.id, "output", f"%PDF-{name}".encode(), f"{name}.pdf", str(user_dir))
+    db.query(BlobRef).delete()
+    db.query(Blob).update({Blob.created_at: datetime.utcnow() - timedelta(hours=2)})
+    db.commit()
+    sha = {name: hashlib.sha256(f"%PDF-{name}".encode()).hexdigest() for name in ("a", "b", "c")}
+
+    # "a" снова загружен, ссылка еще не записана; "b" не удаляется из MinIO
+    store.put(b"%PDF-a", "again.pdf")
+    minio.failing.add(f"blobs/{sha['b']}.pdf")
+
+    assert store.gc(db, grace_sec=3600) == {"deleted": 1, "bytes": 6}
+    assert minio.removed == [f"blobs/{sha['c']}.pdf"]
+    assert {b.sha256 for b in db.query(Blob)} == {sha["a"], sha["b"]}
+    assert store.find(sha["b"]) is None and store.ensure(sha["b"], ".pdf")
+    assert store.stats()["gc_deleted"] == 1
+
+
+def test_reuse_after_gc_on_another_replica_reuploads(tmp_path, db, minio):
+    first, second = blobs.BlobStore(str(tmp_path / "a")), blobs.BlobStore(str(tmp_path / "b"))
+    user = User(tg_id="ivan")
+    db.add(user)
+    db.commit()
+    user_dir = tmp_path / "ivan"
+    user_dir.mkdir()
+    sha256 = hashlib.sha256(b"%PDF-x").hexdigest()
+    first.store(db, user.id, "output", b"%PDF-x", "x.pdf", str(user_dir))
+    db.query(BlobRef).delete()
+    db.commit()
+
+    assert second.gc(db, grace_sec=0)["deleted"] == 1
+    assert f"blobs/{sha256}.pdf" not in minio.objects
+    # На первом экземпляре копия осталась в локальном кэше
+    first.store(db, user.id, "output", b"%PDF-x", "x.pdf", str(user_dir))
+    db.commit()
+
+    assert minio.objects[f"blobs/{sha256}.pdf"] == b"%PDF-x"
+    assert first.stats()["reuploaded"] == 1
+    assert db.get(Blob, sha256) is not None
+
+
+def test_evicted_blobs_are_rehydrated_from_minio(tmp_path, db, minio):
+    store = blobs.BlobStore(str(tmp_path / "blobs"), max_bytes=20, min_age_sec=0,
+                            links_root=str(tmp_path / "uploads"), evict_ratio=1)
+    user = User(tg_id="dave")
+    db.add(user)
+    db.commit()
+    user_dir = tmp_path / "uploads" / "dave"
+    user_dir.mkdir(parents=True)
+
+    for name in "ABC":
+        store.store(db, user.id, "font", name.encode() * 8, f"{name}.ttf", str(user_dir))
+    db.commit()
+    store.wait_evicted()
+
+    assert not (user_dir / "A.ttf").exists()
+    assert f"blobs/{hashlib.sha256(b'A' * 8).hexdigest()}.ttf" in minio.objects
+    assert store.rehydrate(db, user.id, str(user_dir), ["A.ttf", "C.ttf"]) == 1
+    store.wait_evicted()
+    assert (user_dir / "A.ttf").read_bytes() == b"A" * 8
+    assert not (user_dir / "B.ttf").exists()
+    stats = store.stats()
+    assert stats["evicted"] == 2 and stats["rehydrated"] == 1
+    assert stats["cached_bytes"] <= 20
+
+
+def test_legacy_templates_are_moved_into_the_store(tmp_path, db, minio, monkeypatch):
+    store = blobs.BlobStore(str(tmp_path / "blobs"), links_root=str(tmp_path / "uploads"))
+    monkeypatch.setattr(template_service, "blob_store", store)
+    user = User(tg_id="hank")
+    db.add(user)
+    db.commit()
+    user_dir = tmp_path / "uploads" / "hank"
+    user_dir.mkdir(parents=True)
+    (user_dir / "local.pdf").write_bytes(b"%PDF-local")
+    minio.objects["hank/remote.pdf"] = b"%PDF-remote"
+    local = Template(user_id=user.id, file_path=str(user_dir / "local.pdf"), invoice_name="local")
+    remote = Template(user_id=user.id, file_path=str(user_dir / "remote.pdf"), invoice_name="remote",
+                      file_hash="0" * 64)
+    db.add_all([local, remote])
+    db.commit()
+
+    for template, data in ((local, b"%PDF-local"), (remote, b"%PDF-remote")):
+        sha256 = template_service.ensure_template_blob(template, db)
+        assert sha256 == template.file_hash == hashlib.sha256(data).hexdigest()
+        assert minio.objects[f"blobs/{sha256}.pdf"] == data
+        assert open(template.file_path, "rb").read() == data
+    assert db.query(BlobRef).filter_by(kind="template").count() == 2
+    assert template_service.ensure_template_blob(local, db) == local.file_hash
+    assert store.stats()["stored"] == 2
+
+
+def test_missing_fonts_endpoint(client, db):
+    tg_id = "tg_font_negotiation"
+    db.add(User(tg_id=tg_id))
+    db.commit()
+    client.app.dependency_overrides[get_db] = lambda: db
+    try:
+        resp = client.post(
+            "/api/v1/template/fonts/missing",
+            params={"tg_id": tg_id},
+            json={"fonts": [{"name": "Unknown.ttf", "sha256": "0" * 64}]}
+        )
+        assert resp.status_code == 200
+        assert resp.json() == {"missing": ["0" * 64], "linked": []}
+    finally:
+        client.app.dependency_overrides.clear()
+        shutil.rmtree(os.path.join(UPLOAD_DIR, tg_id), ignore_errors=True)
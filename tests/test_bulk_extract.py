@@ -0,0 +1,33 @@
+import os
+import json
+import shutil
+import asyncio
+from bulk_extract import run_bulk_extraction, find_documents
+
+TEST_PDF = os.path.join(os.path.dirname(__file__), "test_invoice.pdf")
+
+
+async def fake_extractor(blocks, table_regions=None):
+    return {"Blocks": {"value": str(len(blocks))}}
+
+
+def test_resume_skips_checkpointed_files(tmp_path):
+    root = tmp_path / "archive"
+    (root / "2024").mkdir(parents=True)
+    for name in ("a.pdf", "2024/b.pdf"):
+        shutil.copy(TEST_PDF, root / name)
+    (root / "broken.pdf").write_bytes(b"not a pdf")
+    output, checkpoint = str(tmp_path / "out.jsonl"), str(tmp_path / "out.ckpt")
+    assert find_documents(str(root)) == ["2024/b.pdf", "a.pdf", "broken.pdf"]
+
+    first = asyncio.run(run_bulk_extraction(str(root), output, checkpoint, 2, files=["a.pdf", "broken.pdf"],
+                                            extractor=fake_extractor))
+    assert (first["ok"], first["failed"]) == (1, 1)
+    assert first["failure_rate"] == 0.5
+
+    second = asyncio.run(run_bulk_extraction(str(root), output, checkpoint, 2, extractor=fake_extractor))
+    assert (second["skipped"], second["ok"], second["failed"]) == (2, 1, 0)
+    with open(output, encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+    assert sorted(r["file"] for r in records) == ["2024/b.pdf", "a.pdf", "broken.pdf"]
+    assert "error" in next(r for r in records if r["file"] == "broken.pdf")
@@ -0,0 +1,29 @@
+import io
+import os
+import json
+import asyncio
+import zipfile
+from services.bulk_service import BulkJob, parse_rows_csv
+from services.document_pool import DocumentPool
+
+TEST_PDF = os.path.join(os.path.dirname(__file__), "test_invoice.pdf")
+FIELDS = {"Total": {"value": "60,00 USD", "bbox": [500, 420, 560, 438], "page": 0, "size": 10.0}}
+
+
+def test_parse_rows_csv_skips_empty_cells():
+    rows = parse_rows_csv('Total,Invoice Date\n"5,00 USD",\n,"June 1, 2030"\n')
+    assert rows == [{"Total": "5,00 USD"}, {"Invoice Date": "June 1, 2030"}]
+
+
+def test_zip_contains_rows_and_report():
+    base = DocumentPool().acquire(1, None, TEST_PDF)
+    job = BulkJob("inv", base, FIELDS, {}, [{"Total": "1,00 USD"}, None, {"Total": "2,00 USD"}])
+
+    async def collect():
+        return b"".join([chunk async for chunk in job.stream_zip()])
+
+    archive = zipfile.ZipFile(io.BytesIO(asyncio.run(collect())))
+    assert archive.namelist() == ["inv_0001.pdf", "inv_0003.pdf", "report.json"]
+    report = json.loads(archive.read("report.json"))
+    assert report["rendered"] == 2
+    assert [r["row"] for r in report["results"] if "error" in r] == [2]
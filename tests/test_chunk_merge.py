@@ -0,0 +1,35 @@
+from services.gemini_service import merge_chunk_fields
+
+
+def test_merge_chunk_fields():
+    page0 = {
+        "Invoice Number": {"value": "INV-1", "page": 0},
+        "Total": None,
+        "Descriptions": [{"value": "Service A", "page": 0}],
+    }
+    page2 = {
+        "Invoice Number": {"value": "INV-X", "page": 2},
+        "Total": {"value": "100", "page": 2},
+        "Descriptions": {"value": "Service B", "page": 2},
+    }
+    merged = merge_chunk_fields([page0, page2])
+    assert merged["Invoice Number"]["value"] == "INV-1"
+    assert merged["Total"]["value"] == "100"
+    assert [d["value"] for d in merged["Descriptions"]] == ["Service A", "Service B"]
+
+
+def test_merge_prefers_higher_confidence():
+    merged = merge_chunk_fields([
+        {"IBAN": {"value": "A", "confidence": 0.4}},
+        {"IBAN": {"value": "B", "confidence": 0.9}},
+    ])
+    assert merged["IBAN"]["value"] == "B"
+
+
+def test_merge_ties_are_deterministic():
+    merged = merge_chunk_fields([
+        {"Total": {"value": "40", "page": 0}, "IBAN": {"value": "A", "page": 0}},
+        {"Total": {"value": "100", "page": 3}, "IBAN": {"value": "B", "page": 3}},
+    ])
+    assert merged["Total"]["value"] == "100"
+    assert merged["IBAN"]["value"] == "A"
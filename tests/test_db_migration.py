@@ -0,0 +1,21 @@
+from sqlalchemy import create_engine, inspect, text
+from models.db import init_db
+
+
+def test_init_db_adds_new_columns_to_existing_tables(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE templates (id INTEGER PRIMARY KEY, user_id INTEGER, file_path VARCHAR, ttf_list JSON, "
+            "parsed_data JSON, is_active INTEGER, updated_at DATETIME, invoice_name VARCHAR, font_map JSON)"
+        ))
+        conn.execute(text("INSERT INTO templates (id, invoice_name) VALUES (1, 'old')"))
+
+    init_db(engine)
+    init_db(engine)
+
+    inspector = inspect(engine)
+    assert {"layout", "file_hash"} <= {c["name"] for c in inspector.get_columns("templates")}
+    assert {"blobs", "blob_refs", "users"} <= set(inspector.get_table_names())
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT invoice_name, file_hash FROM templates")).all() == [("old", None)]
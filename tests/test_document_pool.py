@@ -0,0 +1,37 @@
+import os
+import shutil
+import fitz
+from services.document_pool import DocumentPool
+from utils.pdf import file_sha256, plan_replacement_ops, draw_replacements
+
+TEST_PDF = os.path.join(os.path.dirname(__file__), "test_invoice.pdf")
+TEST_FONT = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+
+
+def test_pool_hits_and_evicts(tmp_path):
+    pool = DocumentPool(max_entries=1)
+    file_hash = file_sha256(TEST_PDF)
+    first = pool.acquire(1, file_hash, TEST_PDF)
+    assert pool.acquire(1, file_hash, TEST_PDF) is first
+    other = str(tmp_path / "other.pdf")
+    shutil.copy(TEST_PDF, other)
+    pool.acquire(2, file_hash, other)
+    stats = pool.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+    assert stats["evictions"] == 1
+    assert stats["entries"] == 1
+
+
+def test_pooled_copy_is_independent():
+    font_map = {"default": TEST_FONT} if os.path.exists(TEST_FONT) else None
+    base = DocumentPool().acquire(1, None, TEST_PDF, font_map)
+    replacements = {"Total": {"old": "60,00 USD", "new": "70,00 USD", "bbox": [500, 420, 560, 438],
+                              "page": 0, "font": "Arial", "size": 10.0}}
+    ops = plan_replacement_ops(base.span_index, replacements, font_map)
+    assert len(ops) == 1
+    font_buffers = {op["fontfile"]: base.font_buffers[op["fontfile"]] for op in ops if op["fontfile"]}
+    with fitz.open(stream=draw_replacements(base.data, ops, font_buffers), filetype="pdf") as doc:
+        assert "70,00 USD" in doc[0].get_text()
+    with fitz.open(stream=base.data, filetype="pdf") as doc:
+        assert "70,00 USD" not in doc[0].get_text()
@@ -0,0 +1,108 @@
+import time
+import threading
+from types import SimpleNamespace
+import pytest
+from models.db import Template
+from services import template_service
+from services.edit_coalescer import EditCoalescer, EditSuperseded
+
+
+def _submit_all(coalescer, edits, apply, gap=0.0):
+    results = [None] * len(edits)
+
+    def request(i, changes):
+        results[i] = coalescer.submit(1, changes, apply)
+
+    threads = []
+    for i, changes in enumerate(edits):
+        t = threading.Thread(target=request, args=(i, changes))
+        t.start()
+        threads.append(t)
+        time.sleep(gap)
+    for t in threads:
+        t.join()
+    return results
+
+
+def test_edits_within_window_render_once():
+    coalescer = EditCoalescer(window_sec=0.2)
+    renders = []
+
+    def apply(changes, superseded):
+        renders.append(changes)
+        return dict(changes)
+
+    results = _submit_all(coalescer, [{"Total": "1"}, {"Total": "2", "Date": "x"}, {"Total": "3"}], apply, gap=0.02)
+
+    assert renders == [{"Total": "3", "Date": "x"}]
+    assert [r[0] for r in results] == [{"Total": "3", "Date": "x"}] * 3
+    assert [r[1:] for r in results] == [(3, False), (3, False), (3, True)]
+    assert coalescer.desired(1) is None
+    assert coalescer.stats()["merged"] == 2
+
+
+def test_running_render_is_cancelled_by_newer_edit():
+    coalescer = EditCoalescer(window_sec=0)
+    started, release = threading.Event(), threading.Event()
+    template_lock = threading.Lock()
+    renders = []
+
+    def apply(changes, superseded):
+        # Как render_flight: рендеры одного шаблона идут по очереди
+        with template_lock:
+            renders.append(changes)
+            if len(renders) == 1:
+                started.set()
+                release.wait()
+            if superseded():
+                raise EditSuperseded()
+            return dict(changes)
+
+    results = [None, None]
+    first = threading.Thread(target=lambda: results.__setitem__(0, coalescer.submit(1, {"A": "1"}, apply)))
+    first.start()
+    started.wait()
+    second = threading.Thread(target=lambda: results.__setitem__(1, coalescer.submit(1, {"B": "2"}, apply)))
+    second.start()
+    while coalescer.desired(1) != {"A": "1", "B": "2"}:
+        time.sleep(0.01)
+    release.set()
+    first.join()
+    second.join()
+
+    assert renders == [{"A": "1"}, {"A": "1", "B": "2"}]
+    assert results[0] == ({"A": "1", "B": "2"}, 1, False)
+    assert results[1] == ({"A": "1", "B": "2"}, 1, True)
+    assert coalescer.stats()["cancelled"] == 1
+
+
+def test_superseded_render_is_not_stored(monkeypatch):
+    stored = []
+    monkeypatch.setattr(template_service, "load_template_layout", lambda *a: (SimpleNamespace(data=b"%PDF"), {}))
+    monkeypatch.setattr(template_service, "plan_render", lambda *a: ([], {}, [], {}))
+    monkeypatch.setattr(template_service.blob_store, "put", lambda *a: stored.append(a))
+
+    with pytest.raises(EditSuperseded):
+        template_service.render_template(Template(invoice_name="inv"), "inv.pdf", "out", {}, {}, lambda: True)
+    assert stored == []
+
+
+def test_confirm_waits_for_pending_edits():
+    coalescer = EditCoalescer(window_sec=0.2)
+    applied, render_threads = [], []
+
+    def apply(changes, superseded):
+        render_threads.append(threading.current_thread())
+        applied.append(changes)
+        return dict(changes)
+
+    request = threading.Thread(target=coalescer.submit, args=(1, {"Total": "9"}, apply))
+    request.start()
+    while coalescer.desired(1) is None:
+        time.sleep(0.01)
+    coalescer.wait(1)
+
+    assert applied == [{"Total": "9"}]
+    assert render_threads[0] is not request
+    request.join()
+    coalescer.wait(1)
@@ -0,0 +1,62 @@
+import time
+import sqlite3
+from services.extraction_cache import ExtractionCache, make_cache_key
+
+BLOCKS = [{"page": 0, "text": "Total", "bbox": [1.0, 2.0, 3.0, 4.0], "font": "Arial", "size": 12.0, "flags": 0}]
+
+
+def test_cache_key_depends_on_prompt_version():
+    assert make_cache_key(BLOCKS, "m", "1") == make_cache_key([dict(BLOCKS[0])], "m", "1")
+    assert make_cache_key(BLOCKS, "m", "1") != make_cache_key(BLOCKS, "m", "2")
+
+
+def test_memory_eviction_falls_back_to_disk(tmp_path):
+    cache = ExtractionCache(path=str(tmp_path / "cache.sqlite3"), memory_entries=1, disk_entries=10)
+    cache.set("a", {"Total": {"value": "1"}})
+    cache.set("b", {"Total": {"value": "2"}})
+    assert cache.get("a") == {"Total": {"value": "1"}}
+    assert cache.get("missing") is None
+    stats = cache.stats()
+    assert stats["disk_hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["memory_evictions"] >= 1
+
+
+def test_ttl_and_disk_limit(tmp_path):
+    cache = ExtractionCache(path=str(tmp_path / "cache.sqlite3"), memory_entries=10, disk_entries=2, ttl_sec=1)
+    for key in ("a", "b", "c"):
+        cache.set(key, {"k": key})
+    assert cache.stats()["disk_entries"] == 2
+    time.sleep(1.1)
+    assert cache.get("c") is None
+
+
+def test_disk_size_limit(tmp_path):
+    cache = ExtractionCache(path=str(tmp_path / "cache.sqlite3"), memory_entries=10, disk_entries=100, disk_bytes=50)
+    for key in ("a", "b", "c"):
+        cache.set(key, {"k": key * 20})
+    stats = cache.stats()
+    assert stats["disk_entries"] == 1
+    assert stats["disk_evictions"] == 2
+
+
+def test_running_totals_survive_reopen_and_old_schema(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE extraction_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+        "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+    )
+    conn.execute("INSERT INTO extraction_cache VALUES ('old', '{\"k\": 1}', ?, ?)", (time.time(), time.time()))
+    conn.commit()
+    conn.close()
+
+    cache = ExtractionCache(path=path, memory_entries=1, disk_entries=10, ttl_sec=60, expire_interval_sec=0)
+    cache.set("a", {"k": "a"})
+    cache.set("a", {"k": "aa"})
+    assert cache.get("old") == {"k": 1}
+    stats = cache.stats()
+    assert stats["disk_entries"] == 2
+    assert stats["disk_bytes"] == len('{"k": 1}') + len('{"k": "aa"}')
+    reopened = ExtractionCache(path=path).stats()
+    assert (reopened["disk_entries"], reopened["disk_bytes"]) == (stats["disk_entries"], stats["disk_bytes"])
@@ -0,0 +1,36 @@
+import os
+from utils.pdf import extract_blocks_from_pdf
+from utils.field_rules import extract_fields_by_rules, iban_is_valid, bic_is_valid, parse_date
+
+TEST_PDF = os.path.join(os.path.dirname(__file__), "test_invoice.pdf")
+
+
+def test_validators():
+    assert iban_is_valid("DE89 3704 0044 0532 0130 00")
+    assert not iban_is_valid("DE89370400440532013001")
+    assert bic_is_valid("DEUTDEFF500")
+    assert not bic_is_valid("DEUT1")
+    assert parse_date("March 26th, 2025").day == 26
+
+
+def test_rules_on_sample_invoice():
+    fields = extract_fields_by_rules(extract_blocks_from_pdf(TEST_PDF))
+    assert fields["Invoice Date"]["value"] == "March 26, 2025"
+    assert fields["Total"]["value"] == "60,00 USD"
+    assert fields["Total"]["bbox"][0] > 500
+    assert fields["Account Number"]["value"] == "4101707073257313"
+    assert fields["Currency"]["value"] == "USD"
+    assert fields["Client Phone"]["value"] == "+971563101559"
+
+
+def test_iban_and_swift_pairing():
+    blocks = [
+        {"page": 0, "text": "IBAN:", "bbox": [10, 10, 40, 22], "font": "Arial", "size": 12.0},
+        {"page": 0, "text": "GB82 WEST 1234 5698 7654 32", "bbox": [50, 10, 220, 22], "font": "Arial", "size": 12.0},
+        {"page": 0, "text": "SWIFT", "bbox": [10, 40, 40, 52], "font": "Arial", "size": 12.0},
+        {"page": 0, "text": "DEUTDEFF", "bbox": [10, 55, 70, 67], "font": "Arial", "size": 12.0},
+    ]
+    fields = extract_fields_by_rules(blocks)
+    assert fields["IBAN"]["value"] == "GB82 WEST 1234 5698 7654 32"
+    assert fields["SWIFT"]["bbox"] == [10, 55, 70, 67]
+
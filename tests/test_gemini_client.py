@@ -0,0 +1,75 @@
+import asyncio
+import pytest
+from google.api_core.exceptions import InvalidArgument, ServiceUnavailable
+from services.gemini_client import GeminiClient
+
+
+class _Response:
+    def __init__(self, text):
+        self.text = text
+
+
+class _FlakyModel:
+    def __init__(self, failures, delay=0.0, error=ServiceUnavailable):
+        self.failures = failures
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+
+    async def generate_content_async(self, prompt, generation_config=None):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error("temporary")
+        await asyncio.sleep(self.delay)
+        return _Response('{"Total": null}')
+
+
+def test_retries_with_backoff():
+    client = GeminiClient(retries=2, backoff_sec=0.01)
+    model = _FlakyModel(failures=2)
+    client._models["m"] = model
+    assert asyncio.run(client.generate("prompt", "m")) == '{"Total": null}'
+    assert model.calls == 3
+    assert client.stats()["retries"] == 2
+
+
+def test_deadline_exceeded():
+    client = GeminiClient(retries=0, timeout_sec=0.05)
+    client._models["m"] = _FlakyModel(failures=0, delay=1.0)
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(client.generate("prompt", "m"))
+    assert client.stats()["timeouts"] == 1
+
+
+def test_hedged_request_after_p95():
+    client = GeminiClient(hedge=True, hedge_min_samples=1)
+    client.record_latency(0.01)
+    model = _FlakyModel(failures=0, delay=0.05)
+    client._models["m"] = model
+    assert asyncio.run(client.generate("prompt", "m")) == '{"Total": null}'
+    assert model.calls == 2
+    assert client.stats()["hedges"] == 1
+
+
+def test_client_errors_are_not_retried():
+    client = GeminiClient(retries=2, backoff_sec=0.01)
+    model = _FlakyModel(failures=1, error=InvalidArgument)
+    client._models["m"] = model
+    with pytest.raises(InvalidArgument):
+        asyncio.run(client.generate("prompt", "m"))
+    assert model.calls == 1
+    assert client.stats()["retries"] == 0
+
+
+def test_waiting_for_a_slot_does_not_trigger_hedge():
+    client = GeminiClient(concurrency=1, hedge=True, hedge_min_samples=1)
+    client.record_latency(0.05)
+    model = _FlakyModel(failures=0, delay=0.03)
+    client._models["m"] = model
+
+    async def main():
+        return await asyncio.gather(*(client.generate("prompt", "m") for _ in range(3)))
+
+    assert asyncio.run(main()) == ['{"Total": null}'] * 3
+    assert model.calls == 3
+    assert client.stats()["hedges"] == 0
@@ -0,0 +1,22 @@
+import asyncio
+import hashlib
+import io
+import pytest
+from fastapi import UploadFile
+from utils.ingest import read_upload, write_bytes_atomic, UploadTooLarge
+
+
+def test_read_upload_hashes_in_one_pass(tmp_path):
+    payload = b"%PDF" + b"x" * (3 * 1024 * 1024)
+    upload = asyncio.run(read_upload(UploadFile(io.BytesIO(payload), filename="a.pdf"), 4 * 1024 * 1024))
+    assert upload.data == payload
+    assert upload.sha256 == hashlib.sha256(payload).hexdigest()
+    target = tmp_path / "a.pdf"
+    write_bytes_atomic(str(target), upload.data)
+    assert target.read_bytes() == payload
+    assert [p.name for p in tmp_path.iterdir()] == ["a.pdf"]
+
+
+def test_read_upload_stops_at_limit():
+    with pytest.raises(UploadTooLarge):
+        asyncio.run(read_upload(UploadFile(io.BytesIO(b"x" * 2048), filename="a.pdf"), 1024))
@@ -0,0 +1,102 @@
+import asyncio
+import pytest
+from fastapi import HTTPException
+from services.job_queue import JobQueue, ScenarioJob
+
+
+def test_background_job_records_steps():
+    queue = JobQueue(workers=1, max_depth=4)
+    job = queue.create("tg_1", "upload")
+
+    async def run():
+        await job.run_step("extract_fonts", asyncio.sleep(0.01))
+        async with job.step_context("parse_fields") as entry:
+            entry["message"] = "ok"
+        job.finish()
+
+    async def main():
+        queue.submit(job, run)
+        while not job.done:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(main())
+    scenario = job.scenario()
+    assert scenario.status == "finished"
+    assert [e["step"] for e in scenario.log] == ["extract_fonts", "parse_fields"]
+    assert scenario.log[0]["duration_sec"] >= 0.01
+    assert scenario.log[1]["message"] == "ok"
+    assert queue.stats()["finished"] == 1
+
+
+def test_failed_step_marks_scenario_error():
+    queue = JobQueue(workers=1)
+    job = queue.create("tg_1", "select")
+
+    async def run():
+        async with job.step_context("upload"):
+            raise HTTPException(500, "MinIO download error")
+
+    async def main():
+        queue.submit(job, run)
+        while not job.done:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(main())
+    scenario = job.scenario()
+    assert scenario.status == "error"
+    assert scenario.error_message == "MinIO download error"
+    assert scenario.log[0]["status"] == "error"
+    assert queue.get(job.scenario_id) is job
+
+
+def test_full_queue_rejects():
+    queue = JobQueue(workers=0, max_depth=1)
+
+    async def main():
+        queue.submit(queue.create("tg_1", "upload"), lambda: asyncio.sleep(0))
+        with pytest.raises(HTTPException):
+            queue.submit(queue.create("tg_1", "upload"), lambda: asyncio.sleep(0))
+
+    asyncio.run(main())
+    assert queue.stats()["rejected"] == 1
+
+
+class _MemoryStore:
+    def __init__(self):
+        self.states = {}
+
+    def save(self, job):
+        self.states[job.scenario_id] = job.state()
+
+    def load(self, scenario_id):
+        state = self.states.get(scenario_id)
+        return ScenarioJob.from_state(state) if state else None
+
+    def delete(self, scenario_id):
+        self.states.pop(scenario_id, None)
+
+    def stats(self):
+        return {"saved": len(self.states)}
+
+
+def test_background_scenario_is_visible_to_other_replicas():
+    store = _MemoryStore()
+    owner, other = JobQueue(workers=1, store=store), JobQueue(workers=0, store=store)
+    job = owner.create("tg_1", "upload")
+
+    async def run():
+        await job.run_step("parse_fields", asyncio.sleep(0))
+        job.finish()
+        job.result = {"invoice_name": "inv"}
+
+    async def main():
+        owner.submit(job, run)
+        while not job.done:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(main())
+    seen = other.get(job.scenario_id)
+    assert seen is not job
+    assert seen.scenario().status == "finished"
+    assert seen.result == {"invoice_name": "inv"}
+    assert [e["step"] for e in seen.scenario().log] == ["parse_fields"]
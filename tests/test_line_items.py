@@ -0,0 +1,72 @@
+from services.gemini_service import extract_rule_fields
+from utils.line_items import detect_line_items
+
+
+def _span(text, bbox, font="Arial", size=12.0, page=0):
+    return {"page": page, "text": text, "bbox": bbox, "font": font, "size": size, "flags": 0}
+
+
+BLOCKS = [
+    _span("Invoice Number: 42", [20, 20, 140, 34]),
+    _span("Description", [20, 100, 90, 114]),
+    _span("Qty", [300, 100, 320, 114]),
+    _span("Price", [380, 100, 410, 114]),
+    _span("Amount", [480, 100, 530, 114]),
+    _span("Design work", [20, 120, 100, 134]),
+    _span("2", [305, 120, 312, 134]),
+    _span("50.00", [380, 120, 410, 134]),
+    _span("100.00", [490, 120, 530, 134]),
+    _span("Hosting", [20, 140, 70, 154]),
+    _span("1", [305, 140, 312, 154]),
+    _span("20.00", [380, 140, 410, 154]),
+    _span("20.00", [495, 140, 530, 154]),
+    _span("Subtotal", [380, 170, 430, 184]),
+    _span("120.00", [490, 170, 530, 184]),
+]
+
+
+def test_detect_line_items():
+    items, indices, complete = detect_line_items(BLOCKS)
+    assert complete
+    assert [item["value"] for item in items] == ["Design work", "Hosting"]
+    assert items[0]["amount"]["value"] == "100.00"
+    assert items[1]["qty"]["value"] == "1"
+    assert items[0]["bbox"] == [20, 120, 100, 134]
+    assert 0 not in indices and 13 not in indices
+    assert set(range(1, 13)) <= set(indices)
+
+
+def test_no_table():
+    assert detect_line_items(BLOCKS[:1]) == ([], [], False)
+
+
+def test_table_continues_on_next_page():
+    first_page = BLOCKS[1:9]
+    repeated = [
+        _span("Description", [20, 40, 90, 54], page=1), _span("Qty", [300, 40, 320, 54], page=1),
+        _span("Price", [380, 40, 410, 54], page=1), _span("Amount", [480, 40, 530, 54], page=1),
+        _span("Support", [20, 60, 70, 74], page=1), _span("3", [305, 60, 312, 74], page=1),
+        _span("10.00", [380, 60, 410, 74], page=1), _span("30.00", [495, 60, 530, 74], page=1),
+    ]
+    headless = [
+        _span("Page 3", [20, 10, 60, 24], page=2),
+        _span("Licenses", [20, 40, 80, 54], page=2), _span("40.00", [495, 40, 530, 54], page=2),
+        _span("Total", [380, 70, 410, 84], page=2), _span("170.00", [490, 70, 530, 84], page=2),
+    ]
+    items, indices, complete = detect_line_items(first_page + repeated + headless)
+    assert [item["value"] for item in items] == ["Design work", "Support", "Licenses"]
+    assert [item["page"] for item in items] == [0, 1, 2]
+    assert complete
+
+    items, _, complete = detect_line_items(first_page + repeated)
+    assert len(items) == 2 and not complete
+
+
+def test_incomplete_table_is_still_asked_from_gemini():
+    _, missing, llm_blocks = extract_rule_fields(BLOCKS)
+    assert "Descriptions" not in missing and len(llm_blocks) < len(BLOCKS)
+
+    cut = BLOCKS[:13]
+    rule_fields, missing, llm_blocks = extract_rule_fields(cut)
+    assert [item["value"] for item in rule_fields["Descriptions"]] == ["Design work", "Hosting"]
+    assert "Descriptions" in missing and llm_blocks == cut
@@ -0,0 +1,37 @@
+from services import minio_service
+
+
+class FakeStat:
+    def __init__(self, metadata):
+        self.metadata = metadata
+
+
+def test_batch_skips_unchanged_objects(tmp_path, monkeypatch):
+    stored = {}
+    uploaded = []
+
+    def stat_object(bucket, name):
+        return FakeStat({"x-amz-meta-sha256": stored[name]} if name in stored else {})
+
+    def fput_object(bucket, name, path, content_type=None, metadata=None):
+        uploaded.append(name)
+        stored[name] = metadata[minio_service.SHA256_META]
+
+    monkeypatch.setattr(minio_service.minio_client, "stat_object", stat_object)
+    monkeypatch.setattr(minio_service.minio_client, "fput_object", fput_object)
+    a = tmp_path / "a.txt"
+    b = tmp_path / "b.txt"
+    a.write_text("fonts")
+    b.write_text("v1")
+    items = [(str(a), "u/a.txt", "text/plain"), (str(b), "u/b.txt", "text/plain")]
+
+    first = minio_service.minio_upload_batch(items)
+    assert sorted(uploaded) == ["u/a.txt", "u/b.txt"]
+    assert not first["u/a.txt"]["skipped"]
+
+    b.write_text("v2")
+    second = minio_service.minio_upload_batch(items)
+    assert second["u/a.txt"]["skipped"]
+    assert not second["u/b.txt"]["skipped"]
+    assert uploaded.count("u/b.txt") == 2
+    assert second["u/b.txt"]["url"].endswith("/u/b.txt")
@@ -0,0 +1,54 @@
+import os
+import fitz
+from models.db import Template
+from services import template_service
+from services.document_pool import DocumentPool
+from utils.pdf import file_sha256
+
+TEST_PDF = os.path.join(os.path.dirname(__file__), "test_invoice.pdf")
+
+LAYOUT = {
+    "Bank Name": {
+        "value": "Credo Bank", "bbox": [97.0, 509.5, 157.0, 524.1],
+        "font": "ProximaNova-Regular", "size": 12.0, "page": 0
+    },
+    "Total": {
+        "value": "60,00 USD", "bbox": [504.8, 421.8, 563.2, 436.5],
+        "font": "ProximaNova-Regular", "size": 12.0, "page": 0
+    },
+}
+
+
+def _no_gemini(blocks, table_regions=None):
+    raise AssertionError("Gemini не должен вызываться при наличии сохраненной разметки")
+
+
+class _MemoryBlobs:
+    def __init__(self):
+        self.blobs = {}
+
+    def put(self, data, name, sha256):
+        self.blobs[sha256] = data
+        return sha256
+
+    def link(self, sha256, dirpath, name):
+        path = os.path.join(dirpath, name)
+        with open(path, "wb") as f:
+            f.write(self.blobs[sha256])
+        return path
+
+
+def test_render_from_stored_layout(tmp_path, monkeypatch):
+    monkeypatch.setattr(template_service, "document_pool", DocumentPool())
+    monkeypatch.setattr(template_service, "blob_store", _MemoryBlobs())
+    monkeypatch.setattr(template_service, "extract_fields_with_bbox_gemini", _no_gemini)
+    template = Template(id=1, invoice_name="inv", file_path=TEST_PDF, layout=LAYOUT, file_hash=file_sha256(TEST_PDF))
+
+    result = template_service.render_template(template, TEST_PDF, str(tmp_path), {"Total": "99,00 USD"}, None)
+
+    assert result["changed_count"] == 1
+    assert result["fields_changed"] == {"Total": "99,00 USD"}
+    assert result["fields_found"]["Bank Name"] == "Credo Bank"
+    assert result["output_name"] == template_service.output_pdf_name("inv", result["sha256"])
+    with fitz.open(result["output_pdf"]) as doc:
+        assert "99,00 USD" in doc[0].get_text()
@@ -0,0 +1,19 @@
+from utils.pdf import merge_overlapping_ops
+
+
+def test_currency_inside_amount_is_one_op():
+    total = {"field": "Total", "page": 0, "rect": [500, 10, 560, 22], "old": "60,00 USD", "text": "70,00 USD"}
+    currency = {"field": "Currency", "page": 0, "rect": [540, 10, 560, 22], "old": "USD", "text": "EUR"}
+    ops = merge_overlapping_ops([currency, total])
+    assert len(ops) == 1
+    assert ops[0]["text"] == "70,00 EUR"
+    assert ops[0]["rect"] == [500, 10, 560, 22]
+    assert merge_overlapping_ops([currency]) == [currency]
+
+
+def test_adjacent_fields_keep_their_own_ops():
+    date = {"field": "Invoice Date", "page": 0, "rect": [100, 10, 180, 22], "old": "March 26, 2025", "text": "April 1, 2025"}
+    number = {"field": "Invoice Number", "page": 0, "rect": [175, 10, 230, 22], "old": "INV-7", "text": "INV-8"}
+    ops = merge_overlapping_ops([date, number])
+    assert sorted(op["field"] for op in ops) == ["Invoice Date", "Invoice Number"]
+    assert {op["field"]: op["rect"] for op in ops} == {"Invoice Date": date["rect"], "Invoice Number": number["rect"]}
@@ -0,0 +1,74 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import fitz
+import pytest
+from fastapi import HTTPException
+from services.pdf_pool import PdfProcessPool
+from utils.pdf import parse_pdf_bytes, draw_replacements, plan_replacement_ops
+from utils.span_index import SpanIndex
+
+TEST_PDF = os.path.join(os.path.dirname(__file__), "test_invoice.pdf")
+
+
+@pytest.fixture(scope="module")
+def pool():
+    pool = PdfProcessPool(workers=1, max_tasks=2, timeout=30)
+    yield pool
+    pool.shutdown()
+
+
+def test_render_in_worker_process(pool):
+    with open(TEST_PDF, "rb") as f:
+        data = f.read()
+    parsed = pool.run(parse_pdf_bytes, data)
+    index = SpanIndex.from_tuples(parsed["spans"])
+    ops = plan_replacement_ops(index, {"Total": {"old": "60,00 USD", "new": "70,00 USD",
+                                                 "bbox": [500, 420, 560, 438], "page": 0}})
+    output = pool.run(draw_replacements, data, ops, {})
+    with fitz.open(stream=output, filetype="pdf") as doc:
+        assert "70,00 USD" in doc[0].get_text()
+    # третья задача идет в новый процесс (max_tasks=2)
+    assert sorted(pool.run(parse_pdf_bytes, data)["fonts"]) == sorted(parsed["fonts"])
+    assert pool.stats()["completed"] == 3
+
+
+def test_timeout_restarts_pool(pool):
+    with pytest.raises(HTTPException) as exc:
+        pool.run(time.sleep, 10, timeout=0.5)
+    assert exc.value.status_code == 504
+    assert pool.run(abs, -1) == 1
+    stats = pool.stats()
+    assert stats["timeouts"] == 1
+    assert stats["restarts"] == 1
+    assert stats["in_flight"] == 0
+
+
+def test_queue_wait_does_not_count_towards_timeout():
+    pool = PdfProcessPool(workers=1, timeout=0.5)
+    try:
+        pool.run(abs, 0)
+        with ThreadPoolExecutor(max_workers=3) as threads:
+            results = list(threads.map(lambda _: pool.run(time.sleep, 0.3), range(3)))
+        assert results == [None] * 3
+        assert pool.stats()["timeouts"] == 0
+    finally:
+        pool.shutdown()
+
+
+def test_queued_tasks_survive_a_killed_worker():
+    pool = PdfProcessPool(workers=1, timeout=0.5)
+    try:
+        pool.run(abs, 0)
+        with ThreadPoolExecutor(max_workers=2) as threads:
+            stuck = threads.submit(pool.run, time.sleep, 10)
+            time.sleep(0.2)
+            queued = threads.submit(pool.run, abs, -2)
+            assert queued.result() == 2
+            with pytest.raises(HTTPException) as exc:
+                stuck.result()
+        assert exc.value.status_code == 504
+        stats = pool.stats()
+        assert stats["timeouts"] == 1 and stats["retried"] == 1
+    finally:
+        pool.shutdown()
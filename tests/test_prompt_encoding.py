@@ -0,0 +1,44 @@
+from utils.prompt_encoding import (
+    encode_blocks_compact, merge_spans_into_lines, chunk_blocks_by_budget, estimate_tokens, raw_blocks_json,
+    encode_blocks
+)
+
+
+def _span(text, bbox, page=0, font="Arial", size=12.0):
+    return {"page": page, "text": text, "bbox": bbox, "font": font, "size": size, "flags": 0}
+
+
+BLOCKS = [
+    _span("Invoice", [10.123456, 10.0, 60.987654, 22.0]),
+    _span("INV-001", [63.0, 10.0, 110.0, 22.0]),
+    _span("", [0.0, 0.0, 0.0, 0.0]),
+    _span("Total", [10.0, 40.0, 40.0, 52.0], font="Arial-Bold"),
+    _span("Page two", [10.0, 10.0, 60.0, 22.0], page=1),
+]
+
+
+def test_merge_drops_empty_and_joins_line():
+    lines = merge_spans_into_lines(BLOCKS)
+    assert [line["text"] for line in lines] == ["Invoice INV-001", "Total", "Page two"]
+    assert lines[0]["bbox"] == [10.123456, 10.0, 110.0, 22.0]
+
+
+def test_compact_encoding_is_smaller():
+    encoded = encode_blocks_compact(BLOCKS)
+    assert "0=Arial/12" in encoded
+    assert "0|10.1|10|110|22|0|Invoice INV-001" in encoded
+    assert len(encoded) < len(raw_blocks_json(BLOCKS))
+
+
+def test_chunk_by_budget_splits_pages():
+    chunks = chunk_blocks_by_budget(BLOCKS, estimate_tokens(encode_blocks_compact(BLOCKS[:4])))
+    assert [{b["page"] for b in chunk} for chunk in chunks] == [{0}, {1}]
+
+
+def test_oversized_page_is_split_without_dropping_blocks():
+    page = [_span(f"Row {i}", [10.0, 10.0 + 20 * i, 60.0, 22.0 + 20 * i]) for i in range(10)]
+    budget = estimate_tokens(raw_blocks_json(page)) // 3
+    chunks = chunk_blocks_by_budget(page, budget, encode_blocks)
+    assert len(chunks) > 1
+    assert [b for chunk in chunks for b in chunk] == page
+    assert all(estimate_tokens(encode_blocks(chunk)) <= budget for chunk in chunks)
@@ -0,0 +1,67 @@
+import time
+import threading
+from services.render_flight import RenderFlight
+
+
+def test_identical_renders_share_one_run_and_others_serialize():
+    flight = RenderFlight()
+    calls, active, overlaps = [], [], []
+    started = threading.Event()
+
+    def render(name):
+        def run():
+            started.set()
+            overlaps.append(len(active))
+            active.append(name)
+            time.sleep(0.05)
+            active.remove(name)
+            calls.append(name)
+            return name
+        return run
+
+    results = {}
+
+    def request(i, key):
+        results[i] = flight.run(1, key, render(key))
+
+    first = threading.Thread(target=request, args=(0, "a"))
+    first.start()
+    started.wait()
+    others = [threading.Thread(target=request, args=(i, key)) for i, key in ((1, "a"), (2, "b"))]
+    for t in others:
+        t.start()
+    for t in [first] + others:
+        t.join()
+
+    assert results == {0: "a", 1: "a", 2: "b"}
+    assert sorted(calls) == ["a", "b"]
+    assert overlaps == [0, 0]
+    stats = flight.stats()
+    assert stats["runs"] == 2 and stats["coalesced"] == 1 and stats["in_flight"] == 0
+
+
+def test_errors_reach_waiting_requests():
+    flight = RenderFlight()
+    gate = threading.Event()
+    errors = []
+
+    def failing():
+        gate.wait()
+        raise ValueError("broken template")
+
+    def request():
+        try:
+            flight.run(7, "k", failing)
+        except ValueError as e:
+            errors.append(str(e))
+
+    threads = [threading.Thread(target=request) for _ in range(2)]
+    for t in threads:
+        t.start()
+    while flight.stats()["coalesced"] < 1:
+        time.sleep(0.01)
+    gate.set()
+    for t in threads:
+        t.join()
+    assert errors == ["broken template", "broken template"]
+    assert flight.stats()["failed"] == 1
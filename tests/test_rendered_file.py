@@ -0,0 +1,25 @@
+import os
+import shutil
+from services.template_service import UPLOAD_DIR
+
+TEST_PDF = os.path.join(os.path.dirname(__file__), "test_invoice.pdf")
+
+
+def test_rendered_pdf_is_streamed_from_disk(client):
+    user_dir = os.path.join(UPLOAD_DIR, "tg_rendered_test")
+    os.makedirs(user_dir, exist_ok=True)
+    shutil.copy(TEST_PDF, os.path.join(user_dir, "invoice_updated.pdf"))
+    try:
+        resp = client.get("/api/v1/file/rendered", params={"tg_id": "tg_rendered_test", "filename": "invoice_updated.pdf"})
+        assert resp.status_code == 200
+        assert resp.headers["content-type"] == "application/pdf"
+        with open(TEST_PDF, "rb") as f:
+            assert resp.content == f.read()
+
+        bad = client.get("/api/v1/file/rendered", params={"tg_id": "tg_rendered_test", "filename": "../x.pdf"})
+        assert bad.status_code == 400
+        for tg_id in ("../tests", "..", "tg/../../tests"):
+            outside = client.get("/api/v1/file/rendered", params={"tg_id": tg_id, "filename": "test_invoice.pdf"})
+            assert outside.status_code == 400
+    finally:
+        shutil.rmtree(user_dir)
@@ -0,0 +1,73 @@
+import os
+import hashlib
+from services import shared_templates as shared
+
+TEST_PDF = os.path.join(os.path.dirname(__file__), "test_invoice.pdf")
+
+
+class FakeStat:
+    def __init__(self, etag):
+        self.etag = etag
+
+
+class FakeResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+    def close(self):
+        pass
+
+    def release_conn(self):
+        pass
+
+
+class FakeMinio:
+    def __init__(self, objects):
+        self.objects = dict(objects)
+        self.downloads = []
+
+    def stat_object(self, bucket, name):
+        return FakeStat(f'"{hashlib.md5(self.objects[name]).hexdigest()}"')
+
+    def get_object(self, bucket, name, request_headers=None):
+        if name not in self.objects:
+            raise shared.S3Error("NoSuchKey", "missing", name, "req", "host", None)
+        self.downloads.append(name)
+        return FakeResponse(self.objects[name])
+
+    def put_object(self, bucket, name, data, length, content_type=None, metadata=None):
+        self.objects[name] = data.read()
+
+
+def test_artifacts_built_once_per_etag(tmp_path, monkeypatch):
+    with open(TEST_PDF, "rb") as f:
+        pdf = f.read()
+    fake = FakeMinio({"templates/a.pdf": pdf})
+    builds = []
+    monkeypatch.setattr(shared, "minio_client", fake)
+    monkeypatch.setattr(shared, "extract_fields_with_bbox_gemini", lambda blocks, tables: builds.append(1) or {"Total": {"value": "1"}})
+
+    store = shared.SharedTemplateStore(str(tmp_path))
+    path, etag = store.fetch_source("templates/a.pdf")
+    artifacts, source = store.artifacts("templates/a.pdf", etag, path)
+    assert source == "build"
+    assert artifacts["sha256"] == hashlib.sha256(pdf).hexdigest()
+    assert "templates/a.pdf.artifacts.json" in fake.objects
+    assert store.artifacts("templates/a.pdf", etag, path)[1] == "memory"
+    assert store.parsed_for(artifacts["sha256"])["spans"]
+
+    # Другой инстанс: исходник не перекачивается, артефакты берутся с диска
+    other = shared.SharedTemplateStore(str(tmp_path))
+    assert other.fetch_source("templates/a.pdf") == (path, etag)
+    assert other.artifacts("templates/a.pdf", etag, path)[1] == "local"
+    assert fake.downloads == ["templates/a.pdf"]
+
+    # Новая версия шаблона: старые файлы удаляются, артефакты собираются заново
+    fake.objects["templates/a.pdf"] = pdf + b"\n"
+    new_path, new_etag = store.fetch_source("templates/a.pdf")
+    assert new_etag != etag and not os.path.exists(path)
+    assert store.artifacts("templates/a.pdf", new_etag, new_path)[1] == "build"
+    assert len(builds) == 2
@@ -0,0 +1,50 @@
+import os
+from utils.pdf import DocumentAnalysis, parse_pdf_bytes
+from utils.span_index import SpanIndex
+
+TEST_PDF = os.path.join(os.path.dirname(__file__), "test_invoice.pdf")
+
+
+def test_duplicate_values_resolved_by_proximity():
+    with DocumentAnalysis(TEST_PDF) as analysis:
+        index = analysis.span_index
+    subtotal = index.locate(0, "60,00 USD", [500, 390, 560, 410])
+    total = index.locate(0, "60,00 USD", [500, 420, 560, 438])
+    assert 393 < subtotal[1] < 395
+    assert 421 < total[1] < 423
+
+
+def test_substring_bbox_from_glyphs():
+    with DocumentAnalysis(TEST_PDF) as analysis:
+        index = analysis.span_index
+    bbox = index.locate(0, "Credo Bank", [90, 509, 160, 524])
+    assert bbox[0] > 90
+    assert abs(bbox[2] - 157.0) < 1
+
+
+def test_case_and_whitespace_insensitive():
+    with DocumentAnalysis(TEST_PDF) as analysis:
+        index = analysis.span_index
+    exact = index.locate(0, "Credo Bank", [90, 509, 160, 524])
+    assert index.locate(0, "credo   BANK", [90, 509, 160, 524]) == exact
+
+
+def test_value_across_spans_and_miss_returns_none():
+    blocks = [
+        {"page": 0, "text": "Invoice:", "bbox": [0, 10, 9, 20]},
+        {"page": 0, "text": "INV", "bbox": [10, 10, 30, 20]},
+        {"page": 0, "text": "-001", "bbox": [31, 10, 50, 20]},
+        {"page": 0, "text": "Due", "bbox": [10, 40, 30, 50]},
+    ]
+    index = SpanIndex.from_blocks(blocks)
+    assert index.locate(0, "inv-001", [10, 10, 50, 20]) == [10, 10, 50, 20]
+    assert index.locate(0, "INV-002", [0, 10, 50, 20]) is None
+    assert index.locate(1, "INV-001") is None
+
+
+def test_index_from_serialized_spans_matches_document():
+    with DocumentAnalysis(TEST_PDF) as analysis:
+        direct = analysis.span_index.locate(0, "Credo Bank", [90, 509, 160, 524])
+    with open(TEST_PDF, "rb") as f:
+        parsed = parse_pdf_bytes(f.read())
+    assert SpanIndex.from_tuples(parsed["spans"]).locate(0, "Credo Bank", [90, 509, 160, 524]) == direct
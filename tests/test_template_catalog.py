@@ -0,0 +1,57 @@
+from services import template_catalog as catalog_module
+from services.template_catalog import TemplateCatalog, template_catalog, template_id_for
+
+
+class FakeObject:
+    def __init__(self, name, etag="e1"):
+        self.object_name = name
+        self.etag = f'"{etag}"'
+        self.size = 100
+
+
+class FakeMinio:
+    def __init__(self, names):
+        self.objects = [FakeObject(n) for n in names]
+        self.calls = 0
+
+    def list_objects(self, bucket, prefix=None, recursive=False):
+        self.calls += 1
+        return iter(self.objects)
+
+
+def test_catalog_pages_with_stable_ids(monkeypatch):
+    fake = FakeMinio([f"templates/t{i:02d}.pdf" for i in range(25)] + ["templates/notes.txt"])
+    monkeypatch.setattr(catalog_module, "minio_client", fake)
+    catalog = TemplateCatalog(ttl=60)
+
+    first = catalog.page(1, 10)
+    last = catalog.page(3, 10)
+    assert first["total"] == 25 and first["pages"] == 3
+    assert [t["template_name"] for t in last["templates"]] == ["t20.pdf", "t21.pdf", "t22.pdf", "t23.pdf", "t24.pdf"]
+    assert first["templates"][0]["template_id"] == template_id_for("templates/t00.pdf")
+    assert catalog.get(template_id_for("templates/t07.pdf"))["object_name"] == "templates/t07.pdf"
+    assert fake.calls == 1
+
+    version = first["version"]
+    fake.objects[0] = FakeObject("templates/t00.pdf", etag="e2")
+    assert catalog.page(1, 10)["version"] == version
+    catalog.invalidate()
+    assert catalog.page(1, 10)["version"] != version
+    assert fake.calls == 2
+
+
+def test_templates_endpoint_conditional(client, monkeypatch):
+    monkeypatch.setattr(catalog_module, "minio_client", FakeMinio(["templates/a.pdf", "templates/b.docx"]))
+    template_catalog.invalidate()
+
+    resp = client.get("/api/v1/template/templates", params={"page_size": 1})
+    assert resp.status_code == 200
+    assert resp.json()["templates"][0]["template_name"] == "a.pdf"
+    etag = resp.headers["etag"]
+
+    again = client.get("/api/v1/template/templates", params={"page_size": 1}, headers={"If-None-Match": etag})
+    assert again.status_code == 304
+    other_page = client.get("/api/v1/template/templates", params={"page": 2, "page_size": 1},
+                            headers={"If-None-Match": etag})
+    assert other_page.status_code == 200
+    template_catalog.invalidate()
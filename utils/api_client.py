@@ -0,0 +1,179 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import json as jsonlib
+from collections import deque
+from typing import AsyncIterator, Dict, Optional
+import aiohttp
+
+logger = logging.getLogger("invoicebot.api_client")
+
+API_MAX_CONNECTIONS = int(os.getenv("API_MAX_CONNECTIONS", "100"))
+API_MAX_CONNECTIONS_PER_HOST = int(os.getenv("API_MAX_CONNECTIONS_PER_HOST", "20"))
+API_TIMEOUT_SEC = float(os.getenv("API_TIMEOUT_SEC", "120"))
+API_CONNECT_TIMEOUT_SEC = float(os.getenv("API_CONNECT_TIMEOUT_SEC", "5"))
+API_RETRIES = int(os.getenv("API_RETRIES", "2"))
+API_BACKOFF_SEC = float(os.getenv("API_BACKOFF_SEC", "0.3"))
+
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS")
+RETRY_STATUSES = (502, 503, 504)
+
+
+class ApiResponse:
+    """Ответ, прочитанный целиком: соединение сразу возвращается в пул."""
+
+    def __init__(self, status: int, headers, body: bytes):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def json(self):
+        return jsonlib.loads(self.body) if self.body else {}
+
+
+class ApiClient:
+    """
+    Общий HTTP-клиент бота: одна ClientSession на процесс (keep-alive, лимит соединений
+    на хост), таймауты на запрос и соединение, повторы с джиттером для идемпотентных
+    запросов (GET/HEAD) при сетевых ошибках и 502/503/504. Собирает задержки по эндпоинтам
+    и число новых/переиспользованных соединений.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        limit: int = API_MAX_CONNECTIONS,
+        limit_per_host: int = API_MAX_CONNECTIONS_PER_HOST,
+        timeout_sec: float = API_TIMEOUT_SEC,
+        connect_timeout_sec: float = API_CONNECT_TIMEOUT_SEC,
+        retries: int = API_RETRIES,
+        backoff_sec: float = API_BACKOFF_SEC
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = aiohttp.ClientTimeout(total=timeout_sec, connect=connect_timeout_sec)
+        self.retries = retries
+        self.backoff_sec = backoff_sec
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._latencies: Dict[str, deque] = {}
+        self._counters = {
+            "requests": 0, "errors": 0, "retries": 0, "timeouts": 0,
+            "connections_created": 0, "connections_reused": 0,
+        }
+
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        trace = aiohttp.TraceConfig()
+
+        async def on_create(session, ctx, params):
+            self._counters["connections_created"] += 1
+
+        async def on_reuse(session, ctx, params):
+            self._counters["connections_reused"] += 1
+
+        trace.on_connection_create_end.append(on_create)
+        trace.on_connection_reuseconn.append(on_reuse)
+        return trace
+
+    async def start(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host),
+                timeout=self.timeout,
+                trace_configs=[self._trace_config()]
+            )
+            logger.info(f"HTTP-клиент запущен: {self.base_url}, до {self.limit_per_host} соединений на хост")
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logger.info(f"HTTP-клиент остановлен: {self.stats()}")
+        self._session = None
+
+    def url(self, path: str) -> str:
+        if path.startswith(("http://", "https://")):
+            return path
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    @staticmethod
+    def _endpoint_path(path: str) -> str:
+        """Ключ метрик: путь API без query; внешние URL (presigned) — одной группой."""
+        if path.startswith(("http://", "https://")):
+            return "external"
+        return "/" + path.split("?")[0].lstrip("/")
+
+    def _record(self, endpoint: str, seconds: float):
+        self._latencies.setdefault(endpoint, deque(maxlen=256)).append(seconds)
+
+    async def request(self, method: str, path: str, retry: Optional[bool] = None, **kwargs) -> ApiResponse:
+        """
+        Запрос к API (path относительно base_url) или по абсолютному URL.
+        retry=None — повторять только идемпотентные методы; тело ответа читается сразу.
+        """
+        if self._session is None or self._session.closed:
+            await self.start()
+        method = method.upper()
+        retries = self.retries if (retry if retry is not None else method in IDEMPOTENT_METHODS) else 0
+        endpoint = f"{method} {self._endpoint_path(path)}"
+        self._counters["requests"] += 1
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                async with self._session.request(method, self.url(path), **kwargs) as resp:
+                    body = await resp.read()
+                    result = ApiResponse(resp.status, resp.headers, body)
+                self._record(endpoint, time.perf_counter() - started)
+                if result.status not in RETRY_STATUSES or attempt >= retries:
+                    return result
+                error = f"HTTP {result.status}"
+            except asyncio.CancelledError:
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    self._counters["timeouts"] += 1
+                if attempt >= retries:
+                    self._counters["errors"] += 1
+                    raise
+                error = repr(e)
+            delay = random.uniform(0, self.backoff_sec * (2 ** attempt))
+            attempt += 1
+            self._counters["retries"] += 1
+            logger.warning(f"{endpoint}: {error}, попытка {attempt}/{retries} через {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+    async def get(self, path: str, **kwargs) -> ApiResponse:
+        return await self.request("GET", path, **kwargs)
+
+    async def post(self, path: str, **kwargs) -> ApiResponse:
+        return await self.request("POST", path, **kwargs)
+
+    async def stream(self, path: str, chunk_size: int = 64 * 1024, **kwargs) -> AsyncIterator[bytes]:
+        """GET с отдачей тела кусками, без буферизации всего ответа (без повторов: поток не перезапустить)."""
+        if self._session is None or self._session.closed:
+            await self.start()
+        endpoint = f"GET {self._endpoint_path(path)}"
+        self._counters["requests"] += 1
+        started = time.perf_counter()
+        try:
+            async with self._session.get(self.url(path), **kwargs) as resp:
+                resp.raise_for_status()
+                async for chunk in resp.content.iter_chunked(chunk_size):
+                    yield chunk
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self._counters["errors"] += 1
+            raise
+        self._record(endpoint, time.perf_counter() - started)
+
+    def stats(self) -> dict:
+        endpoints = {}
+        for endpoint, samples in self._latencies.items():
+            ordered = sorted(samples)
+            endpoints[endpoint] = {
+                "samples": len(ordered),
+                "avg_sec": round(sum(ordered) / len(ordered), 4),
+                "p95_sec": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 4),
+            }
+        return {**self._counters, "endpoints": endpoints}
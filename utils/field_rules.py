@@ -0,0 +1,239 @@
+import re
+from datetime import datetime
+from typing import List, Dict, Optional, Callable, Tuple
+import logging_conf
+
+logger = logging_conf.logger.getChild("field_rules")
+
+DATE_FORMATS = [
+    "%B %d, %Y", "%b %d, %Y", "%B %d %Y", "%b %d %Y", "%d %B %Y", "%d %b %Y", "%d %B, %Y",
+    "%d.%m.%Y", "%d/%m/%Y", "%m/%d/%Y", "%Y-%m-%d", "%d-%m-%Y", "%d.%m.%y", "%d/%m/%y",
+]
+CURRENCY_SYMBOLS = {"$": "USD", "€": "EUR", "£": "GBP", "₽": "RUB", "₾": "GEL", "¥": "JPY", "₸": "KZT"}
+CURRENCY_CODES = {
+    "USD", "EUR", "GBP", "RUB", "GEL", "JPY", "CNY", "CHF", "AED", "KZT", "UAH", "TRY", "AMD", "PLN",
+    "CZK", "SEK", "NOK", "DKK", "CAD", "AUD", "INR", "BYN", "UZS", "AZN",
+}
+
+IBAN_RE = re.compile(r"\b[A-Z]{2}\d{2}(?: ?[A-Z0-9]){11,30}\b")
+BIC_RE = re.compile(r"^[A-Z]{4}[A-Z]{2}[A-Z0-9]{2}(?:[A-Z0-9]{3})?$")
+EMAIL_RE = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+PHONE_RE = re.compile(r"^\+?[\d\s\-().]{7,20}$")
+AMOUNT_RE = re.compile(
+    r"^(?:[A-Z]{3}\s?|[$€£₽₾¥₸]\s?)?-?\d[\d\s., ]*(?:\s?(?:[A-Z]{3}|[$€£₽₾¥₸]))?$"
+)
+ACCOUNT_RE = re.compile(r"^[A-Z0-9][A-Z0-9 \-]{5,33}$")
+
+LABELS: Dict[str, re.Pattern] = {
+    "Invoice Date": re.compile(r"^(invoice date|date of issue|issue date|invoice dated|date)\b\s*:?", re.I),
+    "Due Date": re.compile(r"^(due date|payment due|due)\b\s*:?", re.I),
+    "Subtotal": re.compile(r"^sub[\s-]?total\b\s*:?", re.I),
+    "Total": re.compile(r"^(grand total|total due|amount due|balance due|total)\b\s*:?", re.I),
+    "IBAN": re.compile(r"^iban\b\s*:?", re.I),
+    "SWIFT": re.compile(r"^(swift(/bic)?|bic(/swift)?)(\s+code)?\b\s*:?", re.I),
+    "Account Number": re.compile(r"^(account number|account no\.?|acc(ount)?\.? ?#|a/c no\.?)\s*:?", re.I),
+}
+CLIENT_LABEL_RE = re.compile(r"^(billed to|bill to|invoice to|client|customer|buyer)\b", re.I)
+
+
+def iban_is_valid(value: str) -> bool:
+    """Проверка IBAN по контрольной сумме (mod 97)."""
+    iban = value.replace(" ", "").upper()
+    if not re.fullmatch(r"[A-Z]{2}\d{2}[A-Z0-9]{11,30}", iban):
+        return False
+    rearranged = iban[4:] + iban[:4]
+    digits = "".join(str(int(ch, 36)) for ch in rearranged)
+    return int(digits) % 97 == 1
+
+
+def bic_is_valid(value: str) -> bool:
+    return bool(BIC_RE.match(value.replace(" ", "").upper()))
+
+
+def parse_date(value: str) -> Optional[datetime]:
+    text = re.sub(r"(\d)(st|nd|rd|th)\b", r"\1", value.strip().rstrip(".,;"))
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def is_amount(value: str) -> bool:
+    return bool(AMOUNT_RE.match(value.strip())) and any(ch.isdigit() for ch in value)
+
+
+def is_account_number(value: str) -> bool:
+    text = value.strip().upper()
+    return bool(ACCOUNT_RE.match(text)) and sum(ch.isdigit() for ch in text) >= 6
+
+
+def is_phone(value: str) -> bool:
+    return bool(PHONE_RE.match(value.strip())) and sum(ch.isdigit() for ch in value) >= 7
+
+
+def find_currency(value: str) -> Optional[Tuple[str, int, int]]:
+    """Ищет код или символ валюты в строке суммы: (код, начало, конец)."""
+    for m in re.finditer(r"\b[A-Z]{3}\b", value):
+        if m.group(0) in CURRENCY_CODES:
+            return m.group(0), m.start(), m.end()
+    for i, ch in enumerate(value):
+        if ch in CURRENCY_SYMBOLS:
+            return CURRENCY_SYMBOLS[ch], i, i + 1
+    return None
+
+
+VALIDATORS: Dict[str, Callable[[str], bool]] = {
+    "Invoice Date": lambda v: parse_date(v) is not None,
+    "Due Date": lambda v: parse_date(v) is not None,
+    "Subtotal": is_amount,
+    "Total": is_amount,
+    "IBAN": iban_is_valid,
+    "SWIFT": bic_is_valid,
+    "Account Number": lambda v: is_account_number(v) or iban_is_valid(v),
+}
+
+
+def _sub_bbox(span: dict, start: int, end: int) -> List[float]:
+    """Оценка bbox подстроки спана пропорционально позиции символов."""
+    x0, y0, x1, y1 = span["bbox"]
+    length = max(len(span["text"]), 1)
+    width = x1 - x0
+    return [x0 + width * start / length, y0, x0 + width * end / length, y1]
+
+
+def _field(span: dict, value: str, bbox: List[float], confidence: float) -> dict:
+    return {
+        "value": value,
+        "bbox": [round(c, 2) for c in bbox],
+        "font": span.get("font", ""),
+        "size": span.get("size", 11.0),
+        "page": span.get("page", 0),
+        "confidence": confidence,
+        "source": "rules",
+    }
+
+
+def _v_overlap(a: List[float], b: List[float]) -> float:
+    inter = min(a[3], b[3]) - max(a[1], b[1])
+    return inter / max(min(a[3] - a[1], b[3] - b[1]), 1e-6)
+
+
+def _right_neighbor(spans: List[dict], label: dict) -> Optional[dict]:
+    candidates = [
+        s for s in spans
+        if s is not label and s["page"] == label["page"]
+        and s["bbox"][0] >= label["bbox"][2] - 1 and _v_overlap(s["bbox"], label["bbox"]) > 0.5
+    ]
+    return min(candidates, key=lambda s: s["bbox"][0] - label["bbox"][2], default=None)
+
+
+def _below_neighbor(spans: List[dict], label: dict) -> Optional[dict]:
+    size = float(label.get("size", 11.0))
+    candidates = [
+        s for s in spans
+        if s is not label and s["page"] == label["page"]
+        and 0 <= s["bbox"][1] - label["bbox"][3] + 1 <= 2.5 * size
+        and min(s["bbox"][2], label["bbox"][2]) - max(s["bbox"][0], label["bbox"][0]) > 0
+    ]
+    return min(candidates, key=lambda s: s["bbox"][1], default=None)
+
+
+def _labeled_value(spans: List[dict], field: str) -> Optional[dict]:
+    label_re = LABELS[field]
+    validate = VALIDATORS[field]
+    for span in spans:
+        m = label_re.match(span["text"])
+        if not m:
+            continue
+        rest = span["text"][m.end():]
+        value = rest.strip()
+        if value and validate(value):
+            start = m.end() + (len(rest) - len(rest.lstrip()))
+            return _field(span, value, _sub_bbox(span, start, start + len(value)), 0.9)
+        if value:
+            continue
+        for neighbor in (_right_neighbor(spans, span), _below_neighbor(spans, span)):
+            if neighbor is not None and validate(neighbor["text"]):
+                return _field(neighbor, neighbor["text"], list(neighbor["bbox"]), 0.9)
+    return None
+
+
+def _unlabeled_iban(spans: List[dict]) -> Optional[dict]:
+    for span in spans:
+        for m in IBAN_RE.finditer(span["text"]):
+            if iban_is_valid(m.group(0)):
+                return _field(span, m.group(0), _sub_bbox(span, m.start(), m.end()), 0.95)
+    return None
+
+
+def _client_contacts(spans: List[dict]) -> Dict[str, dict]:
+    """Email и телефон клиента: ищутся в колонке под меткой «Billed To / Client»."""
+    found: Dict[str, dict] = {}
+    for label in spans:
+        if not CLIENT_LABEL_RE.match(label["text"]):
+            continue
+        column = sorted(
+            (
+                s for s in spans
+                if s["page"] == label["page"] and s["bbox"][1] >= label["bbox"][3] - 1
+                and abs(s["bbox"][0] - label["bbox"][0]) < 3 * float(label.get("size", 11.0))
+            ),
+            key=lambda s: s["bbox"][1]
+        )
+        prev_bottom = label["bbox"][3]
+        for span in column[:8]:
+            if span["bbox"][1] - prev_bottom > 3 * float(span.get("size", 11.0)):
+                break
+            prev_bottom = span["bbox"][3]
+            text = span["text"].strip()
+            email = EMAIL_RE.search(text)
+            if email and "Client Email" not in found:
+                found["Client Email"] = _field(span, email.group(0), _sub_bbox(span, email.start(), email.end()), 0.85)
+            elif is_phone(text) and "Client Phone" not in found:
+                found["Client Phone"] = _field(span, text, list(span["bbox"]), 0.85)
+        if found:
+            break
+    return found
+
+
+def extract_fields_by_rules(blocks: List[dict]) -> Dict[str, dict]:
+    """
+    Детерминированное извлечение полей со строгим форматом (даты, суммы, IBAN, SWIFT, счет,
+    валюта, контакты клиента). Возвращает только найденные поля с bbox и confidence.
+    """
+    spans = [
+        {**b, "text": (b.get("text") or "").strip(), "page": b.get("page", 0)}
+        for b in blocks if (b.get("text") or "").strip() and b.get("bbox")
+    ]
+    spans.sort(key=lambda s: (s["page"], s["bbox"][1], s["bbox"][0]))
+    fields: Dict[str, dict] = {}
+    for field in LABELS:
+        value = _labeled_value(spans, field)
+        if value is not None:
+            fields[field] = value
+    if "IBAN" not in fields:
+        iban = _unlabeled_iban(spans)
+        if iban is not None:
+            fields["IBAN"] = iban
+    for amount_field in ("Total", "Subtotal"):
+        amount = fields.get(amount_field)
+        currency = find_currency(amount["value"]) if amount else None
+        if currency:
+            code, start, end = currency
+            span = next((
+                s for s in spans
+                if s["page"] == amount["page"] and amount["value"] in s["text"]
+                and s["bbox"][0] <= amount["bbox"][0] + 1 and s["bbox"][2] >= amount["bbox"][2] - 1
+                and _v_overlap(s["bbox"], amount["bbox"]) > 0.5
+            ), None)
+            if span is None:
+                continue
+            offset = span["text"].find(amount["value"])
+            fields["Currency"] = _field(span, amount["value"][start:end],
+                                        _sub_bbox(span, offset + start, offset + end), 0.85)
+            break
+    fields.update(_client_contacts(spans))
+    logger.info(f"Rule-based extraction: {list(fields.keys())}")
+    return fields
@@ -0,0 +1,68 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import logging_conf
+
+logger = logging_conf.logger.getChild("ingest")
+
+READ_CHUNK = 1024 * 1024
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class IngestedFile:
+    """Содержимое загруженного файла, прочитанное за один проход, и его SHA-256."""
+
+    def __init__(self, filename: str, data: bytes, sha256: str):
+        self.filename = filename
+        self.data = data
+        self.sha256 = sha256
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+
+async def read_upload(upload, max_bytes: int) -> IngestedFile:
+    """
+    Читает UploadFile один раз кусками: размер проверяется по ходу чтения (без seek),
+    хэш считается на лету. Превышение лимита — UploadTooLarge, остаток потока не читается.
+    """
+    h = hashlib.sha256()
+    buf = bytearray()
+    while True:
+        chunk = await upload.read(READ_CHUNK)
+        if not chunk:
+            break
+        if len(buf) + len(chunk) > max_bytes:
+            raise UploadTooLarge(f"{upload.filename}: больше {max_bytes} байт")
+        h.update(chunk)
+        buf += chunk
+    return IngestedFile(upload.filename, bytes(buf), h.hexdigest())
+
+
+def write_bytes_atomic(path: str, data: bytes):
+    """Запись через временный файл в той же папке и rename: читатели не видят недописанный файл."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".tmp_")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def copy_file_atomic(src: str, dst: str):
+    """Копия файла, появляющаяся в dst целиком (временный файл и rename)."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dst) or ".", prefix=".tmp_")
+    os.close(fd)
+    try:
+        shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dst)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
@@ -0,0 +1,226 @@
+import re
+from typing import List, Dict, Optional, Tuple
+import logging_conf
+
+logger = logging_conf.logger.getChild("line_items")
+
+HEADER_PATTERNS: Dict[str, re.Pattern] = {
+    "description": re.compile(
+        r"^(description|item|items|service|services|product|details|наименование|описание|услуга|товар)\b", re.I
+    ),
+    "qty": re.compile(r"^(qty|quantity|hours|hrs|units?|кол-во|количество)\b", re.I),
+    "price": re.compile(r"^(rate|price|unit price|unit cost|цена|ставка)\b", re.I),
+    "amount": re.compile(r"^(amount|line total|total|sum|сумма)\b", re.I),
+}
+STOP_RE = re.compile(r"^(sub[\s-]?total|total|tax|vat|balance|итого|всего|ндс)\b", re.I)
+
+
+def _v_overlap(a, b) -> float:
+    inter = min(a[3], b[3]) - max(a[1], b[1])
+    return inter / max(min(a[3] - a[1], b[3] - b[1]), 1e-6)
+
+
+def _area_overlap(a, b) -> float:
+    w = min(a[2], b[2]) - max(a[0], b[0])
+    h = min(a[3], b[3]) - max(a[1], b[1])
+    if w <= 0 or h <= 0:
+        return 0.0
+    smaller = min((a[2] - a[0]) * (a[3] - a[1]), (b[2] - b[0]) * (b[3] - b[1]))
+    return w * h / max(smaller, 1e-6)
+
+
+def _union(boxes) -> List[float]:
+    boxes = list(boxes)
+    return [min(b[0] for b in boxes), min(b[1] for b in boxes), max(b[2] for b in boxes), max(b[3] for b in boxes)]
+
+
+def _inside(box, region, tol: float = 2.0) -> bool:
+    return (box[0] >= region[0] - tol and box[1] >= region[1] - tol
+            and box[2] <= region[2] + tol and box[3] <= region[3] + tol)
+
+
+def _find_header(spans: List[Tuple[int, dict]]) -> Optional[List[Tuple[str, int, dict]]]:
+    """Строка заголовка таблицы: «Description» и хотя бы одна из колонок qty/price/amount на одной линии."""
+    for idx, span in spans:
+        if not HEADER_PATTERNS["description"].match(span["text"]):
+            continue
+        header = [("description", idx, span)]
+        used = {"description"}
+        same_line = sorted(
+            (
+                (i, s) for i, s in spans
+                if i != idx and s["page"] == span["page"] and _v_overlap(s["bbox"], span["bbox"]) > 0.5
+            ),
+            key=lambda item: item[1]["bbox"][0]
+        )
+        for i, s in same_line:
+            for column, pattern in HEADER_PATTERNS.items():
+                if column not in used and pattern.match(s["text"]):
+                    header.append((column, i, s))
+                    used.add(column)
+                    break
+        if len(header) > 1:
+            return sorted(header, key=lambda h: h[2]["bbox"][0])
+    return None
+
+
+def _column_bounds(header: List[Tuple[str, int, dict]]) -> List[Tuple[str, float, float]]:
+    bounds = []
+    for pos, (column, _, span) in enumerate(header):
+        left = -1e9 if pos == 0 else (header[pos - 1][2]["bbox"][2] + span["bbox"][0]) / 2
+        right = 1e9 if pos == len(header) - 1 else (span["bbox"][2] + header[pos + 1][2]["bbox"][0]) / 2
+        bounds.append((column, left, right))
+    return bounds
+
+
+def _column_of(span: dict, bounds) -> Optional[str]:
+    center = (span["bbox"][0] + span["bbox"][2]) / 2
+    for column, left, right in bounds:
+        if left <= center < right:
+            return column
+    return None
+
+
+def _cell(spans: List[Tuple[int, dict]]) -> Optional[dict]:
+    """Ячейка из спанов; из перекрывающихся спанов берется последний (нарисованный поверх)."""
+    kept: List[dict] = []
+    for _, span in sorted(spans, key=lambda item: item[0]):
+        kept = [k for k in kept if _area_overlap(k["bbox"], span["bbox"]) < 0.5]
+        kept.append(span)
+    if not kept:
+        return None
+    kept.sort(key=lambda s: s["bbox"][0])
+    return {
+        "value": " ".join(s["text"] for s in kept),
+        "bbox": [round(c, 2) for c in _union(s["bbox"] for s in kept)],
+        "font": kept[0].get("font", ""),
+        "size": kept[0].get("size", 11.0),
+        "page": kept[0]["page"],
+    }
+
+
+def _find_region(box, regions: List[List[float]], line_height: float) -> Optional[List[float]]:
+    for candidate in regions:
+        if _inside(box, candidate) and (candidate[3] - candidate[1]) > line_height * 2:
+            return candidate
+    return None
+
+
+def _page_rows(spans: List[Tuple[int, dict]], page: int, top: float,
+               region: Optional[List[float]] = None) -> List[List[Tuple[int, dict]]]:
+    """Спаны страницы ниже top (и внутри region, если она задана), сгруппированные в строки."""
+    below = sorted(
+        ((i, s) for i, s in spans if s["page"] == page and s["bbox"][1] >= top - 1),
+        key=lambda item: (item[1]["bbox"][1], item[1]["bbox"][0])
+    )
+    rows: List[List[Tuple[int, dict]]] = []
+    for i, span in below:
+        if region is not None and not _inside(span["bbox"], region):
+            continue
+        if rows and _v_overlap(rows[-1][0][1]["bbox"], span["bbox"]) > 0.5:
+            rows[-1].append((i, span))
+        else:
+            rows.append([(i, span)])
+    return rows
+
+
+def _row_cells(row: List[Tuple[int, dict]], bounds) -> Dict[str, List[Tuple[int, dict]]]:
+    cells: Dict[str, List[Tuple[int, dict]]] = {}
+    for i, s in row:
+        column = _column_of(s, bounds)
+        if column:
+            cells.setdefault(column, []).append((i, s))
+    return cells
+
+
+def _is_item_row(row: List[Tuple[int, dict]], bounds) -> bool:
+    cells = _row_cells(row, bounds)
+    return "description" in cells and len(cells) > 1
+
+
+def _scan_rows(rows, bounds, prev_bottom: float, line_height: float, items: List[dict],
+               table_indices: List[int]) -> str:
+    """
+    Разбирает строки одной страницы в позиции. Возвращает причину остановки: stop — строка
+    Subtotal/Total (таблица закончилась), break — разрыв или строка без описания, end — кончилась страница.
+    """
+    page_start = len(items)
+    for row in rows:
+        if any(STOP_RE.match(s["text"]) for _, s in row):
+            return "stop"
+        top = min(s["bbox"][1] for _, s in row)
+        if top - prev_bottom > 3 * line_height:
+            return "break"
+        cells = _row_cells(row, bounds)
+        description = _cell(cells.get("description", []))
+        if description is None:
+            return "break"
+        numeric = {c: _cell(cells.get(c, [])) for c in ("qty", "price", "amount")}
+        if len(items) > page_start and not any(numeric.values()) and top - prev_bottom < 0.6 * line_height:
+            last = items[-1]
+            last["value"] = f"{last['value']} {description['value']}"
+            last["bbox"] = [round(c, 2) for c in _union([last["bbox"], description["bbox"]])]
+        else:
+            items.append({**description, "confidence": 0.9, "source": "table", **numeric})
+        table_indices.extend(i for i, _ in row)
+        prev_bottom = max(s["bbox"][3] for _, s in row)
+    return "end"
+
+
+def detect_line_items(
+    blocks: List[dict],
+    table_regions: Optional[Dict[int, List[List[float]]]] = None
+) -> Tuple[List[dict], List[int], bool]:
+    """
+    Находит таблицу позиций счета по геометрии спанов (заголовок Description/Qty/Price/Amount,
+    колонки по позициям заголовков, строки до Subtotal/Total). Если переданы области таблиц
+    от PyMuPDF (page.find_tables), строки ограничиваются областью, содержащей заголовок.
+    Таблица, дошедшая до конца страницы, продолжается на следующей: с повторенного заголовка
+    или с первой строки, попадающей в те же колонки (описание и число).
+    Возвращает (позиции в формате поля Descriptions, индексы блоков таблицы, закончилась ли
+    таблица строкой итогов — только тогда список позиций полный).
+    """
+    spans = [
+        (i, {**b, "text": (b.get("text") or "").strip(), "page": b.get("page", 0)})
+        for i, b in enumerate(blocks) if (b.get("text") or "").strip() and b.get("bbox")
+    ]
+    header = _find_header(spans)
+    if header is None:
+        return [], [], False
+    page = header[0][2]["page"]
+    last_page = max(s["page"] for _, s in spans)
+    items: List[dict] = []
+    table_indices: List[int] = []
+    pages = []
+    while True:
+        pages.append(page)
+        regions = (table_regions or {}).get(page, [])
+        if header is not None:
+            header_box = _union(h[2]["bbox"] for h in header)
+            line_height = header_box[3] - header_box[1]
+            bounds = _column_bounds(header)
+            table_indices.extend(h[1] for h in header)
+            region = _find_region(header_box, regions, line_height)
+            rows = _page_rows(spans, page, header_box[3], region)
+            prev_bottom = header_box[3]
+        else:
+            # Продолжение без заголовка: с первой строки, где есть описание и хотя бы одно число
+            first = next((row for row in _page_rows(spans, page, -1e9) if _is_item_row(row, bounds)), None)
+            if first is None:
+                break
+            prev_bottom = min(s["bbox"][1] for _, s in first)
+            region = _find_region(_union(s["bbox"] for _, s in first), regions, line_height)
+            rows = _page_rows(spans, page, prev_bottom, region)
+        reason = _scan_rows(rows, bounds, prev_bottom, line_height, items, table_indices)
+        if reason != "end" or page >= last_page:
+            break
+        page += 1
+        header = _find_header([(i, s) for i, s in spans if s["page"] == page])
+    if not items:
+        return [], [], False
+    complete = reason == "stop"
+    logger.info(
+        f"Найдена таблица позиций: {len(items)} строк на страницах {pages}"
+        f"{'' if complete else ' (без строки итогов)'}"
+    )
+    return items, table_indices, complete
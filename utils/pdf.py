@@ -1,11 +1,14 @@
 import fitz
+import io
 import os
 import json
-import shutil
+import hashlib
 import zipfile
 import xml.etree.ElementTree as ET
-from typing import Dict, Union, Optional, List
+from typing import Dict, Union, Optional, List, Tuple, BinaryIO
 import logging_conf
+from utils.span_index import SpanIndex, IndexedSpan
+from utils.ingest import write_bytes_atomic
 
 logger = logging_conf.logger.getChild("pdf_util")
 
@@ -13,20 +16,181 @@ logger = logging_conf.logger.getChild("pdf_util")
 FONT_MAP: Dict[str, str] = {}
 
 
+def file_sha256(file_path: str) -> str:
+    """SHA-256 содержимого файла (для проверки, менялся ли исходник шаблона)."""
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
 def normalize_font_name(name: str) -> str:
     return name.split("+")[-1] if "+" in name else name
 
 
-def extract_fonts_from_pdf(file_path: str) -> List[str]:
-    doc = fitz.open(file_path)
+def analyze_document(doc) -> Tuple[List[str], List[dict], List[Tuple[float, float]], List[IndexedSpan]]:
+    """Один проход rawdict по страницам: шрифты, блоки-спаны, размеры страниц и спаны с глифами."""
     fonts = set()
-    for page in doc:
+    blocks = []
+    spans = []
+    page_sizes = []
+    for page_num, page in enumerate(doc):
+        page_sizes.append((page.rect.width, page.rect.height))
         for font in page.get_fonts():
             fonts.add(normalize_font_name(font[3]))
-    return list(fonts)
+        for block in page.get_text("rawdict")["blocks"]:
+            if block["type"] != 0:
+                continue
+            for line in block["lines"]:
+                for span in line["spans"]:
+                    chars = span.get("chars", [])
+                    text = "".join(ch["c"] for ch in chars)
+                    blocks.append({
+                        "page": page_num,
+                        "text": text.strip(),
+                        "bbox": span["bbox"],
+                        "font": span.get("font", ""),
+                        "size": span.get("size", 11.0),
+                        "flags": span.get("flags", 0)
+                    })
+                    if text.strip():
+                        spans.append(IndexedSpan(page_num, text, tuple(span["bbox"]),
+                                                 [tuple(ch["bbox"]) for ch in chars]))
+    return list(fonts), blocks, page_sizes, spans
+
+
+def parse_pdf_bytes(data: bytes, filetype: str = "pdf") -> dict:
+    """
+    Разбор документа из байтов в компактный, сериализуемый вид (для рабочих процессов):
+    спаны — кортежи (page, text, bbox, chars), из которых SpanIndex собирается без повторного парсинга.
+    """
+    with fitz.open(stream=data, filetype=filetype) as doc:
+        fonts, blocks, page_sizes, spans = analyze_document(doc)
+    return {
+        "fonts": fonts,
+        "blocks": blocks,
+        "page_sizes": page_sizes,
+        "spans": [(s.page, s.text, s.bbox, s.chars) for s in spans],
+    }
+
+
+class DocumentAnalysis:
+    """
+    Документ, открытый один раз на запрос: шрифты, спаны, размеры страниц и индекс спанов
+    считаются за один проход по страницам. Ресурсы освобождаются через close() или with.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        data: Optional[bytes] = None,
+        filetype: str = "pdf",
+        sha256: Optional[str] = None
+    ):
+        if data is None:
+            with open(path, "rb") as f:
+                data = f.read()
+        self.path = path
+        self.data = data
+        self.sha256 = sha256 or hashlib.sha256(data).hexdigest()
+        self.doc = fitz.open(stream=data, filetype=filetype)
+        self.font_buffers: Dict[str, bytes] = {}
+        self._fonts: Optional[List[str]] = None
+        self._blocks: Optional[List[dict]] = None
+        self._page_sizes: Optional[List[Tuple[float, float]]] = None
+        self._span_index: Optional[SpanIndex] = None
+        self._table_regions: Optional[Dict[int, List[List[float]]]] = None
+
+    def __enter__(self) -> "DocumentAnalysis":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if not self.doc.is_closed:
+            self.doc.close()
+
+    def _analyze(self):
+        self._fonts, self._blocks, self._page_sizes, spans = analyze_document(self.doc)
+        self._span_index = SpanIndex(spans)
+
+    @property
+    def fonts(self) -> List[str]:
+        if self._fonts is None:
+            self._analyze()
+        return self._fonts
+
+    @property
+    def blocks(self) -> List[dict]:
+        if self._blocks is None:
+            self._analyze()
+        return self._blocks
+
+    @property
+    def page_sizes(self) -> List[Tuple[float, float]]:
+        if self._page_sizes is None:
+            self._analyze()
+        return self._page_sizes
+
+    @property
+    def span_index(self) -> SpanIndex:
+        if self._span_index is None:
+            self._analyze()
+        return self._span_index
+
+    def font_buffer(self, font_path: str) -> bytes:
+        """Содержимое TTF; читается с диска один раз на документ (или берется из пула)."""
+        if font_path not in self.font_buffers:
+            with open(font_path, "rb") as f:
+                self.font_buffers[font_path] = f.read()
+        return self.font_buffers[font_path]
+
+    @property
+    def table_regions(self) -> Dict[int, List[List[float]]]:
+        """Области таблиц по страницам (PyMuPDF find_tables) — подсказка для поиска позиций счета."""
+        if self._table_regions is None:
+            regions: Dict[int, List[List[float]]] = {}
+            for page_num, page in enumerate(self.doc):
+                try:
+                    tables = page.find_tables()
+                except Exception as e:
+                    logger.warning(f"find_tables не сработал на странице {page_num}: {e}")
+                    continue
+                boxes = [list(t.bbox) for t in tables.tables]
+                if boxes:
+                    regions[page_num] = boxes
+            self._table_regions = regions
+        return self._table_regions
+
+
+def analyze_template_file(file_path: str) -> dict:
+    """Шрифты, блоки, области таблиц и хэш шаблона за одно открытие документа."""
+    with open(file_path, "rb") as f:
+        data = f.read()
+    return analyze_template_data(data, os.path.splitext(file_path)[1])
+
+
+def analyze_template_data(data: bytes, ext: str, sha256: Optional[str] = None) -> dict:
+    """То же, что analyze_template_file, но по буферу в памяти (без чтения с диска)."""
+    ext = ext.lower()
+    docx_fonts = extract_fonts_from_docx(io.BytesIO(data)) if ext == ".docx" else None
+    with DocumentAnalysis(data=data, filetype=ext.lstrip(".") or "pdf", sha256=sha256) as analysis:
+        return {
+            "fonts": docx_fonts if docx_fonts is not None else analysis.fonts,
+            "blocks": analysis.blocks,
+            "table_regions": analysis.table_regions,
+            "sha256": analysis.sha256,
+        }
+
+
+def extract_fonts_from_pdf(file_path: str) -> List[str]:
+    with DocumentAnalysis(file_path) as analysis:
+        return analysis.fonts
 
 
-def extract_fonts_from_docx(file_path: str) -> List[str]:
+def extract_fonts_from_docx(file_path: Union[str, BinaryIO]) -> List[str]:
     fonts = set()
     try:
         with zipfile.ZipFile(file_path, 'r') as docx:
@@ -46,148 +210,170 @@ def extract_fonts_from_docx(file_path: str) -> List[str]:
 
 def save_extracted_fonts_list(dirpath: str, invoice_name: str, fonts: List[str]) -> str:
     path = os.path.join(dirpath, f"{invoice_name}_extracted_fonts.txt")
-    with open(path, "w", encoding="utf-8") as f:
-        for font in fonts:
-            f.write(f"{font}\n")
+    write_bytes_atomic(path, "".join(f"{font}\n" for font in fonts).encode("utf-8"))
     return path
 
 
 def save_parsed_data_json(dirpath: str, invoice_name: str, data: dict) -> str:
     path = os.path.join(dirpath, f"{invoice_name}_parsed_fields.json")
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    write_bytes_atomic(path, json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8"))
     return path
 
 
 def extract_blocks_from_pdf(pdf_path: str) -> List[dict]:
-    doc = fitz.open(pdf_path)
-    all_blocks = []
-    for page_num, page in enumerate(doc):
-        d = page.get_text("dict")
-        for block in d["blocks"]:
-            if block["type"] != 0:
-                continue
-            for line in block["lines"]:
-                for span in line["spans"]:
-                    all_blocks.append({
-                        "page": page_num,
-                        "text": span["text"].strip(),
-                        "bbox": span["bbox"],
-                        "font": span.get("font", ""),
-                        "size": span.get("size", 11.0),
-                        "flags": span.get("flags", 0)
-                    })
-    return all_blocks
+    with DocumentAnalysis(pdf_path) as analysis:
+        return analysis.blocks
 
 
-def find_value_bbox(page, value):
-    if not value:
-        return None
-    rects = page.search_for(str(value))
-    if rects:
-        return [rects[0].x0, rects[0].y0, rects[0].x1, rects[0].y1]
-    return None
+def find_table_regions(pdf_path: str) -> Dict[int, List[List[float]]]:
+    with DocumentAnalysis(pdf_path) as analysis:
+        return analysis.table_regions
 
 
-def get_font_file(pdf_fontname: str) -> Optional[str]:
-    if pdf_fontname in FONT_MAP:
-        return FONT_MAP[pdf_fontname]
-    for key, path in FONT_MAP.items():
+def get_font_file(pdf_fontname: str, font_map: Optional[Dict[str, str]] = None) -> Optional[str]:
+    font_map = font_map or FONT_MAP
+    if pdf_fontname in font_map:
+        return font_map[pdf_fontname]
+    for key, path in font_map.items():
         if key.lower() in pdf_fontname.lower():
             return path
-    return FONT_MAP.get("default")
+    return font_map.get("default")
 
 
-def replace_fields_in_pdf_bbox(
-    input_pdf: str,
-    output_pdf: str,
+def plan_replacement_ops(
+    span_index: SpanIndex,
     replacements: Dict[str, dict],
     font_map: Optional[Dict[str, str]] = None
-) -> int:
-    doc = fitz.open(input_pdf)
-    changed_count = 0
-    inserted_fonts = {}
-
+) -> List[dict]:
+    """
+    Операции отрисовки: точный прямоугольник старого значения (по индексу спанов, иначе bbox из
+    разметки), новый текст, кегль и файл шрифта. Не требует открытого документа.
+    """
+    ops = []
     for field, v in replacements.items():
         old_val = v["old"]
         new_val = v["new"]
         bbox = v["bbox"]
         page_num = v["page"]
-        font = v.get("font", "helv")
-        size = v.get("size", 11.0)
         if not old_val or not new_val or old_val == new_val or page_num is None:
             continue
-        page = doc[page_num]
-        precise_bbox = find_value_bbox(page, old_val)
-        if precise_bbox:
-            x0, y0, x1, y1 = precise_bbox
-        elif bbox:
-            x0, y0, x1, y1 = bbox
-        else:
+        rect = span_index.locate(page_num, old_val, bbox) or bbox
+        if not rect:
             continue
+        ops.append({
+            "field": field,
+            "page": page_num,
+            "rect": [float(c) for c in rect],
+            "old": str(old_val),
+            "text": str(new_val),
+            "size": v.get("size", 11.0),
+            "fontfile": get_font_file(v.get("font", "helv"), font_map),
+        })
+    return merge_overlapping_ops(ops)
+
+
+def _rects_overlap(a, b) -> bool:
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def merge_overlapping_ops(ops: List[dict]) -> List[dict]:
+    """
+    Сливает операции, где одно старое значение вложено в другое (валюта внутри суммы «60,00 USD»):
+    иначе две закраски и две надписи ложатся на одни и те же глифы. Остается большая операция,
+    в ее новом тексте старое значение вложенной заменяется новым (если сумму тоже меняли и
+    в новом тексте старой валюты уже нет — побеждает явно заданная сумма). Прямоугольники,
+    которые лишь пересекаются (соседние bbox из разметки), остаются отдельными операциями.
+    """
+    def area(op):
+        x0, y0, x1, y1 = op["rect"]
+        return (x1 - x0) * (y1 - y0)
+
+    merged: List[dict] = []
+    for op in sorted(ops, key=area, reverse=True):
+        host = next((
+            m for m in merged
+            if m["page"] == op["page"] and _rects_overlap(m["rect"], op["rect"]) and op["old"] in m["old"]
+        ), None)
+        if host is None:
+            merged.append(dict(op))
+            continue
+        if op["old"] in host["text"]:
+            host["text"] = host["text"].replace(op["old"], op["text"], 1)
+        else:
+            logger.info(f"Поле {op['field']} перекрыто полем {host['field']}, используется значение {host['field']}")
+        host["rect"] = [
+            min(host["rect"][0], op["rect"][0]), min(host["rect"][1], op["rect"][1]),
+            max(host["rect"][2], op["rect"][2]), max(host["rect"][3], op["rect"][3]),
+        ]
+    return merged
+
+
+def apply_replacement_ops(doc, ops: List[dict], font_buffer) -> int:
+    """Закрашивает старые значения и вписывает новые; font_buffer(path) -> bytes TTF."""
+    font_aliases: Dict[str, str] = {}
+    inserted_fonts = set()
+    for op in ops:
+        page_num = op["page"]
+        page = doc[page_num]
+        x0, y0, x1, y1 = op["rect"]
         pad = 1
         rect = fitz.Rect(x0 - pad, y0 - pad, x1 + pad, y1 + pad)
         page.draw_rect(rect, color=(1,1,1), fill=(1,1,1))
 
-        fontfile = None
-        fontname = font
-        fm = font_map or FONT_MAP
-        if fm:
-            fontfile = get_font_file(font)
+        fontname = "helv"
+        fontfile = op.get("fontfile")
         if fontfile:
-            if fontfile not in inserted_fonts:
-                fontname = doc.insert_font(file=fontfile)
-                inserted_fonts[fontfile] = fontname
-            else:
-                fontname = inserted_fonts[fontfile]
-        else:
-            fontname = "helv"
+            alias = font_aliases.setdefault(fontfile, f"tplfont{len(font_aliases)}")
+            try:
+                if (page_num, alias) not in inserted_fonts:
+                    page.insert_font(fontname=alias, fontbuffer=font_buffer(fontfile))
+                    inserted_fonts.add((page_num, alias))
+                fontname = alias
+            except (OSError, RuntimeError, ValueError) as e:
+                logger.warning(f"Шрифт {fontfile} не вставлен, используется helv: {e}")
 
-        insert_x = x0
-        insert_y = y1 - 2
         page.insert_text(
-            (insert_x, insert_y),
-            str(new_val),
-            fontsize=size,
+            (x0, y1 - 2),
+            op["text"],
+            fontsize=op["size"],
             fontname=fontname,
             color=(0,0,0),
             overlay=True
         )
-        changed_count += 1
-    doc.save(output_pdf)
-    doc.close()
-    return changed_count
-
-
-def process_invoice_and_replace(
-    pdf_path: str,
-    output_pdf: str,
-    changes: Dict[str, str],
-    font_map: Optional[Dict[str, str]] = None,
-    extract_fields_with_bbox_gemini=None
-) -> Dict[str, Union[int, str, dict]]:
-    blocks = extract_blocks_from_pdf(pdf_path)
-    if extract_fields_with_bbox_gemini is None:
-        raise RuntimeError("extract_fields_with_bbox_gemini не передан! Используйте сервис Gemini.")
-    fields = extract_fields_with_bbox_gemini(blocks)
+    return len(ops)
+
+
+def draw_replacements(data: bytes, ops: List[dict], font_buffers: Dict[str, bytes]) -> bytes:
+    """Рендер из байтов в байты — задача для рабочего процесса, без обращения к диску."""
+    with fitz.open(stream=data, filetype="pdf") as doc:
+        apply_replacement_ops(doc, ops, lambda path: font_buffers[path])
+        return doc.tobytes()
+
+
+def merge_pdf_bytes(parts: List[bytes]) -> bytes:
+    """Склеивает несколько PDF в один (для пакетной генерации одним файлом)."""
+    with fitz.open() as merged:
+        for data in parts:
+            with fitz.open(stream=data, filetype="pdf") as doc:
+                merged.insert_pdf(doc)
+        return merged.tobytes(garbage=3, deflate=True)
+
+
+def collect_editable_fields(fields: dict) -> List[Tuple[str, dict]]:
+    """Редактируемые поля разметки: позиции счета как «Service N», затем остальные поля."""
     editable_fields = []
-    desc_values = set()
     if "Descriptions" in fields and isinstance(fields["Descriptions"], list):
         for idx, elem in enumerate(fields["Descriptions"], 1):
             if isinstance(elem, dict) and elem.get("value"):
                 editable_fields.append((f"Service {idx}", elem))
-                desc_values.add(elem.get("value"))
     elif "Descriptions" in fields and isinstance(fields["Descriptions"], dict) and fields["Descriptions"].get("value"):
         editable_fields.append(("Service", fields["Descriptions"]))
-        desc_values.add(fields["Descriptions"].get("value"))
     elif "Description" in fields and isinstance(fields["Description"], dict) and fields["Description"].get("value"):
         editable_fields.append(("Service", fields["Description"]))
-        desc_values.add(fields["Description"].get("value"))
     elif "Description" in fields and isinstance(fields["Description"], list):
         for idx, elem in enumerate(fields["Description"], 1):
             if isinstance(elem, dict) and elem.get("value"):
                 editable_fields.append((f"Service {idx}", elem))
-                desc_values.add(elem.get("value"))
     for k, v in fields.items():
         if k in ("Description", "Descriptions"):
             continue
@@ -197,6 +383,10 @@ def process_invoice_and_replace(
                     editable_fields.append((k, elem))
         elif isinstance(v, dict) and v.get("value"):
             editable_fields.append((k, v))
+    return editable_fields
+
+
+def build_replacements(editable_fields: List[Tuple[str, dict]], changes: Dict[str, str]) -> Dict[str, dict]:
     replacements = {}
     for k, v in editable_fields:
         orig_value = v.get("value")
@@ -213,18 +403,4 @@ def process_invoice_and_replace(
                     "font": v.get("font", "helv"),
                     "size": v.get("size", 11.0)
                 }
-    if not replacements:
-        shutil.copy(pdf_path, output_pdf)
-        return {
-            "changed_count": 0,
-            "output_pdf": output_pdf,
-            "fields_found": {k: v.get("value") for k, v in editable_fields},
-            "fields_changed": {}
-        }
-    count = replace_fields_in_pdf_bbox(pdf_path, output_pdf, replacements, font_map)
-    return {
-        "changed_count": count,
-        "output_pdf": output_pdf,
-        "fields_found": {k: v.get("value") for k, v in editable_fields},
-        "fields_changed": {k: changes[k] for k in replacements},
-    }
+    return replacements
@@ -0,0 +1,178 @@
+import json
+import math
+import threading
+from typing import Callable, List, Dict, Tuple, Any
+import logging_conf
+
+logger = logging_conf.logger.getChild("prompt_encoding")
+
+CHARS_PER_TOKEN = 4
+
+
+class PromptSizeCounter:
+    """Счетчик размера промптов до и после компактного кодирования."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {"prompts": 0, "raw_chars": 0, "encoded_chars": 0, "raw_tokens": 0, "encoded_tokens": 0,
+                      "split_pages": 0}
+
+    def record(self, raw_chars: int, encoded_chars: int):
+        with self._lock:
+            self._data["prompts"] += 1
+            self._data["raw_chars"] += raw_chars
+            self._data["encoded_chars"] += encoded_chars
+            self._data["raw_tokens"] += estimate_tokens_from_chars(raw_chars)
+            self._data["encoded_tokens"] += estimate_tokens_from_chars(encoded_chars)
+
+    def record_split(self, pages: int = 1):
+        with self._lock:
+            self._data["split_pages"] += pages
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._data)
+        stats["saved_ratio"] = (
+            round(1 - stats["encoded_chars"] / stats["raw_chars"], 4) if stats["raw_chars"] else 0.0
+        )
+        return stats
+
+
+prompt_size_counter = PromptSizeCounter()
+
+
+def estimate_tokens_from_chars(chars: int) -> int:
+    return math.ceil(chars / CHARS_PER_TOKEN)
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов (≈4 символа на токен), без обращения к API."""
+    return estimate_tokens_from_chars(len(text))
+
+
+def raw_blocks_json(blocks: List[dict]) -> str:
+    return json.dumps(blocks, ensure_ascii=False)
+
+
+def merge_spans_into_lines(blocks: List[dict], gap_ratio: float = 0.6) -> List[dict]:
+    """
+    Склеивает соседние спаны одной строки (та же страница, базовая линия, шрифт и размер),
+    если расстояние между ними меньше gap_ratio * size. Пустые спаны отбрасываются.
+    """
+    spans = [b for b in blocks if (b.get("text") or "").strip() and b.get("bbox")]
+    spans.sort(key=lambda b: (b.get("page", 0), round(b["bbox"][3]), b["bbox"][0]))
+    lines: List[dict] = []
+    for span in spans:
+        prev = lines[-1] if lines else None
+        size = float(span.get("size", 11.0))
+        if (
+            prev is not None
+            and prev["page"] == span.get("page", 0)
+            and prev["font"] == span.get("font", "")
+            and abs(prev["size"] - size) < 0.1
+            and abs(prev["bbox"][3] - span["bbox"][3]) < size * 0.25
+            and 0 <= span["bbox"][0] - prev["bbox"][2] <= size * gap_ratio
+        ):
+            gap = span["bbox"][0] - prev["bbox"][2]
+            prev["text"] = prev["text"] + (" " if gap > size * 0.15 else "") + span["text"].strip()
+            prev["bbox"] = [
+                min(prev["bbox"][0], span["bbox"][0]), min(prev["bbox"][1], span["bbox"][1]),
+                max(prev["bbox"][2], span["bbox"][2]), max(prev["bbox"][3], span["bbox"][3]),
+            ]
+            continue
+        lines.append({
+            "page": span.get("page", 0),
+            "text": span["text"].strip(),
+            "bbox": list(span["bbox"]),
+            "font": span.get("font", ""),
+            "size": size,
+        })
+    return lines
+
+
+def _num(value: float, precision: int) -> str:
+    text = f"{value:.{precision}f}"
+    return text.rstrip("0").rstrip(".") if "." in text else text
+
+
+def _cell(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("|", "\\|").replace("\n", " ")
+
+
+def encode_blocks_compact(blocks: List[dict], precision: int = 1) -> str:
+    """
+    Компактное табличное представление блоков для промпта:
+    таблица шрифтов (id=font/size) и строки `page|x0|y0|x1|y1|font_id|text`.
+    """
+    lines = merge_spans_into_lines(blocks)
+    fonts: Dict[Tuple[str, float], int] = {}
+    rows = []
+    for line in lines:
+        key = (line["font"], round(line["size"], 1))
+        font_id = fonts.setdefault(key, len(fonts))
+        coords = "|".join(_num(c, precision) for c in line["bbox"])
+        rows.append(f"{line['page']}|{coords}|{font_id}|{_cell(line['text'])}")
+    font_rows = [f"{fid}={name}/{size:g}" for (name, size), fid in fonts.items()]
+    return "fonts:\n" + "\n".join(font_rows) + "\nrows (page|x0|y0|x1|y1|font|text):\n" + "\n".join(rows)
+
+
+def split_blocks_by_page(blocks: List[dict]) -> Dict[int, List[dict]]:
+    pages: Dict[int, List[dict]] = {}
+    for b in blocks:
+        pages.setdefault(b.get("page", 0), []).append(b)
+    return dict(sorted(pages.items()))
+
+
+def encode_blocks(blocks: List[dict], mode: str = "json") -> str:
+    """Блоки в том виде, в котором они попадут в промпт: json — исходный JSON, compact — таблица."""
+    return encode_blocks_compact(blocks) if mode == "compact" else raw_blocks_json(blocks)
+
+
+def _split_to_budget(blocks: List[dict], token_budget: int, encode: Callable[[List[dict]], str]) -> List[List[dict]]:
+    """Делит подряд идущие блоки на части в пределах бюджета; блоки не отбрасываются (в части минимум один)."""
+    parts = []
+    start = 0
+    while start < len(blocks):
+        lo, hi = start + 1, len(blocks)
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if estimate_tokens(encode(blocks[start:mid])) <= token_budget:
+                lo = mid
+            else:
+                hi = mid - 1
+        parts.append(blocks[start:lo])
+        start = lo
+    return parts
+
+
+def chunk_blocks_by_budget(blocks: List[dict], token_budget: int,
+                           encode: Callable[[List[dict]], str] = encode_blocks_compact) -> List[List[dict]]:
+    """
+    Делит блоки на группы страниц, каждая из которых укладывается в бюджет токенов (оценка по encode).
+    Страница, которая сама по себе больше бюджета, делится на несколько частей — ничего не теряется.
+    """
+    if estimate_tokens(encode(blocks)) <= token_budget:
+        return [blocks]
+    chunks: List[List[dict]] = []
+    current: List[dict] = []
+    current_tokens = 0
+    for page, page_blocks in split_blocks_by_page(blocks).items():
+        page_tokens = estimate_tokens(encode(page_blocks))
+        if current_tokens + page_tokens <= token_budget:
+            current += page_blocks
+            current_tokens += page_tokens
+            continue
+        if current:
+            chunks.append(current)
+        if page_tokens <= token_budget:
+            current, current_tokens = list(page_blocks), page_tokens
+            continue
+        parts = _split_to_budget(page_blocks, token_budget, encode)
+        logger.warning(f"Страница {page} больше бюджета {token_budget} токенов, разбита на {len(parts)} части")
+        prompt_size_counter.record_split()
+        chunks.extend(parts[:-1])
+        current = parts[-1]
+        current_tokens = estimate_tokens(encode(current))
+    if current:
+        chunks.append(current)
+    return chunks
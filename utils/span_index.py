@@ -0,0 +1,169 @@
+import math
+from typing import List, Dict, Optional, Tuple, Iterable
+
+GRID_CELL = 64.0
+
+
+class IndexedSpan:
+    __slots__ = ("page", "text", "bbox", "chars")
+
+    def __init__(self, page: int, text: str, bbox: Tuple[float, float, float, float], chars=None):
+        self.page = page
+        self.text = text
+        self.bbox = bbox
+        self.chars = chars
+
+    def sub_bbox(self, start: int, end: int) -> List[float]:
+        """bbox подстроки: по глифам, если они есть, иначе пропорционально числу символов."""
+        if self.chars and len(self.chars) == len(self.text):
+            boxes = self.chars[start:end]
+            return [min(b[0] for b in boxes), min(b[1] for b in boxes),
+                    max(b[2] for b in boxes), max(b[3] for b in boxes)]
+        x0, y0, x1, y1 = self.bbox
+        length = max(len(self.text), 1)
+        return [x0 + (x1 - x0) * start / length, y0, x0 + (x1 - x0) * end / length, y1]
+
+
+def _center(bbox) -> Tuple[float, float]:
+    return (bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2
+
+
+def _intersects(a, b) -> bool:
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+class SpanIndex:
+    """
+    Пространственный индекс спанов документа: равномерная сетка по страницам.
+    Строится один раз на документ и заменяет полнотекстовый page.search_for на каждое поле
+    (с той же нестрогой проверкой текста): bbox от LLM «прилипает» к реальному тексту,
+    повторяющиеся значения различаются по близости.
+    """
+
+    def __init__(self, spans: Iterable[IndexedSpan], cell: float = GRID_CELL):
+        self.cell = cell
+        self.spans: List[IndexedSpan] = list(spans)
+        self._grid: Dict[Tuple[int, int, int], List[int]] = {}
+        self._by_page: Dict[int, List[int]] = {}
+        self._lines: Optional[List[Tuple[int, str, List[Tuple[int, int]]]]] = None
+        self._line_of: Dict[int, int] = {}
+        for i, span in enumerate(self.spans):
+            self._by_page.setdefault(span.page, []).append(i)
+            for key in self._cells(span.page, span.bbox):
+                self._grid.setdefault(key, []).append(i)
+
+    @classmethod
+    def from_tuples(cls, spans: Iterable[tuple]) -> "SpanIndex":
+        """Индекс из сериализуемых спанов (page, text, bbox, chars) — см. utils.pdf.parse_pdf_bytes."""
+        return cls(IndexedSpan(*span) for span in spans)
+
+    @classmethod
+    def from_blocks(cls, blocks: List[dict]) -> "SpanIndex":
+        return cls(
+            IndexedSpan(b.get("page", 0), b.get("text", ""), tuple(b["bbox"]))
+            for b in blocks if b.get("text") and b.get("bbox")
+        )
+
+    def _cells(self, page: int, bbox) -> Iterable[Tuple[int, int, int]]:
+        for gx in range(math.floor(bbox[0] / self.cell), math.floor(bbox[2] / self.cell) + 1):
+            for gy in range(math.floor(bbox[1] / self.cell), math.floor(bbox[3] / self.cell) + 1):
+                yield page, gx, gy
+
+    def _query_ids(self, page: int, bbox) -> List[int]:
+        seen = set()
+        result = []
+        for key in self._cells(page, bbox):
+            for i in self._grid.get(key, ()):
+                if i not in seen and _intersects(self.spans[i].bbox, bbox):
+                    seen.add(i)
+                    result.append(i)
+        return result
+
+    def query(self, page: int, bbox) -> List[IndexedSpan]:
+        """Спаны страницы, пересекающие прямоугольник."""
+        return [self.spans[i] for i in self._query_ids(page, bbox)]
+
+    def _build_lines(self):
+        """
+        Строки страницы: подряд идущие спаны на одной высоте. Для каждой — нормализованный текст
+        (нижний регистр, без пробелов) и позиция каждого его символа в исходном спане.
+        Строится при первом поиске; индекс может использоваться из нескольких потоков.
+        """
+        lines = []
+        line_of: Dict[int, int] = {}
+        prev = None
+        for i, span in enumerate(self.spans):
+            if prev is None or not self._same_line(self.spans[prev], span):
+                lines.append((span.page, [], []))
+            _, text, positions = lines[-1]
+            line_of[i] = len(lines) - 1
+            for pos, ch in enumerate(span.text):
+                if ch.isspace():
+                    continue
+                for low in ch.lower():
+                    text.append(low)
+                    positions.append((i, pos))
+            prev = i
+        self._line_of = line_of
+        self._lines = [(page, "".join(text), positions) for page, text, positions in lines]
+
+    @staticmethod
+    def _same_line(a: IndexedSpan, b: IndexedSpan) -> bool:
+        if a.page != b.page or b.bbox[0] < a.bbox[0]:
+            return False
+        overlap = min(a.bbox[3], b.bbox[3]) - max(a.bbox[1], b.bbox[1])
+        height = min(a.bbox[3] - a.bbox[1], b.bbox[3] - b.bbox[1])
+        return height > 0 and overlap > height * 0.5
+
+    @staticmethod
+    def _normalize(value: str) -> str:
+        return "".join(ch for ch in value.lower() if not ch.isspace())
+
+    def _match_bbox(self, positions, start: int, end: int) -> List[float]:
+        """bbox совпадения: объединение частей всех затронутых спанов (по глифам)."""
+        ranges: Dict[int, List[int]] = {}
+        for span_i, pos in positions[start:end]:
+            r = ranges.setdefault(span_i, [pos, pos])
+            r[0], r[1] = min(r[0], pos), max(r[1], pos)
+        boxes = [self.spans[i].sub_bbox(lo, hi + 1) for i, (lo, hi) in ranges.items()]
+        return [min(b[0] for b in boxes), min(b[1] for b in boxes),
+                max(b[2] for b in boxes), max(b[3] for b in boxes)]
+
+    def _matches(self, lines: Iterable[int], needle: str) -> List[List[float]]:
+        found = []
+        for line_no in lines:
+            _, text, positions = self._lines[line_no]
+            pos = text.find(needle)
+            while pos != -1:
+                found.append(self._match_bbox(positions, pos, pos + len(needle)))
+                pos = text.find(needle, pos + 1)
+        return found
+
+    def locate(self, page: int, value: str, hint: Optional[List[float]] = None) -> Optional[List[float]]:
+        """
+        Точный bbox значения на странице — как page.search_for: без учета регистра и пробелов,
+        значение может занимать несколько спанов одной строки. Сначала ищется в строках рядом
+        с hint (bbox от LLM), затем по всей странице; из нескольких вхождений выбирается ближайшее
+        к hint. None — значение не найдено (вызывающий код берет bbox из разметки).
+        """
+        needle = self._normalize(str(value or ""))
+        if not needle:
+            return None
+        if self._lines is None:
+            self._build_lines()
+        matches = []
+        if hint:
+            margin = max(hint[3] - hint[1], 1.0) * 2
+            area = [hint[0] - margin, hint[1] - margin, hint[2] + margin, hint[3] + margin]
+            near = sorted({self._line_of[i] for i in self._query_ids(page, area)})
+            matches = self._matches(near, needle)
+        if not matches:
+            matches = self._matches(
+                sorted({self._line_of[i] for i in self._by_page.get(page, ())}), needle
+            )
+        if not matches:
+            return None
+        if not hint:
+            return matches[0]
+        hx, hy = _center(hint)
+        return min(matches, key=lambda b: (_center(b)[0] - hx) ** 2 + (_center(b)[1] - hy) ** 2)